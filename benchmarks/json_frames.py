@@ -0,0 +1,77 @@
+"""
+Compares the JSON libraries Browser can use on WebSocket frames like
+those recorded from a busy room: mostly heartbeats, with small event
+payloads in between.
+
+    python benchmarks/json_frames.py [repeat]
+"""
+import importlib
+import sys
+import timeit
+
+from chatexchange import _utils
+from chatexchange.browser import Browser
+
+
+HEARTBEAT = '{"r1":{},"r17":{},"r11540":{}}'
+
+MESSAGE_POSTED = (
+    '{"r11540":{"e":[{"event_type":1,"time_stamp":1700000000,'
+    '"content":"[ <a href=\\"//github.com/Charcoal-SE/SmokeDetector\\">'
+    'SmokeDetector</a> ] Potentially bad keyword in body: '
+    '<a href=\\"//stackoverflow.com/q/1\\">Buy cheap stuff</a> by '
+    '<a href=\\"//stackoverflow.com/u/2\\">spammer</a> on '
+    '<code>stackoverflow.com</code>","id":123456789,"user_id":120914,'
+    '"user_name":"SmokeDetector","room_id":11540,'
+    '"room_name":"Charcoal HQ","message_id":65432100}],"t":123456789,"d":1}}')
+
+MESSAGE_EDITED = (
+    '{"r1":{"e":[{"event_type":2,"time_stamp":1700000001,'
+    '"content":"hello world, edited","id":123456790,"user_id":5,'
+    '"user_name":"someone","room_id":1,"room_name":"Sandbox",'
+    '"message_edits":1,"message_id":65432101}],"t":123456790,"d":1}}')
+
+STARRED = (
+    '{"r1":{"e":[{"event_type":6,"time_stamp":1700000002,'
+    '"content":"star me","id":123456791,"room_id":1,"room_name":"Sandbox",'
+    '"message_id":65432101,"message_stars":1}],"t":123456791,"d":1}}')
+
+# roughly the mix seen on a busy room
+FRAMES = [HEARTBEAT] * 6 + [MESSAGE_POSTED, MESSAGE_EDITED, STARRED, '']
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print("%d frames, %d%% heartbeats" % (
+        len(FRAMES) * repeat,
+        100 * sum(1 for f in FRAMES if f in (HEARTBEAT, '')) // len(FRAMES)))
+
+    for name in _utils.json_libraries:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            print("%-8s not installed" % (name,))
+            continue
+
+        loads = _utils.json_loads_for(name)
+
+        def parse_all(frame):
+            return loads(frame) if frame else None
+
+        plain = min(timeit.repeat(
+            lambda: [parse_all(f) for f in FRAMES],
+            number=repeat, repeat=3))
+
+        browser = Browser()
+        browser.json_loads = loads
+        skipping = min(timeit.repeat(
+            lambda: [browser.decode_frame(f) for f in FRAMES],
+            number=repeat, repeat=3))
+
+        per_frame = 1e9 / (len(FRAMES) * repeat)
+        print("%-8s %7.0f ns/frame parsing all, %7.0f ns/frame skipping heartbeats" % (
+            name, plain * per_frame, skipping * per_frame))
+
+
+if __name__ == '__main__':
+    main()
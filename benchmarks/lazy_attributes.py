@@ -0,0 +1,93 @@
+"""
+Compares the memory and attribute read cost of Message objects using
+slot-backed LazyFrom attributes with the previous WeakKeyDictionary
+storage.
+
+    python benchmarks/lazy_attributes.py [count]
+"""
+import gc
+import sys
+import timeit
+import tracemalloc
+import weakref
+
+from chatexchange import messages
+
+
+class WeakKeyLazyFrom(object):
+    """
+    LazyFrom as it was before values moved into instance slots.
+    """
+    def __init__(self, method_name):
+        self.method_name = method_name
+        self.values = weakref.WeakKeyDictionary()
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        if obj not in self.values:
+            getattr(obj, self.method_name)()
+        return self.values[obj]
+
+    def __set__(self, obj, value):
+        self.values[obj] = value
+
+
+LAZY_NAMES = (
+    'room', 'content', 'owner', '_parent_message_id', 'stars',
+    'starred_by_you', 'pinned', 'content_source', 'editor', 'edited',
+    'edits', 'pins', 'pinners', 'time_stamp')
+
+
+class OldMessage(object):
+    def __init__(self, id, client):
+        self.id = id
+        self._client = client
+
+
+for _name in LAZY_NAMES:
+    setattr(OldMessage, _name, WeakKeyLazyFrom('scrape'))
+
+
+def populate(message):
+    for name in LAZY_NAMES:
+        setattr(message, name, None)
+    message.content = 'hello'
+
+
+def measure_memory(cls, count):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    objects = []
+    for i in range(count):
+        message = cls(i, None)
+        populate(message)
+        objects.append(message)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    used = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    del objects
+    return used / float(count)
+
+
+def measure_reads(cls, number=200000):
+    message = cls(1, None)
+    populate(message)
+    return min(timeit.repeat(
+        'message.content', globals={'message': message},
+        number=number, repeat=5)) / number
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for label, cls in [
+        ('WeakKeyDictionary', OldMessage),
+        ('slots', messages.Message),
+    ]:
+        print("%-18s %8.0f bytes/object  %6.1f ns/read" % (
+            label, measure_memory(cls, count), measure_reads(cls) * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Compares the time the scrape helpers take to parse the page fixtures in
+tests/mock_responses.py with each installed BeautifulSoup tree builder.
+
+    python benchmarks/soup_parsers.py [transcript message count]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from chatexchange import _utils  # noqa: E402
+from chatexchange.browser import Browser  # noqa: E402
+from tests import mock_responses  # noqa: E402
+
+
+def main():
+    message_count = int(sys.argv[1]) if len(sys.argv) > 1 else 150
+    transcript_page = mock_responses.transcript_page(message_count)
+
+    pages = [
+        ('transcript (%d messages)' % (message_count,), transcript_page,
+         lambda soup: Browser._parse_transcript(soup, 100)),
+        ('history', mock_responses.HISTORY_PAGE,
+         lambda soup: Browser._parse_history(soup, 1234)),
+        ('profile', mock_responses.PROFILE_PAGE, Browser._parse_profile),
+        ('room info', mock_responses.ROOM_INFO_PAGE, Browser._parse_room_info),
+        ('current users', mock_responses.ROOM_PAGE, Browser._parse_current_users),
+        ('favorite', mock_responses.FAVORITE_PAGE,
+         lambda soup: soup.find('input', {'name': 'fkey'})['value']),
+    ]
+
+    for parser, module_name in _utils.html_parsers:
+        try:
+            if module_name is not None:
+                __import__(module_name)
+        except ImportError:
+            print("%s: not installed" % (parser,))
+            continue
+
+        browser = Browser()
+        browser.soup_parser = parser
+        print("%s:" % (parser,))
+        for label, page, parse in pages:
+            number = 20 if 'transcript' in label else 200
+            seconds = min(timeit.repeat(
+                lambda: parse(browser.make_soup(page)),
+                number=number, repeat=3)) / number
+            print("  %-26s %8.2f ms" % (label, seconds * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,9 +6,12 @@ if sys.version_info[0] == 2:
 else:
     from html.parser import HTMLParser
     from html import entities as htmlentitydefs
+import collections
 import functools
+import importlib
 import logging
-import weakref
+import threading
+import time
 
 
 def log_and_ignore_exceptions(
@@ -81,11 +84,173 @@ def parse_last_seen(text):
     return number * suffixes[char]
 
 
+_now = getattr(time, 'monotonic', time.time)
+
+
+# JSON libraries json_loads_for will look for, fastest first
+json_libraries = ('orjson', 'ujson', 'json')
+
+
+def json_loads_for(library=None):
+    """
+    Returns the loads function of the named JSON library, or of the
+    fastest one installed if library is None.
+    """
+    for name in ([library] if library else json_libraries):
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            if library:
+                raise
+            continue
+        return module.loads
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping that holds at most maxsize entries, discarding
+    the least recently used ones first.
+
+    If ttl is given, entries also expire ttl seconds after they were
+    last stored or looked up.
+    """
+    def __init__(self, maxsize, ttl=None):
+        assert maxsize >= 0, "maxsize must not be negative"
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (value, expiry time or None), least recently used first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _expiry(self):
+        if self.ttl is None:
+            return None
+        return _now() + self.ttl
+
+    def _expire(self, now):
+        # Entries are in order of last use, and so also of expiry time.
+        while self._entries:
+            key, (_, expiry) = next(iter(self._entries.items()))
+            if expiry is None or expiry > now:
+                break
+            del self._entries[key]
+            self.expirations += 1
+
+    def get(self, key, default=None):
+        """
+        Returns the value for key, marking it as recently used, or
+        default if it's not present.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= _now():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            # re-inserting moves it to the end (OrderedDict.move_to_end
+            # isn't available on Python 2)
+            del self._entries[key]
+            self._entries[key] = (entry[0], self._expiry())
+            return entry[0]
+
+    def put(self, key, value):
+        """
+        Stores value for key, marking it as recently used and evicting
+        the least recently used entries if the cache is full.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, self._expiry())
+            if self.ttl is not None:
+                self._expire(_now())
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return default if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and (entry[1] is None or entry[1] > _now())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+# BeautifulSoup tree builders html_parser_for will look for, fastest
+# first, and the modules they need
+html_parsers = (('lxml', 'lxml'), ('html.parser', None))
+
+
+def html_parser_for(parser=None):
+    """
+    Returns the name of the BeautifulSoup tree builder to use: parser
+    if given, or the fastest one installed.
+    """
+    if parser:
+        return parser
+    for name, module_name in html_parsers:
+        if module_name is None:
+            return name
+        try:
+            importlib.import_module(module_name)
+        except ImportError:
+            continue
+        return name
+
+
+# Stored in a lazy attribute's slot to mark it as not loaded.
+NOT_LOADED = object()
+
+
+def lazy_slots(*names):
+    """
+    Returns the __slots__ entries backing the LazyFrom attributes with
+    the given names.
+    """
+    return tuple(LazyFrom.slot_prefix + name for name in names)
+
+
 class LazyFrom(object):
     """
     A descriptor used when multiple lazy attributes depend on a common
     source of data.
+
+    Values are stored on the instance, in the attribute named by
+    slot_prefix + the descriptor's own name. Classes with __slots__
+    should declare these with lazy_slots(); other classes store them in
+    their __dict__.
     """
+    slot_prefix = '_lazy_'
+
     def __init__(self, method_name):
         """
         method_name is the name of the method that will be invoked if
@@ -93,23 +258,58 @@ class LazyFrom(object):
         attribute (through this descriptor).
         """
         self.method_name = method_name
-        self.values = weakref.WeakKeyDictionary()
+        self.name = None
+        self.slot_name = None
+
+    def __set_name__(self, cls, name):
+        self.name = name
+        self.slot_name = self.slot_prefix + name
+
+    def _slot(self, obj):
+        if self.slot_name is None:
+            # __set_name__ is only called on Python 3.6+.
+            for cls in type(obj).__mro__:
+                for name, value in vars(cls).items():
+                    if value is self:
+                        self.__set_name__(cls, name)
+                        return self.slot_name
+            raise AttributeError("LazyFrom is not bound to %r" % (obj,))
+        return self.slot_name
 
     def __get__(self, obj, cls):
         if obj is None:
             return self
 
-        if obj not in self.values:
+        slot = self.slot_name or self._slot(obj)
+        value = getattr(obj, slot, NOT_LOADED)
+        if value is NOT_LOADED:
             method = getattr(obj, self.method_name)
             method()
+            value = getattr(obj, slot, NOT_LOADED)
 
-        assert obj in self.values, "method failed to populate attribute"
+        assert value is not NOT_LOADED, "method failed to populate attribute"
 
-        return self.values[obj]
+        return value
 
     def __set__(self, obj, value):
-        self.values[obj] = value
+        setattr(obj, self.slot_name or self._slot(obj), value)
 
     def __delete__(self, obj):
-        if obj in self.values:
-            del self.values[obj]
+        setattr(obj, self._slot(obj), NOT_LOADED)
+
+    def is_loaded(self, obj):
+        """
+        Returns whether obj has a value for this attribute, without
+        loading it.
+        """
+        return getattr(obj, self._slot(obj), NOT_LOADED) is not NOT_LOADED
+
+    def peek(self, obj, default=None):
+        """
+        Returns obj's value for this attribute if it has been loaded,
+        or default otherwise.
+        """
+        value = getattr(obj, self._slot(obj), NOT_LOADED)
+        if value is NOT_LOADED:
+            return default
+        return value
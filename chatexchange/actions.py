@@ -0,0 +1,172 @@
+"""
+Chat actions (sends, edits and deletes) and the queues they wait in
+before a Client's RequestLanes send them.
+"""
+import sys
+if sys.version_info[0] == 2:
+    import Queue as queue
+else:
+    import queue
+import collections
+import concurrent.futures
+import time
+
+
+# Priorities for queued chat actions; lower values are served first.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class PeekableQueue(queue.Queue):
+    """
+    A simple extension of the standard Queue object which allows inspection of the tail
+    and manipulating the returned value.
+    """
+    def peek_latest(self):
+        """
+        Return the last object which was added to the queue without modifying the queue
+        """
+        if self.qsize() > 0:
+            # Implementation detail: queue grows rightward, last element is [-1]
+            return self.queue[-1]
+
+    def poke_latest(self, oldvalue, newvalue):
+        """
+        Replace the lastest value if it is identical to the passed-in oldvalue.
+        Otherwise, return False to signify failure.
+        """
+        with self.mutex:
+            # the worker may have taken it off the queue since it was peeked
+            if self.queue and self.queue[-1] is oldvalue:
+                self.queue[-1] = newvalue
+                return True
+        return False
+
+
+class PriorityPeekableQueue(PeekableQueue):
+    """
+    A PeekableQueue of ChatActions that serves higher priorities first,
+    and actions of the same priority in the order they were queued.
+
+    So that a steady stream of urgent actions can't starve the rest, an
+    action that has waited more than max_wait seconds is served before
+    any newer actions, whatever their priority. Anything that isn't a
+    ChatAction (like SystemExit) is served after all the actions.
+    """
+    priorities = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+
+    max_wait = 60.0
+
+    def _init(self, maxsize):
+        self.queues = dict(
+            (priority, collections.deque()) for priority in self.priorities)
+        self.others = collections.deque()
+
+    def _qsize(self):
+        return len(self.others) + sum(len(q) for q in self.queues.values())
+
+    def _put(self, item):
+        if isinstance(item, ChatAction):
+            item.queued_at = time.time()
+            self.queues[item.priority].append(item)
+        else:
+            self.others.append(item)
+
+    def _get(self):
+        overdue = time.time() - self.max_wait
+        chosen = None
+        for priority in self.priorities:
+            q = self.queues[priority]
+            if not q:
+                continue
+            if chosen is None:
+                chosen = q
+            elif q[0].queued_at < overdue and q[0].queued_at < chosen[0].queued_at:
+                chosen = q
+
+        if chosen is None:
+            return self.others.popleft()
+        return chosen.popleft()
+
+    def peek_latest(self, priority=PRIORITY_NORMAL):
+        """
+        Return the last action of the given priority which was added to the
+        queue without modifying the queue
+        """
+        with self.mutex:
+            q = self.queues[priority]
+            if q:
+                return q[-1]
+
+    def poke_latest(self, oldvalue, newvalue):
+        """
+        Replace the latest action of oldvalue's priority if it is identical
+        to oldvalue. Otherwise, return False to signify failure.
+        """
+        assert oldvalue.priority == newvalue.priority
+        with self.mutex:
+            q = self.queues[oldvalue.priority]
+            if q and q[-1] is oldvalue:
+                newvalue.queued_at = oldvalue.queued_at
+                q[-1] = newvalue
+                return True
+        return False
+
+    def reprioritize(self, action, priority):
+        """
+        Moves a queued action to another priority, keeping its place in
+        line for max_wait. Returns False if it is no longer queued.
+        """
+        with self.mutex:
+            q = self.queues[action.priority]
+            try:
+                q.remove(action)
+            except ValueError:
+                return False
+            action.priority = priority
+            self.queues[priority].append(action)
+            return True
+
+
+class ChatActionError(Exception):
+    pass
+
+
+class ChatAction(object):
+    """
+    A send, edit or delete waiting to be done by a RequestLane.
+
+    target_id is the room id for sends, and the message id otherwise.
+    Each of the futures resolves to the new message's id for a send, or
+    to the final response for an edit or delete, and fails with
+    ChatActionError if the action is given up on. An action has several
+    futures when queued sends have been merged into it.
+
+    priority is one of PRIORITY_HIGH, PRIORITY_NORMAL and PRIORITY_LOW.
+    """
+    def __init__(
+            self, action_type, target_id, text, futures=None,
+            priority=PRIORITY_NORMAL
+    ):
+        assert action_type in ('send', 'edit', 'delete')
+        assert priority in PriorityPeekableQueue.priorities
+        self.action_type = action_type
+        self.target_id = target_id
+        self.text = text
+        self.priority = priority
+        if futures is None:
+            futures = [concurrent.futures.Future()]
+        self.futures = futures
+
+    @property
+    def future(self):
+        """
+        The future of the most recently queued part of this action.
+        """
+        return self.futures[-1]
+
+    def __repr__(self):
+        return '{0!s}({1!r}, {2!r}, {3!r}, priority={4!r})'.format(
+            type(self).__name__, self.action_type, self.target_id, self.text,
+            self.priority)
@@ -0,0 +1,625 @@
+"""
+An asyncio interface for Stack Exchange chat.
+
+Everything here runs on one event loop: HTTP requests and the WebSocket
+go through aiohttp, and a single socket task serves every watched room,
+so a process can follow hundreds of rooms without a thread per room.
+
+The domain objects (Message, Room, User and the events) are the same as
+in the synchronous API, and are looked up through the same deduplicated
+registry. Their lazy attributes still load synchronously if touched
+before being scraped, so use the scrape_* coroutines first to fill them
+in without blocking the loop.
+
+Requires aiohttp (`pip install chatexchange[aio]`).
+"""
+import asyncio
+import inspect
+import json
+import logging
+import time
+
+import aiohttp
+
+from . import _utils, browser, client, messages, rooms, users
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncResponse(object):
+    """
+    A fully-read HTTP response, with the parts of the requests.Response
+    interface that the rest of ChatExchange uses.
+    """
+    def __init__(self, status_code, url, content, encoding=None, json_loads=json.loads):
+        self.status_code = status_code
+        self.url = url
+        self.content = content
+        self.encoding = encoding or 'utf-8'
+        self._json_loads = json_loads
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, 'replace')
+
+    def json(self):
+        return self._json_loads(self.content)
+
+
+class AsyncBrowser(object):
+    """
+    An asyncio counterpart of L{browser.Browser}.
+
+    Page parsing is shared with Browser, so the scrape helpers return
+    exactly the same data.
+    """
+    user_agent = browser.Browser.user_agent
+
+    request_timeout = browser.Browser.request_timeout
+
+    json_library = browser.Browser.json_library
+    html_parser = browser.Browser.html_parser
+    make_soup = browser.Browser.make_soup
+    decode_frame = browser.Browser.decode_frame
+
+    socket_ping_interval = browser.Browser.socket_ping_interval
+    socket_idle_timeout = browser.Browser.socket_idle_timeout
+
+    def __init__(self, host=None):
+        self.logger = logger.getChild('AsyncBrowser')
+        self.host = host
+        self.rooms = {}
+        self.chat_fkey = None
+        self.user_id = None
+        self.user_name = None
+        self.socket = None
+        # room_id -> on_activity for every room watched over the socket,
+        # kept here so that recovery can re-watch them all even after
+        # the first one has been moved to a new socket
+        self.socket_callbacks = {}
+        # room_id -> time.time() of the last frame received for the room
+        self.last_frame_times = {}
+        self.json_loads = _utils.json_loads_for(self.json_library)
+        self.soup_parser = _utils.html_parser_for(self.html_parser)
+        self.on_websocket_closed = self._default_ws_recovery
+        self._session = None
+
+    @property
+    def chat_root(self):
+        assert self.host, "browser has no associated host"
+        return 'https://chat.%s' % (self.host,)
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                headers={'User-Agent': self.user_agent},
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout))
+        return self._session
+
+    async def close(self):
+        if self.socket is not None:
+            await self.socket.close()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    # request helpers
+
+    async def _request(
+        self, method, url,
+        data=None, headers=None, with_chat_root=True
+    ):
+        if with_chat_root:
+            url = self.chat_root + '/' + url
+
+        async with self.session.request(
+                method, url, data=data, headers=headers) as raw_response:
+            response = AsyncResponse(
+                raw_response.status, str(raw_response.url),
+                await raw_response.read(), raw_response.charset,
+                self.json_loads)
+
+        if response.status_code >= 400:
+            raise HTTPError(
+                "%s for url %s" % (response.status_code, url), response)
+
+        return response
+
+    async def get(self, url, data=None, headers=None, with_chat_root=True):
+        return await self._request('GET', url, data, headers, with_chat_root)
+
+    async def post(self, url, data=None, headers=None, with_chat_root=True):
+        return await self._request('POST', url, data, headers, with_chat_root)
+
+    async def get_soup(self, url, data=None, headers=None, with_chat_root=True):
+        response = await self.get(url, data, headers, with_chat_root)
+        return self.make_soup(response.text)
+
+    async def post_fkeyed(self, url, data=None, headers=None):
+        if data is None:
+            data = {}
+        elif not isinstance(data, dict):
+            raise TypeError("data must be a dict")
+        else:
+            data = dict(data)
+
+        data['fkey'] = await self.get_chat_fkey()
+
+        return await self.post(url, data, headers)
+
+    # authentication
+
+    async def login_site(self, host, email, password):
+        """
+        Logs the browser into a Stack Exchange site.
+        """
+        assert self.host is None or self.host == host
+
+        if host == 'stackexchange.com':
+            login_host = 'meta.stackexchange.com'
+        else:
+            login_host = host
+
+        fkey_soup = await self.get_soup(
+            'https://%s/users/login?returnurl = %%2f' % (login_host,),
+            with_chat_root=False)
+        fkey_input = fkey_soup.find('input', {'name': 'fkey'})
+        if fkey_input is None:
+            raise browser.LoginError("fkey input not found")
+
+        response = await self.post(
+            'https://%s/users/login' % (login_host,),
+            {'email': email, 'password': password, 'fkey': fkey_input['value']},
+            with_chat_root=False)
+        await self._handle_se_openid_prompt_if_neccessary(response)
+
+        if not any(cookie.key == 'acct' for cookie in self.session.cookie_jar):
+            raise browser.LoginError(
+                "failed to get `acct` cookie from Stack Exchange OpenID, "
+                "check credentials provided for accuracy")
+
+        self.host = host
+
+    async def login_site_with_cookie(self, host, cookie_jar):
+        self.session.cookie_jar.update_cookies(dict(cookie_jar.items()))
+
+        if host == 'stackexchange.com':
+            host = 'meta.stackexchange.com'
+
+        verify_soup = await self.get_soup(
+            'https://%s/users/login' % (host,), with_chat_root=False)
+        if not verify_soup.select('.my-profile'):
+            raise browser.LoginError(
+                "login with cookie could not be verified, "
+                "try credential login instead")
+
+    async def _handle_se_openid_prompt_if_neccessary(self, prompt_response):
+        prompt_prefix = 'https://openid.stackexchange.com/account/prompt'
+
+        if not prompt_response.url.startswith(prompt_prefix):
+            return prompt_response
+
+        prompt_soup = self.make_soup(prompt_response.text)
+
+        data = {
+            'session': prompt_soup.find('input', {'name': 'session'})['value'],
+            'fkey': prompt_soup.find('input', {'name': 'fkey'})['value']
+        }
+
+        url = 'https://openid.stackexchange.com/account/prompt/submit'
+
+        return await self.post(url, data, with_chat_root=False)
+
+    async def get_chat_fkey(self):
+        if self.chat_fkey is None:
+            await self._update_chat_fkey_and_user()
+        return self.chat_fkey
+
+    async def _update_chat_fkey_and_user(self):
+        """
+        Updates the fkey used by this browser, and associated user name/id.
+        """
+        favorite_soup = await self.get_soup('chats/join/favorite')
+
+        chat_fkey = favorite_soup.find('input', {'name': 'fkey'})['value']
+        if not chat_fkey:
+            raise browser.BrowserError('fkey missing')
+
+        user_link_soup = favorite_soup.select('.topbar-menu-links a')[0]
+        self.user_id, self.user_name = (
+            browser.Browser.user_id_and_name_from_link(user_link_soup))
+        self.chat_fkey = chat_fkey
+
+    # remote requests
+
+    async def join_room(self, room_id):
+        room_id = str(room_id)
+        self.rooms[room_id] = {}
+        response = await self.post_fkeyed(
+            'chats/%s/events' % (room_id,),
+            {
+                'since': 0,
+                'mode': 'Messages',
+                'msgCount': 100
+            })
+        self.rooms[room_id]['eventtime'] = response.json()['time']
+
+    async def leave_room(self, room_id):
+        room_id = str(room_id)
+        self.rooms.pop(room_id, None)
+        self.socket_callbacks.pop(room_id, None)
+        if self.socket is not None:
+            await self.socket.remove_room(room_id)
+        await self.post_fkeyed('/chats/leave/%s' % (room_id,))
+
+    async def watch_room_socket(self, room_id, on_activity):
+        """
+        Watches for raw activity in a room over this browser's WebSocket,
+        connecting it first if no other room is being watched.
+
+        on_activity may be a plain function or a coroutine function.
+        """
+        room_id = str(room_id)
+        self.socket_callbacks[room_id] = on_activity
+        if self.socket is None or self.socket.killed:
+            self.socket = AsyncSocketWatcher(self)
+            self.socket.add_room(room_id, on_activity)
+            await self.socket.start(room_id)
+        else:
+            self.socket.add_room(room_id, on_activity)
+        return self.socket
+
+    async def _default_ws_recovery(self, room_id):
+        on_activity = self.socket_callbacks.get(room_id)
+        self.rooms.pop(room_id, None)
+        await self.join_room(room_id)
+        if on_activity is not None:
+            await self.watch_room_socket(room_id, on_activity)
+
+    async def send_message(self, room_id, text):
+        return await self.post_fkeyed(
+            'chats/%s/messages/new' % (room_id,),
+            {'text': text})
+
+    async def edit_message(self, message_id, text):
+        return await self.post_fkeyed(
+            'messages/%s' % (message_id,),
+            {'text': text})
+
+    async def delete_message(self, message_id):
+        return await self.post_fkeyed('messages/%s/delete' % (message_id, ))
+
+    async def get_history(self, message_id):
+        """
+        Returns the data from the history page for message_id.
+        """
+        history_soup = await self.get_soup(
+            'messages/%s/history' % (message_id,))
+        return browser.Browser._parse_history(history_soup, message_id)
+
+    async def get_transcript_with_message(self, message_id):
+        """
+        Returns the data from the transcript page associated with message_id.
+        """
+        transcript_soup = await self.get_soup(
+            'transcript/message/%s' % (message_id,))
+        return browser.Browser._parse_transcript(transcript_soup, message_id)
+
+    async def get_profile(self, user_id):
+        """
+        Returns the data from the profile page for user_id.
+        """
+        profile_soup = await self.get_soup('users/%s' % (user_id,))
+        return browser.Browser._parse_profile(profile_soup)
+
+    async def get_room_info(self, room_id):
+        """
+        Returns the data from the room info page for room_id.
+        """
+        info_soup = await self.get_soup('rooms/info/%s' % (room_id,))
+        return browser.Browser._parse_room_info(info_soup)
+
+
+class AsyncSocketWatcher(object):
+    """
+    Reads one WebSocket for every room watched by an AsyncBrowser, and
+    passes each room its own 'r<room_id>' section of every frame.
+    """
+    def __init__(self, browser):
+        self.logger = logger.getChild('AsyncSocketWatcher')
+        self.browser = browser
+        self.rooms = {}
+        self.ws = None
+        self.task = None
+        self.killed = False
+
+    def add_room(self, room_id, on_activity):
+        self.rooms[str(room_id)] = on_activity
+
+    async def remove_room(self, room_id):
+        self.rooms.pop(str(room_id), None)
+        if not self.rooms:
+            await self.close()
+
+    async def start(self, room_id):
+        last_event_time = self.browser.rooms[room_id]['eventtime']
+
+        ws_auth_data = (await self.browser.post_fkeyed(
+            'ws-auth',
+            {'roomid': room_id}
+        )).json()
+        wsurl = ws_auth_data['url'] + '?l=%s' % (last_event_time,)
+        self.logger.debug('wsurl == %r', wsurl)
+
+        # aiohttp pings every heartbeat seconds, and closes the
+        # connection if no pong comes back within half that.
+        self.ws = await self.browser.session.ws_connect(
+            wsurl, origin=self.browser.chat_root,
+            heartbeat=self.browser.socket_ping_interval)
+        self.task = asyncio.ensure_future(self._runner())
+
+    async def close(self):
+        self.killed = True
+        if self.ws is not None:
+            await self.ws.close()
+
+    async def _runner(self):
+        while not self.killed:
+            try:
+                frame = await self.ws.receive(
+                    timeout=self.browser.socket_idle_timeout)
+            except asyncio.TimeoutError:
+                self.logger.warning(
+                    "No frames for %.0f seconds; reconnecting.",
+                    self.browser.socket_idle_timeout)
+                await self.ws.close()
+                break
+
+            if frame.type == aiohttp.WSMsgType.TEXT:
+                now = time.time()
+                for room_id in list(self.rooms):
+                    self.browser.last_frame_times[room_id] = now
+                activity = self.browser.decode_frame(frame.data)
+                if activity is not None:
+                    await self._dispatch(activity)
+            elif frame.type in (
+                    aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING,
+                    aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                break
+
+        if self.killed:
+            return
+
+        self.killed = True
+        on_websocket_closed = self.browser.on_websocket_closed
+        if on_websocket_closed is None:
+            raise browser.BrowserError("WebSocket closed unexpectedly")
+        for room_id in list(self.rooms):
+            await _maybe_await(on_websocket_closed(room_id))
+
+    async def _dispatch(self, activity):
+        for key, room_activity in activity.items():
+            if not key.startswith('r'):
+                continue
+            on_activity = self.rooms.get(key[1:])
+            if on_activity is not None:
+                await _maybe_await(on_activity({key: room_activity}))
+
+
+class AsyncClient(object):
+    """
+    An asyncio counterpart of L{client.Client}.
+
+    Sends are not queued through a worker thread: each send, edit and
+    delete coroutine completes once Stack Exchange has accepted it,
+    waiting out any throttling with asyncio.sleep. Actions for the same
+    room are serialized so throttling waits apply in order, and the
+    backoff after an action delays the room's next one, not its result.
+    """
+    valid_hosts = client.Client.valid_hosts
+
+    def __init__(self, host='stackexchange.com'):
+        self.logger = logger.getChild('AsyncClient')
+
+        if host not in self.valid_hosts:
+            raise ValueError("invalid host: %r" % (host,))
+
+        self.host = host
+        self.logged_in = False
+        self.on_message_sent = None
+
+        # The synchronous client holds the deduplicated domain objects
+        # and the throttling rules; it never logs in or sends anything.
+        self._client = client.Client(host)
+        self._br = AsyncBrowser(host)
+        self._previous = None
+        self._action_locks = {}
+        # when the backoff after each room's last action ends
+        self._ready_at = {}
+
+    def get_message(self, message_id, **attrs_to_set):
+        return self._client.get_message(message_id, **attrs_to_set)
+
+    def get_room(self, room_id, **attrs_to_set):
+        return self._client.get_room(room_id, **attrs_to_set)
+
+    def get_user(self, user_id, **attrs_to_set):
+        return self._client.get_user(user_id, **attrs_to_set)
+
+    async def get_me(self):
+        await self._br.get_chat_fkey()
+        return self.get_user(self._br.user_id, name=self._br.user_name)
+
+    async def login(self, email, password):
+        assert not self.logged_in
+        self.logger.info("Logging in.")
+        await self._br.login_site(self.host, email, password)
+        self.logged_in = True
+        self.logger.info("Logged in.")
+
+    async def login_with_cookie(self, cookie_jar):
+        assert not self.logged_in
+        self.logger.info("Logging in with acct cookie.")
+        await self._br.login_site_with_cookie(self.host, cookie_jar)
+        self.logged_in = True
+        self.logger.info("Logged in (cookie).")
+
+    async def logout(self):
+        """
+        Closes the WebSocket and HTTP session. Sends already in progress
+        should be awaited first.
+        """
+        await self._br.close()
+        self.logged_in = False
+        self.logger.info("Logged out.")
+
+    def set_websocket_recovery(self, on_ws_closed):
+        self._br.on_websocket_closed = on_ws_closed
+
+    async def join_room(self, room_id):
+        await self._br.join_room(room_id)
+
+    async def leave_room(self, room_id):
+        await self._br.leave_room(room_id)
+
+    async def watch_socket(self, room_id, event_callback, event_filter=None):
+        """
+        Calls event_callback(event, client) for every event in room_id
+        that matches event_filter, if one is given.
+        event_callback may be a plain function or a coroutine function;
+        coroutines are awaited before the next event is handled.
+        """
+        room = self.get_room(room_id)
+
+        async def on_activity(activity):
+            for event in room._events_from_activity(activity, room.id, event_filter):
+                await _maybe_await(event_callback(event, self))
+
+        return await self._br.watch_room_socket(room.id, on_activity)
+
+    # scraping
+
+    async def scrape_history(self, message):
+        """
+        Loads the history page attributes of a Message (or message id).
+        """
+        if not isinstance(message, messages.Message):
+            message = self.get_message(message)
+        message._apply_history(await self._br.get_history(message.id))
+        return message
+
+    async def scrape_transcript(self, message):
+        """
+        Loads the transcript attributes of a Message (or message id), and
+        those of every other message on the same transcript page.
+        """
+        if not isinstance(message, messages.Message):
+            message = self.get_message(message)
+        message._apply_transcript(
+            await self._br.get_transcript_with_message(message.id))
+        return message
+
+    async def scrape_profile(self, user):
+        """
+        Loads the profile attributes of a User (or user id).
+        """
+        if not isinstance(user, users.User):
+            user = self.get_user(user)
+        user._apply_profile(await self._br.get_profile(user.id))
+        return user
+
+    async def scrape_info(self, room):
+        """
+        Loads the info page attributes of a Room (or room id).
+        """
+        if not isinstance(room, rooms.Room):
+            room = self.get_room(room)
+        room._apply_info(await self._br.get_room_info(room.id))
+        return room
+
+    # chat actions
+
+    async def send_message(self, room_id, text):
+        """
+        Sends a message, returning its id once it has been posted.
+        """
+        response = await self._do_action_despite_throttling(
+            ('send', room_id, text), room_id)
+        message_id = response.json()['id']
+        if self.on_message_sent is not None:
+            self.on_message_sent(message_id, room_id)
+        return message_id
+
+    async def edit_message(self, message_id, text):
+        return await self._do_action_despite_throttling(
+            ('edit', message_id, text), None)
+
+    async def delete_message(self, message_id):
+        return await self._do_action_despite_throttling(
+            ('delete', message_id, ''), None)
+
+    async def _do_action_despite_throttling(self, action, room_id):
+        lock = self._action_locks.get(room_id)
+        if lock is None:
+            lock = self._action_locks[room_id] = asyncio.Lock()
+
+        action_type, target_id, text = action
+
+        async with lock:
+            # wait out the backoff left by this room's previous action
+            delay = self._ready_at.get(room_id, 0) - _utils._now()
+            if delay > 0:
+                self.logger.debug("Waiting %.1f seconds before next action", delay)
+                await asyncio.sleep(delay)
+
+            if text == self._previous:
+                text = " " + text
+
+            sent = False
+            attempt = 0
+            response = None
+            while not sent:
+                attempt += 1
+                self.logger.debug("Attempt %d: start.", attempt)
+
+                try:
+                    if action_type == 'send':
+                        response = await self._br.send_message(target_id, text)
+                    elif action_type == 'edit':
+                        response = await self._br.edit_message(target_id, text)
+                    else:
+                        assert action_type == 'delete'
+                        response = await self._br.delete_message(target_id)
+                except HTTPError as ex:
+                    if ex.response.status_code == 409:
+                        # this could be a throttling message we know how to handle
+                        response = ex.response
+                    else:
+                        raise
+
+                unpacked = client.Client._unpack_response(response)
+                sent, wait, text = self._client._assess_action_response(
+                    unpacked, action_type, text, attempt)
+                if sent:
+                    self._previous = text
+                    # the result is ready now; the wait only holds up
+                    # the room's next action
+                    self._ready_at[room_id] = _utils._now() + wait
+                else:
+                    await asyncio.sleep(wait)
+
+        return response
+
+
+async def _maybe_await(result):
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+
+class HTTPError(browser.BrowserError):
+    def __init__(self, message, response):
+        super(HTTPError, self).__init__(message)
+        self.response = response
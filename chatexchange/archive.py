@@ -0,0 +1,259 @@
+"""
+Streams a room's whole history from its day-by-day transcript pages.
+
+    archiver = TranscriptArchiver(client, 1, datetime.date(2020, 1, 1),
+                                  checkpoint_path='sandbox.checkpoint')
+    for message_data in archiver:
+        ...
+
+or, from the command line:
+
+    chatexchange-archive stackexchange.com 1 --start 2020-01-01 \\
+        --checkpoint sandbox.checkpoint --output sandbox.jsonl
+"""
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import sys
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+class TranscriptArchiver(object):
+    """
+    Iterates over the data of every message posted in a room from start
+    to end (inclusive datetime.dates; end defaults to today, UTC), in
+    the same form as L{browser.Browser.get_transcript_with_message}'s
+    'messages'.
+
+    Days are fetched by a pool of `workers` threads, at most
+    2 * workers days ahead of the one being yielded, so memory use
+    doesn't grow with the length of the history.
+
+    If checkpoint_path is given, the last day whose messages have all
+    been handled is recorded there, along with the last message handled
+    (a message counts as handled once the next one is asked for). A
+    later archiver with the same checkpoint_path carries on from the day
+    after, skipping that day's messages up to and including that one.
+    If after_message_id is given, it's used as the last message handled
+    instead.
+    """
+    def __init__(
+            self, client, room_id, start, end=None, workers=4,
+            checkpoint_path=None, after_message_id=None
+    ):
+        assert workers >= 1, "workers must be at least 1"
+        if end is None:
+            end = datetime.date(*time.gmtime()[:3])
+
+        self.logger = logger.getChild('TranscriptArchiver')
+        self._client = client
+        self.room_id = int(room_id)
+        self.start = start
+        self.end = end
+        self.workers = workers
+        self.checkpoint_path = checkpoint_path
+        self.after_message_id = after_message_id
+
+    def load_checkpoint(self):
+        """
+        Returns the last complete day and the last message id recorded
+        in the checkpoint, or (None, None).
+        """
+        if self.checkpoint_path is None or not os.path.exists(self.checkpoint_path):
+            return None, None
+
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+
+        if checkpoint['room_id'] != self.room_id or (
+                checkpoint['host'] != self._client.host):
+            raise ValueError(
+                "checkpoint %s is for room %s on %s, not room %s on %s" % (
+                    self.checkpoint_path, checkpoint['room_id'],
+                    checkpoint['host'], self.room_id, self._client.host))
+
+        day = checkpoint['day']
+        if day is not None:
+            day = _parse_day(day)
+        return day, checkpoint.get('message_id')
+
+    def save_checkpoint(self, day, message_id):
+        if self.checkpoint_path is None:
+            return
+
+        # write then rename, so an interruption can't leave it half-written
+        temporary_path = self.checkpoint_path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump({
+                'host': self._client.host,
+                'room_id': self.room_id,
+                'day': day.isoformat() if day is not None else None,
+                'message_id': message_id,
+            }, f)
+        _replace(temporary_path, self.checkpoint_path)
+
+    def pending_days(self, last_done=None):
+        """
+        Yields the days still to be archived, after the last_done day.
+        """
+        day = self.start
+        if last_done is not None and last_done >= day:
+            day = last_done + datetime.timedelta(days=1)
+
+        while day <= self.end:
+            yield day
+            day += datetime.timedelta(days=1)
+
+    def fetch_day(self, day):
+        """
+        Returns the data of every message posted in the room on day.
+        """
+        browser = self._client._br
+        data = browser.get_transcript_day(self.room_id, day)
+        messages_data = data['messages']
+        for hours in data['hours']:
+            messages_data.extend(
+                browser.get_transcript_day(self.room_id, day, hours)['messages'])
+
+        self.logger.info(
+            "Fetched %d messages from room %s on %s",
+            len(messages_data), self.room_id, day)
+        return messages_data
+
+    def __iter__(self):
+        last_day, last_message_id = self.load_checkpoint()
+        if self.after_message_id is not None:
+            last_message_id = self.after_message_id
+        # the first day may have been partly handled already
+        skip_through = last_message_id
+
+        days = self.pending_days(last_day)
+        fetches = collections.deque()
+        executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+
+        def fetch_next_day():
+            for day in days:
+                fetches.append((day, executor.submit(self.fetch_day, day)))
+                return
+
+        try:
+            for _ in range(2 * self.workers):
+                fetch_next_day()
+
+            while fetches:
+                day, fetch = fetches.popleft()
+                fetch_next_day()
+
+                messages_data = fetch.result()
+                if skip_through is not None:
+                    handled_ids = [message_data['id'] for message_data in messages_data]
+                    if skip_through in handled_ids:
+                        messages_data = messages_data[handled_ids.index(skip_through) + 1:]
+                    skip_through = None
+
+                for message_data in messages_data:
+                    yield message_data
+                    # asking for the next one means this one was handled
+                    last_message_id = message_data['id']
+
+                last_day = day
+                self.save_checkpoint(last_day, last_message_id)
+        finally:
+            for _, fetch in fetches:
+                fetch.cancel()
+            executor.shutdown(wait=True)
+            # record progress through a day that was only partly handled
+            self.save_checkpoint(last_day, last_message_id)
+
+
+def main(argv=None):
+    from . import client
+
+    parser = argparse.ArgumentParser(
+        description="Writes a chat room's transcript as JSON lines.")
+    parser.add_argument('host', help="e.g. stackexchange.com")
+    parser.add_argument('room_id', type=int)
+    parser.add_argument(
+        '--start', required=True, type=_parse_day, help="first day, YYYY-MM-DD")
+    parser.add_argument(
+        '--end', type=_parse_day, help="last day, YYYY-MM-DD; defaults to today (UTC)")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument(
+        '--checkpoint', help="file to record progress in, and resume from")
+    parser.add_argument(
+        '--output', help="file to append messages to; defaults to stdout")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    after_message_id = None
+    if args.output is None:
+        output = sys.stdout
+    else:
+        # if we were killed before the checkpoint caught up, don't
+        # write messages that are already in the output again
+        after_message_id = _last_written_id(args.output)
+        output = open(args.output, 'a')
+        if output.tell() and _ends_mid_line(args.output):
+            output.write('\n')
+
+    archiver = TranscriptArchiver(
+        client.Client(args.host), args.room_id, args.start, args.end,
+        workers=args.workers, checkpoint_path=args.checkpoint,
+        after_message_id=after_message_id)
+
+    try:
+        for message_data in archiver:
+            output.write(json.dumps(message_data) + '\n')
+            # flush before the checkpoint can move past this message
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+def _parse_day(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def _ends_mid_line(path):
+    with open(path, 'rb') as f:
+        f.seek(-1, 2)
+        return f.read(1) != b'\n'
+
+
+def _last_written_id(path):
+    """
+    Returns the id of the last complete message in a JSON lines file,
+    or None.
+    """
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as f:
+        f.seek(0, 2)
+        # a transcript message is well under this size
+        f.seek(max(0, f.tell() - 65536))
+        lines = f.read().split(b'\n')
+
+    # the last line is either empty or was cut off mid-write
+    for line in reversed(lines[:-1]):
+        try:
+            return json.loads(line.decode('utf-8'))['id']
+        except (ValueError, KeyError, TypeError):
+            continue
+    return None
+
+
+if __name__ == '__main__':
+    main()
@@ -11,7 +11,7 @@ import time
 from bs4 import BeautifulSoup
 import requests
 import websocket
-from . import _utils
+from . import _utils, httpcache, throttling
 import socket
 import re
 
@@ -32,26 +32,204 @@ class Browser(object):
 
     request_timeout = 30.0
 
+    # (requests per second, burst size) allowed for each class of
+    # endpoint, or None for no limit; see _endpoint_class.
+    rate_limits = {
+        'read': None,
+        'write': (2.0, 4),
+        'auth': (0.5, 2),
+        # WebSocket authorization, once per room joined or recovered
+        'socket': (10.0, 20),
+    }
+
+    _auth_url_re = re.compile(r'(^|/)(users/login|account/prompt)')
+    _socket_url_re = re.compile(r'^/?ws-auth$')
+    _read_post_url_re = re.compile(r'^/?(events|chats/\d+/events)$')
+
+    # If True, every room watched through watch_room_socket shares a
+    # single WebSocket connection instead of opening one per room.
+    share_socket = False
+
+    # If True, every room watched through watch_room_http is polled by a
+    # single thread, with one request covering all rooms that are due.
+    batch_polling = False
+
+    # The JSON library used to decode socket frames and responses:
+    # 'orjson', 'ujson', 'json', or None for the fastest one installed.
+    json_library = None
+
+    # The BeautifulSoup tree builder used for scraped pages, such as
+    # 'lxml' or 'html.parser', or None for the fastest one installed.
+    html_parser = None
+
+    # WebSocket keepalive: send a ping every socket_ping_interval seconds,
+    # stop waiting on reads after socket_recv_timeout seconds to check on
+    # the connection, and treat it as dead if nothing at all (pongs and
+    # SE's empty heartbeat frames included) arrives for
+    # socket_idle_timeout seconds. None disables each of these.
+    socket_ping_interval = 30.0
+    socket_recv_timeout = 5.0
+    socket_idle_timeout = 90.0
+
+    # How many recent event ids to remember for each room watched by
+    # WebSocket, to drop events seen again after a reconnection.
+    max_seen_event_ids = 1000
+
+    # GET responses are cached by an httpcache.CachingAdapter holding up
+    # to http_cache_size of them in memory (None disables the cache), and
+    # also in the directory http_cache_dir if set. Responses for paths
+    # matching the patterns in http_cache_ttls are reused for that many
+    # seconds, whatever their headers say.
+    http_cache_size = 1000
+    http_cache_dir = None
+    http_cache_ttls = (
+        (r'^/+rooms/\d+/?$', 5),  # current users
+        (r'^/rooms/pingable/\d+$', 10),
+        (r'^/rooms/info/\d+$', 60),
+        (r'^/users/\d+$', 60),
+    )
+
+    # If set to a dispatch.ActivityDispatcher, watchers hand activity to
+    # it instead of calling on_activity on their own threads.
+    dispatcher = None
+
     def __init__(self):
         self.logger = logger.getChild('Browser')
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': self.user_agent
         })
+        self.http_cache = None
+        if self.http_cache_size:
+            self.http_cache = httpcache.CachingAdapter(
+                self.http_cache_size, self.http_cache_dir, self.http_cache_ttls)
+            self.session.mount('https://', self.http_cache)
+            self.session.mount('http://', self.http_cache)
         self.rooms = {}
         self.sockets = {}
         self.polls = {}
+        self.shared_socket = None
+        self.shared_poll = None
+        # room_id -> LRUCache of recent event ids, kept across reconnections
+        self.seen_event_ids = {}
+        # room_id -> time.time() of the last frame received for the room
+        self.last_frame_times = {}
         self.host = None
         self.on_websocket_closed = self._default_ws_recovery
+        self.rate_limiter = throttling.RateLimiter(self.rate_limits)
+        self.retry_policy = throttling.RetryPolicy()
+        self.json_loads = _utils.json_loads_for(self.json_library)
+        self.soup_parser = _utils.html_parser_for(self.html_parser)
+
+    def decode_response(self, response):
+        """
+        Decodes the JSON body of a response.
+        """
+        return self.json_loads(response.content)
+
+    def decode_frame(self, frame):
+        """
+        Decodes a WebSocket frame, returning None for empty and heartbeat
+        frames without parsing them.
+        """
+        if not frame or frame == '{}':
+            return None
+        # Heartbeats only list the rooms being watched, like {"r1":{}}:
+        # every key in them has an empty object for its value.
+        if frame.endswith('{}}') and frame.count('":') == frame.count('":{}'):
+            return None
+        return self.json_loads(frame)
+
+    def _dispatch_activity(self, room_id, on_activity, activity):
+        if self.dispatcher is None:
+            on_activity(activity)
+        else:
+            self.dispatcher.submit(room_id, on_activity, activity)
+
+    def _track_socket_activity(self, room_id, activity):
+        """
+        Records the latest event time from room_id's section of activity
+        received over a WebSocket, and removes any events in it that have
+        already been seen.
+        """
+        key = 'r' + room_id
+        room_activity = activity.get(key)
+        if not room_activity:
+            return activity
+
+        room = self.rooms.get(room_id)
+        if room is not None and 't' in room_activity:
+            room['eventtime'] = room_activity['t']
+
+        events_data = room_activity.get('e')
+        if not events_data:
+            return activity
+
+        seen = self.seen_event_ids.get(room_id)
+        if seen is None:
+            seen = self.seen_event_ids[room_id] = _utils.LRUCache(
+                self.max_seen_event_ids)
+        fresh = []
+        for event_data in events_data:
+            event_id = event_data.get('id') if event_data else None
+            if event_id is not None:
+                if event_id in seen:
+                    continue
+                seen.put(event_id, True)
+            fresh.append(event_data)
+
+        if len(fresh) == len(events_data):
+            return activity
+        self.logger.debug(
+            "Dropped %d already seen events in room #%s",
+            len(events_data) - len(fresh), room_id)
+        activity = dict(activity)
+        activity[key] = dict(room_activity, e=fresh)
+        return activity
+
+    def _backfill_room(self, room_id, since, on_activity):
+        """
+        Passes on_activity any events in room_id since the event time
+        `since` that haven't been seen yet.
+        """
+        activity = self.decode_response(
+            self.post_fkeyed('events', {'r' + room_id: since}))
+        activity = self._track_socket_activity(room_id, activity)
+        self._dispatch_activity(room_id, on_activity, activity)
 
     def _default_ws_recovery(self, room_id):
         on_activity = self.sockets[room_id].on_activity
+        last_event_time = self.rooms.get(room_id, {}).get('eventtime')
         try:
             self.leave_room(room_id)
         except websocket.WebSocketConnectionClosedException:
             pass
         self.join_room(room_id)
-        self.watch_room_socket(room_id, on_activity)
+        if last_event_time is None:
+            self.watch_room_socket(room_id, on_activity)
+            return
+
+        if self.share_socket:
+            # The shared socket may already be back up for other rooms,
+            # so watch this one first, holding its live activity until
+            # the backfill has been passed on; events in both are only
+            # passed on once, as they're already seen.
+            held = _HeldActivity(on_activity)
+            socket_watcher = self.watch_room_socket(room_id, held)
+            self._try_backfill_room(room_id, last_event_time, on_activity)
+            held.release()
+            socket_watcher.on_activity = on_activity
+        else:
+            self._try_backfill_room(room_id, last_event_time, on_activity)
+            self.watch_room_socket(room_id, on_activity)
+
+    def _try_backfill_room(self, room_id, since, on_activity):
+        # catch up on what happened while we were disconnected
+        try:
+            self._backfill_room(room_id, since, on_activity)
+        except (requests.RequestException, ValueError):
+            self.logger.exception(
+                "Could not backfill events for room #%s", room_id)
 
     @property
     def chat_root(self):
@@ -64,6 +242,8 @@ class Browser(object):
         self, method, url,
         data=None, headers=None, with_chat_root=True
     ):
+        endpoint_class = self._endpoint_class(method, url)
+
         if with_chat_root:
             url = self.chat_root + '/' + url
 
@@ -71,57 +251,82 @@ class Browser(object):
         # using the actual .post method causes data to be form-encoded,
         # whereas using .request with method='POST' would create a query string
 
-        # Try again if we fail. We're blaming "the internet" for weirdness.
-        MAX_HTTP_RETRIES = 5                # EGAD! A MAGIC NUMBER!
+        # Try again if we fail. We're blaming "the internet" for weirdness,
+        # or Stack Exchange being briefly overloaded.
+        retry_policy = self.retry_policy
+        retry_policy.on_request()
         attempt = 0
-        response = None
 
-        while attempt <= MAX_HTTP_RETRIES:
-            attempt += 1
+        while True:
+            self.rate_limiter.acquire(endpoint_class)
+            error = None
             try:
                 response = method_method(
                     url, data=data, headers=headers, timeout=self.request_timeout)
-                break
+            # BadStatusLine throws ConnectionError. We catch both timeouts
+            # because of this bug in requests:
+            # https://github.com/kennethreitz/requests/issues/1236
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout, socket.timeout) as e:
+                error = e
+                response = None
+            else:
+                if not retry_policy.is_retryable(response):
+                    break
 
-            # We want to try again, so continue
-            # BadStatusLine throws this error
-            except requests.exceptions.ConnectionError as e:
-                print("Connection Error %s -> Trying again..." % e)
-                time.sleep(0.1)                  # short pause before retrying
-                if attempt == MAX_HTTP_RETRIES:  # Only show exception if last try
-                    raise
-                continue
+            delay = retry_policy.next_delay(attempt, response)
+            if delay is None:
+                self.logger.warning(
+                    "Giving up on %s %s after %d attempts: %s",
+                    method.upper(), url, attempt + 1,
+                    error or response.status_code)
+                if error is not None:
+                    raise error
+                break
 
-            except (requests.exceptions.Timeout, socket.timeout) as e:
-                # Timeout occurred, retry
-                # Catching both because of this bug in requests
-                # https://github.com/kennethreitz/requests/issues/1236
-                print("Timeout %s -> Trying again..." % e)
-                time.sleep(1.0)     # Longer pause because it was a time out. Assume overloaded and give them a second
-                if attempt == MAX_HTTP_RETRIES:                     # Only show exception if last try
-                    raise
-                continue
+            self.logger.info(
+                "Attempt %d of %s %s failed (%s), retrying in %.2f seconds",
+                attempt + 1, method.upper(), url,
+                error or response.status_code, delay)
+            time.sleep(delay)
+            attempt += 1
 
         response.raise_for_status()
 
-        # XXX: until throttling is implemented everywhere in Client, at least add some delay here.
-        time.sleep(0.1)
-
         return response
 
+    def _endpoint_class(self, method, url):
+        """
+        Classifies a request as 'auth', 'socket', 'read' or 'write', for
+        rate limiting.
+
+        Polling for events is a POST, but doesn't change anything, so it
+        counts as a read.
+        """
+        if self._auth_url_re.search(url):
+            return 'auth'
+        if self._socket_url_re.match(url):
+            return 'socket'
+        if method == 'get' or self._read_post_url_re.match(url):
+            return 'read'
+        return 'write'
+
     def get(self, url, data=None, headers=None, with_chat_root=True):
         return self._request('get', url, data, headers, with_chat_root)
 
     def post(self, url, data=None, headers=None, with_chat_root=True):
         return self._request('post', url, data, headers, with_chat_root)
 
+    def make_soup(self, html):
+        return BeautifulSoup(html, self.soup_parser)
+
     def get_soup(self, url, data=None, headers=None, with_chat_root=True):
         response = self.get(url, data, headers, with_chat_root)
-        return BeautifulSoup(response.text, "html.parser")
+        return self.make_soup(response.text)
 
     def post_soup(self, url, data=None, headers=None, with_chat_root=True):
         response = self.post(url, data, headers, with_chat_root)
-        return BeautifulSoup(response.text, "html.parser")
+        return self.make_soup(response.text)
 
     def post_fkeyed(self, url, data=None, headers=None):
         if data is None:
@@ -208,7 +413,7 @@ class Browser(object):
             # no prompt for us to handle
             return prompt_response
 
-        prompt_soup = BeautifulSoup(prompt_response.text, "html.parser")
+        prompt_soup = self.make_soup(prompt_response.text)
 
         data = {
             'session': prompt_soup.find('input', {'name': 'session'})['value'],
@@ -262,7 +467,7 @@ class Browser(object):
                 'mode': 'Messages',
                 'msgCount': 100
             })
-        eventtime = response.json()['time']
+        eventtime = self.decode_response(response)['time']
         self.rooms[room_id]['eventtime'] = eventtime
 
     def leave_room(self, room_id):
@@ -281,27 +486,60 @@ class Browser(object):
         """
         Watches for raw activity in a room using WebSockets.
 
-        This starts a new daemon thread.
+        This starts a new daemon thread, unless share_socket is set and
+        a shared connection is already running.
         """
         room_id = str(room_id)
+        if self.share_socket:
+            return self._watch_room_shared_socket(room_id, on_activity)
+
         socket_watcher = RoomSocketWatcher(self, room_id, on_activity)
         socket_watcher.on_websocket_closed = self.on_websocket_closed
         self.sockets[room_id] = socket_watcher
         socket_watcher.start()
         return socket_watcher
 
+    def _watch_room_shared_socket(self, room_id, on_activity):
+        shared_socket = self.shared_socket
+        if shared_socket is None or shared_socket.killed:
+            shared_socket = SharedSocketWatcher(self)
+            shared_socket.on_websocket_closed = self.on_websocket_closed
+            self.shared_socket = shared_socket
+            socket_watcher = shared_socket.add_room(room_id, on_activity)
+            shared_socket.start(room_id)
+        else:
+            socket_watcher = shared_socket.add_room(room_id, on_activity)
+        self.sockets[room_id] = socket_watcher
+        return socket_watcher
+
     def watch_room_http(self, room_id, on_activity, interval):
         """
         Watches for raw activity in a room using HTTP polling.
 
-        This starts a new daemon thread.
+        This starts a new daemon thread, unless batch_polling is set and
+        a shared poller is already running.
         """
         room_id = str(room_id)
+        if self.batch_polling:
+            return self._watch_room_shared_poll(room_id, on_activity, interval)
+
         http_watcher = RoomPollingWatcher(self, room_id, on_activity, interval)
         self.polls[room_id] = http_watcher
         http_watcher.start()
         return http_watcher
 
+    def _watch_room_shared_poll(self, room_id, on_activity, interval):
+        shared_poll = self.shared_poll
+        if shared_poll is None or shared_poll.killed:
+            shared_poll = SharedPollingWatcher(self)
+            self.shared_poll = shared_poll
+            http_watcher = shared_poll.add_room(room_id, on_activity, interval)
+            shared_poll.start()
+        else:
+            http_watcher = shared_poll.add_room(room_id, on_activity, interval)
+        self.polls[room_id] = http_watcher
+        return http_watcher
+
     def toggle_starring(self, message_id):
         return self.post_fkeyed(
             'messages/%s/star' % (message_id,))
@@ -327,7 +565,8 @@ class Browser(object):
     def delete_message(self, message_id):
         return self.post_fkeyed('messages/%s/delete' % (message_id, ))
 
-    def _get_edits(self, previous_soup):
+    @classmethod
+    def _get_edits(cls, previous_soup):
         """
         Helper for get_history: Get number of edits and editor name
         """
@@ -343,7 +582,7 @@ class Browser(object):
                 try:
                     user_soup = item.select('.username a')[0]
                     latest_editor_user_id, latest_editor_user_name = (
-                        self.user_id_and_name_from_link(user_soup))
+                        cls.user_id_and_name_from_link(user_soup))
                 except IndexError:
                     user_soup = item.select('.username')[0]
                     latest_editor_user_id = None
@@ -358,7 +597,8 @@ class Browser(object):
         return edits, has_editor_name, \
             latest_editor_user_id, latest_editor_user_name
 
-    def _get_pin_data(self, data, history_soup):
+    @classmethod
+    def _get_pin_data(cls, data, history_soup):
         """
         Helper for get_history: Extract users who pinned a message
         """
@@ -373,7 +613,7 @@ class Browser(object):
                 a_soup = p_soup.select('a')[0]
 
                 pins += 1
-                user_id, user_name = self.user_id_and_name_from_link(a_soup)
+                user_id, user_name = cls.user_id_and_name_from_link(a_soup)
                 pinner_user_ids.append(user_id)
                 pinner_user_names.append(user_name)
 
@@ -386,6 +626,10 @@ class Browser(object):
         history_soup = self.get_soup(
             'messages/%s/history' % (message_id,))
 
+        return self._parse_history(history_soup, message_id)
+
+    @classmethod
+    def _parse_history(cls, history_soup, message_id):
         latest_soup = history_soup.select('.monologue')[0]
         previous_soup = history_soup.select('.monologue')[1:]
 
@@ -405,19 +649,19 @@ class Browser(object):
         try:
             owner_soup = latest_soup.select('.username a')[0]
             owner_user_id, owner_user_name = (
-                self.user_id_and_name_from_link(owner_soup))
+                cls.user_id_and_name_from_link(owner_soup))
         except IndexError:
             owner_soup = latest_soup.select('.username')[0]
             owner_user_id = None
             owner_user_name = owner_soup.text
 
         edits, has_editor_name, latest_editor_user_id, \
-            latest_editor_user_name = self._get_edits(previous_soup)
+            latest_editor_user_name = cls._get_edits(previous_soup)
 
-        data = self._get_star_data(
+        data = cls._get_star_data(
             latest_soup, include_starred_by_you=False)
 
-        pins, pinner_user_ids, pinner_user_names = self._get_pin_data(
+        pins, pinner_user_ids, pinner_user_names = cls._get_pin_data(
                 data, history_soup)
 
         data.update({
@@ -446,27 +690,76 @@ class Browser(object):
         transcript_soup = self.get_soup(
             'transcript/message/%s' % (message_id,))
 
-        room_soups = transcript_soup.select('.room-name a')
+        return self._parse_transcript(transcript_soup, message_id)
+
+    def get_transcript_day(self, room_id, day, hours=None):
+        """
+        Returns the data from a room's transcript page for a day (a
+        datetime.date), or for the (start, end) range of hours given.
+
+        Busy days are split over several pages; data['hours'] lists the
+        ranges of the pages other than this one.
+        """
+        url = 'transcript/%s/%d/%d/%d' % (room_id, day.year, day.month, day.day)
+        if hours is not None:
+            url += '/%d-%d' % hours
+        transcript_soup = self.get_soup(url)
+
+        data = self._parse_transcript(transcript_soup)
+        data['hours'] = self._parse_transcript_hours(transcript_soup)
+        return data
+
+    _transcript_hours_re = re.compile(r'^/transcript/\d+/\d+/\d+/\d+/(\d+)-(\d+)$')
+
+    @classmethod
+    def _parse_transcript_hours(cls, transcript_soup):
+        hours = []
+        for link in transcript_soup.find_all('a', href=cls._transcript_hours_re):
+            match = cls._transcript_hours_re.match(link['href'])
+            hour_range = int(match.group(1)), int(match.group(2))
+            if hour_range not in hours:
+                hours.append(hour_range)
+        return hours
+
+    @classmethod
+    def _parse_transcript(cls, transcript_soup, message_id=None):
+        # Transcript pages can hold hundreds of messages, so this uses
+        # find_all() rather than the much slower CSS select().
+
+        room_soups = [
+            link
+            for room_name_soup in transcript_soup.find_all(class_='room-name')
+            for link in room_name_soup.find_all('a')
+        ]
         room_soup = room_soups[-1]
         room_id = int(room_soup['href'].split('/')[-2])
         room_name = room_soup.text
 
         messages_data = []
 
-        monologues_soups = transcript_soup.select('.monologue')
+        monologues_soups = transcript_soup.find_all(class_='monologue')
 
         seen_target_message = False
 
         for monologue_soup in monologues_soups:
+            username_soups = [
+                username_soup
+                for signature_soup in monologue_soup.find_all(class_='signature')
+                for username_soup in signature_soup.find_all(class_='username')
+            ]
             try:
-                user_link, = monologue_soup.select('.signature .username a')
-                user_id, user_name = self.user_id_and_name_from_link(user_link)
+                user_link, = [
+                    link
+                    for username_soup in username_soups
+                    for link in username_soup.find_all('a')
+                ]
+                user_id, user_name = cls.user_id_and_name_from_link(user_link)
             except ValueError:
-                username_div, = monologue_soup.select('.signature .username')
+                username_div, = username_soups
                 user_id = None
                 user_name = username_div.text
 
-            message_soups = monologue_soup.select('.message')
+            message_soups = monologue_soup.find_all(class_='message')
 
             for message_soup in message_soups:
                 this_message_id = int(message_soup['id'].split('-')[1])
@@ -474,16 +767,16 @@ class Browser(object):
                 if this_message_id == message_id:
                     seen_target_message = True
 
-                edited = bool(message_soup.select('.edits'))
+                edited = message_soup.find(class_='edits') is not None
 
                 content = str(
-                    message_soup.select('.content')[0]
+                    message_soup.find(class_='content')
                 ).partition('>')[2].rpartition('<')[0].strip()
 
-                star_data = self._get_star_data(
+                star_data = cls._get_star_data(
                     message_soup, include_starred_by_you=True)
 
-                parent_info_soups = message_soup.select('.reply-info')
+                parent_info_soups = message_soup.find_all(class_='reply-info')
 
                 if parent_info_soups:
                     parent_info_soup, = parent_info_soups
@@ -513,7 +806,7 @@ class Browser(object):
 
                 messages_data.append(message_data)
 
-        if not seen_target_message:
+        if message_id is not None and not seen_target_message:
             logger.error("Did not see target message %s in scraped page." % (message_id))
 
         data = {
@@ -524,29 +817,30 @@ class Browser(object):
 
         return data
 
-    def _get_star_data(self, root_soup, include_starred_by_you):
+    @staticmethod
+    def _get_star_data(root_soup, include_starred_by_you):
         """
         Gets star data indicated to the right of a message from a soup.
         """
 
-        stars_soups = root_soup.select('.stars')
+        stars_soups = root_soup.find_all(class_='stars')
 
         if stars_soups:
             stars_soup, = stars_soups
 
-            times_soup = stars_soup.select('.times')
+            times_soup = stars_soup.find_all(class_='times')
             if times_soup and times_soup[0].text:
                 stars = int(times_soup[0].text)
             else:
                 stars = 1
 
+            stars_classes = stars_soup.get('class', [])
+
             if include_starred_by_you:
                 # some pages never show user-star, so we have to skip
-                starred_by_you = bool(
-                    root_soup.select('.stars.user-star'))
+                starred_by_you = 'user-star' in stars_classes
 
-            pinned = bool(
-                root_soup.select('.stars.owner-star'))
+            pinned = 'owner-star' in stars_classes
 
             if pinned:
                 pins_known = False
@@ -588,6 +882,11 @@ class Browser(object):
         """
         profile_soup = self.get_soup('users/%s' % (user_id,))
 
+        return self._parse_profile(profile_soup)
+
+    @staticmethod
+    def _parse_profile(profile_soup):
+
         name = profile_soup.find('h1').text
 
         is_moderator = bool(u'♦' in profile_soup.select('.user-status')[0].text)
@@ -623,6 +922,11 @@ class Browser(object):
         """
         info_soup = self.get_soup('rooms/info/%s' % (room_id,))
 
+        return self._parse_room_info(info_soup)
+
+    @classmethod
+    def _parse_room_info(cls, info_soup):
+
         name = info_soup.find('h1').text
 
         description = str(
@@ -642,7 +946,7 @@ class Browser(object):
         owner_user_names = []
 
         for card_soup in info_soup.select('#room-ownercards .usercard'):
-            user_id, user_name = self.user_id_and_name_from_link(card_soup.find('a'))
+            user_id, user_name = cls.user_id_and_name_from_link(card_soup.find('a'))
             owner_user_ids.append(user_id)
             owner_user_names.append(user_name)
 
@@ -664,7 +968,7 @@ class Browser(object):
 
     def get_pingable_users_in_room(self, room_id):
         url = "rooms/pingable/{0}".format(room_id)
-        return self.get(url).json()
+        return self.decode_response(self.get(url))
 
     def get_pingable_user_ids_in_room(self, room_id):
         return [user_id for (user_id, name, _1, _2) in self.get_pingable_users_in_room(room_id)]
@@ -675,6 +979,10 @@ class Browser(object):
     def get_current_users_in_room(self, room_id):
         url = "/rooms/{0}/".format(room_id)
         soup = self.get_soup(url)
+        return self._parse_current_users(soup)
+
+    @staticmethod
+    def _parse_current_users(soup):
         try:
             # Sometime around 2020-11, SE changed to sending data for the users present in the room data in a
             # <div class="js-present" data-users="<JSON encoded list of user records>">
@@ -707,8 +1015,10 @@ class Browser(object):
 
     def set_websocket_recovery(self, on_ws_closed):
         self.on_websocket_closed = on_ws_closed
-        for s in self.sockets:
+        for s in self.sockets.values():
             s.on_websocket_closed = self.on_websocket_closed
+        if self.shared_socket is not None:
+            self.shared_socket.on_websocket_closed = self.on_websocket_closed
 
 
 class RoomSocketWatcher(object):
@@ -729,10 +1039,10 @@ class RoomSocketWatcher(object):
     def start(self):
         last_event_time = self.browser.rooms[self.room_id]['eventtime']
 
-        ws_auth_data = self.browser.post_fkeyed(
+        ws_auth_data = self.browser.decode_response(self.browser.post_fkeyed(
             'ws-auth',
             {'roomid': self.room_id}
-        ).json()
+        ))
         wsurl = ws_auth_data['url'] + '?l=%s' % (last_event_time,)
         self.logger.debug('wsurl == %r', wsurl)
 
@@ -747,11 +1057,13 @@ class RoomSocketWatcher(object):
         self.thread.start()
 
     def _runner(self):
-        # look at wsdump.py later to handle opcodes
+        keepalive = SocketKeepalive(self.browser, self.ws, self)
         while not self.killed:
             try:
-                a = self.ws.recv()
+                a = keepalive.recv()
             except websocket.WebSocketConnectionClosedException as e:
+                if self.killed:
+                    break
                 if self.on_websocket_closed is not None:
                     self.on_websocket_closed(self.room_id)
                 else:
@@ -759,8 +1071,223 @@ class RoomSocketWatcher(object):
                 self.killed = True
                 break
 
-            if a is not None and a != "":
-                self.on_activity(json.loads(a))
+            if a is None:
+                continue
+            self.browser.last_frame_times[self.room_id] = time.time()
+            activity = self.browser.decode_frame(a)
+            if activity is not None:
+                activity = self.browser._track_socket_activity(
+                    self.room_id, activity)
+                self.browser._dispatch_activity(
+                    self.room_id, self.on_activity, activity)
+
+
+class SocketKeepalive(object):
+    """
+    Reads from a watcher's WebSocket, pinging the server as configured
+    on the Browser and checking that frames are still arriving.
+
+    If none arrive for browser.socket_idle_timeout seconds the
+    connection is assumed to be half-open: it's closed and treated as
+    lost, so that the watcher's recovery hook runs.
+    """
+    def __init__(self, browser, ws, watcher):
+        self.logger = logger.getChild('SocketKeepalive')
+        self.ws = ws
+        self.watcher = watcher
+        self.ping_interval = browser.socket_ping_interval
+        self.idle_timeout = browser.socket_idle_timeout
+        if browser.socket_recv_timeout is not None:
+            ws.settimeout(browser.socket_recv_timeout)
+        self.last_frame = self.last_ping = time.time()
+        self.last_pong = None
+
+    def recv(self):
+        """
+        Returns the text of the next data frame, "" for an empty
+        heartbeat frame, or None if the watcher was killed while waiting.
+        """
+        while not self.watcher.killed:
+            now = time.time()
+            if self.idle_timeout is not None and now - self.last_frame > self.idle_timeout:
+                self.logger.warning(
+                    "No frames for %.0f seconds; reconnecting.", now - self.last_frame)
+                self.ws.close()
+                raise websocket.WebSocketConnectionClosedException(
+                    "no frames received for %.0f seconds" % (now - self.last_frame,))
+            if self.ping_interval is not None and now - self.last_ping >= self.ping_interval:
+                self.ws.ping()
+                self.last_ping = now
+
+            try:
+                opcode, data = self.ws.recv_data(control_frame=True)
+            except websocket.WebSocketTimeoutException:
+                continue
+
+            self.last_frame = time.time()
+            if opcode in (websocket.ABNF.OPCODE_TEXT, websocket.ABNF.OPCODE_BINARY):
+                return data.decode('utf-8')
+            elif opcode == websocket.ABNF.OPCODE_PONG:
+                self.last_pong = self.last_frame
+            elif opcode == websocket.ABNF.OPCODE_CLOSE:
+                raise websocket.WebSocketConnectionClosedException(
+                    "server closed the connection")
+        return None
+
+
+class SharedSocketWatcher(object):
+    """
+    Watches for raw activity in any number of rooms over one WebSocket.
+
+    Stack Exchange sends the activity of every room the user is in over
+    any socket it has open, keyed by 'r<room_id>'. Each room's section
+    is passed to that room's on_activity callback on its own, so the
+    callbacks see the same activity dicts as with RoomSocketWatcher.
+    """
+    def __init__(self, browser):
+        self.logger = logger.getChild('SharedSocketWatcher')
+        self.browser = browser
+        self.rooms = {}
+        self.thread = None
+        self.on_websocket_closed = None
+        self.killed = False
+
+    def add_room(self, room_id, on_activity):
+        """
+        Starts routing activity for room_id to on_activity. Rooms can be
+        added while the connection is running.
+        """
+        room_id = str(room_id)
+        watcher = SharedRoomWatcher(self, room_id, on_activity)
+        self.rooms[room_id] = watcher
+        return watcher
+
+    def remove_room(self, room_id):
+        """
+        Stops routing activity for room_id, closing the connection once
+        no rooms are left.
+        """
+        self.rooms.pop(str(room_id), None)
+        if not self.rooms:
+            self.close()
+
+    def close(self):
+        self.killed = True
+        if hasattr(self, 'ws'):
+            self.ws.close()
+
+    def start(self, room_id):
+        """
+        Connects, authenticating the socket for room_id, and starts
+        reading from it in a new daemon thread.
+        """
+        room_id = str(room_id)
+        last_event_time = self.browser.rooms[room_id]['eventtime']
+
+        ws_auth_data = self.browser.decode_response(self.browser.post_fkeyed(
+            'ws-auth',
+            {'roomid': room_id}
+        ))
+        wsurl = ws_auth_data['url'] + '?l=%s' % (last_event_time,)
+        self.logger.debug('wsurl == %r', wsurl)
+
+        self.ws = websocket.create_connection(
+            wsurl, origin=self.browser.chat_root)
+
+        self.thread = threading.Thread(
+            name="ChatExchange: SharedSocketWatcher for chat.{}".format(
+                self.browser.host),
+            target=self._runner)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _runner(self):
+        keepalive = SocketKeepalive(self.browser, self.ws, self)
+        while not self.killed:
+            try:
+                a = keepalive.recv()
+            except websocket.WebSocketConnectionClosedException as e:
+                if self.killed:
+                    break
+                # mark ourselves dead first, so that recovery hooks which
+                # watch rooms again get a fresh connection
+                self.killed = True
+                if self.on_websocket_closed is None:
+                    raise e
+                for room_id in list(self.rooms):
+                    self.on_websocket_closed(room_id)
+                break
+
+            if a is None:
+                continue
+            now = time.time()
+            for room_id in list(self.rooms):
+                self.browser.last_frame_times[room_id] = now
+            activity = self.browser.decode_frame(a)
+            if activity is not None:
+                self._dispatch(activity)
+
+    def _dispatch(self, activity):
+        for key, room_activity in activity.items():
+            if not key.startswith('r'):
+                continue
+            watcher = self.rooms.get(key[1:])
+            if watcher is not None:
+                room_activity = self.browser._track_socket_activity(
+                    watcher.room_id, {key: room_activity})
+                try:
+                    self.browser._dispatch_activity(
+                        watcher.room_id, watcher.on_activity, room_activity)
+                except Exception:
+                    # one room's handler mustn't stop every other room's
+                    self.logger.exception(
+                        "Handling activity in room #%s failed", watcher.room_id)
+
+
+class _HeldActivity(object):
+    """
+    An on_activity callback that holds activity until released, then
+    passes it, and everything after it, on to on_activity in order.
+    """
+    def __init__(self, on_activity):
+        self.on_activity = on_activity
+        self._lock = threading.Lock()
+        self._held = []
+
+    def __call__(self, activity):
+        with self._lock:
+            if self._held is not None:
+                self._held.append(activity)
+                return
+        self.on_activity(activity)
+
+    def release(self):
+        while True:
+            with self._lock:
+                held, self._held = self._held, []
+                if not held:
+                    self._held = None
+                    return
+            for activity in held:
+                self.on_activity(activity)
+
+
+class SharedRoomWatcher(object):
+    """
+    A single room's subscription to a SharedSocketWatcher or
+    SharedPollingWatcher.
+    """
+    def __init__(self, shared_watcher, room_id, on_activity):
+        self.shared_watcher = shared_watcher
+        self.room_id = room_id
+        self.on_activity = on_activity
+        self.on_websocket_closed = None
+        self.killed = False
+
+    def close(self):
+        self.killed = True
+        if self.shared_watcher.rooms.get(self.room_id) is self:
+            self.shared_watcher.remove_room(self.room_id)
 
 
 class RoomPollingWatcher(object):
@@ -788,8 +1315,8 @@ class RoomPollingWatcher(object):
         while not self.killed:
             last_event_time = self.browser.rooms[self.room_id]['eventtime']
 
-            activity = self.browser.post_fkeyed(
-                'events', {'r' + self.room_id: last_event_time}).json()
+            activity = self.browser.decode_response(self.browser.post_fkeyed(
+                'events', {'r' + self.room_id: last_event_time}))
 
             try:
                 room_result = activity['r' + self.room_id]
@@ -798,11 +1325,125 @@ class RoomPollingWatcher(object):
             except KeyError:
                 pass  # no updated time from room
 
-            self.on_activity(activity)
+            self.browser._dispatch_activity(
+                self.room_id, self.on_activity, activity)
 
             time.sleep(self.interval)
 
 
+class SharedPollingWatcher(object):
+    """
+    Polls for raw activity in any number of rooms from a single thread.
+
+    Each tick sends one 'events' request with an r<room_id> key for
+    every room that is due (or due within `slack` seconds), and passes
+    each room's section of the response to that room's on_activity.
+    """
+    slack = 0.5
+
+    def __init__(self, browser):
+        self.logger = logger.getChild('SharedPollingWatcher')
+        self.browser = browser
+        self.rooms = {}
+        self.thread = None
+        self.killed = False
+        self._wakeup = threading.Event()
+
+    def add_room(self, room_id, on_activity, interval):
+        """
+        Starts polling room_id every interval seconds, beginning with
+        the next tick.
+        """
+        room_id = str(room_id)
+        watcher = SharedRoomWatcher(self, room_id, on_activity)
+        watcher.interval = interval
+        watcher.next_poll = 0
+        self.rooms[room_id] = watcher
+        self._wakeup.set()
+        return watcher
+
+    def remove_room(self, room_id):
+        """
+        Stops polling room_id, stopping the thread once no rooms are left.
+        """
+        self.rooms.pop(str(room_id), None)
+        if not self.rooms:
+            self.close()
+
+    def start(self):
+        self.thread = threading.Thread(
+            name="ChatExchange: SharedPollingWatcher for chat.{}".format(
+                self.browser.host),
+            target=self._runner)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.killed = True
+        self._wakeup.set()
+
+    def _runner(self):
+        while not self.killed:
+            now = time.time()
+            watchers = list(self.rooms.values())
+            due = [w for w in watchers if w.next_poll <= now + self.slack]
+
+            if due:
+                try:
+                    self._poll(due, now)
+                except (requests.RequestException, ValueError):
+                    self.logger.exception("polling %d rooms failed", len(due))
+                    for watcher in due:
+                        watcher.next_poll = now + watcher.interval
+
+            self._wakeup.clear()
+            watchers = list(self.rooms.values())
+            if watchers:
+                timeout = min(w.next_poll for w in watchers) - time.time()
+                self._wakeup.wait(max(timeout, 0))
+            else:
+                self._wakeup.wait()
+
+    def _poll(self, watchers, now):
+        data = {}
+        for watcher in watchers:
+            room = self.browser.rooms.get(watcher.room_id)
+            if room is not None:
+                data['r' + watcher.room_id] = room['eventtime']
+        if not data:
+            return
+
+        activity = self.browser.decode_response(
+            self.browser.post_fkeyed('events', data))
+
+        for watcher in watchers:
+            watcher.next_poll = now + watcher.interval
+            key = 'r' + watcher.room_id
+            if key not in data or watcher.killed:
+                continue
+
+            room_result = activity.get(key)
+            if room_result is None:
+                self._dispatch(watcher, {})
+                continue
+
+            try:
+                self.browser.rooms[watcher.room_id]['eventtime'] = room_result['t']
+            except KeyError:
+                pass  # no updated time from room, or room was left
+
+            self._dispatch(watcher, {key: room_result})
+
+    def _dispatch(self, watcher, activity):
+        try:
+            self.browser._dispatch_activity(
+                watcher.room_id, watcher.on_activity, activity)
+        except Exception:
+            # one room's handler mustn't stop every other room's polling
+            self.logger.exception(
+                "Handling activity in room #%s failed", watcher.room_id)
+
+
 class BrowserError(Exception):
     pass
 
@@ -1,20 +1,17 @@
 import sys
-if sys.version_info[0] == 2:
-    import Queue as queue
-else:
-    import queue
 import logging
 if sys.version_info[:2] <= (2, 6):
     logging.Logger.getChild = lambda self, suffix:\
         self.manager.getLogger('.'.join((self.name, suffix)) if self.root is not self else suffix)
-import collections
+import concurrent.futures
 import re
 import time
 import threading
 import weakref
 import requests
 
-from . import browser, messages, rooms, users
+from . import _utils, actions, browser, events, messages, rooms, users
+from .actions import ChatActionError, PeekableQueue  # noqa: F401 (backwards-compatibility)
 
 
 TOO_FAST_RE = r"You can perform this action again in (\d+) second"
@@ -23,28 +20,75 @@ TOO_FAST_RE = r"You can perform this action again in (\d+) second"
 logger = logging.getLogger(__name__)
 
 
-class PeekableQueue(queue.Queue):
+class RequestLane(object):
     """
-    A simple extension of the standard Queue object which allows inspection of the tail
-    and manipulating the returned value.
+    The queue of chat actions waiting to be sent for one room, and the
+    thread that sends them.
+
+    Each lane waits out its own throttling, so a throttled room doesn't
+    hold up sends to other rooms.
     """
-    def peek_latest(self):
-        """
-        Return the last object which was added to the queue without modifying the queue
-        """
-        if self.qsize() > 0:
-            # Implementation detail: queue grows rightward, last element is [-1]
-            return self.queue[-1]
+    def __init__(self, client, room_id):
+        self.room_id = room_id
+        self.queue = actions.PriorityPeekableQueue()
+        self.previous = None
+        # when the backoff after the last action ends, and the next may go
+        self.ready_at = 0
+        self.thread = threading.Thread(
+            target=client._worker, args=(self,),
+            name="ChatExchange: message_sender for room #{} on chat.{}".format(
+                room_id, client.host))
+        self.thread.daemon = True
+
+
+class IdentityMap(object):
+    """
+    The known instances of one type of object, by id.
 
-    def poke_latest(self, oldvalue, newvalue):
+    Any instance that is still referenced somewhere can be found here,
+    so there's only ever one object per id. The most recently used
+    instances are also kept alive by an L{_utils.LRUCache}, so that they
+    (and the data they have loaded) outlive their last outside reference.
+    """
+    def __init__(self, maxsize, ttl=None):
+        self.instances = weakref.WeakValueDictionary()
+        self.recent = _utils.LRUCache(maxsize, ttl)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_or_create(self, id, factory, *args):
         """
-        Replace the lastest value if it is identical to the passed-in oldvalue.
-        Otherwise, return False to signify failure.
+        Returns the known instance with the given id, creating it with
+        factory(id, *args) if there is none, and marks it as recently used.
         """
-        if self.queue[-1] is oldvalue:
-            self.queue[-1] = newvalue
-            return True
-        return False
+        with self._lock:
+            instance = self.instances.get(id)
+            if instance is None:
+                self.misses += 1
+                instance = self.instances[id] = factory(id, *args)
+            else:
+                self.hits += 1
+        self.recent.put(id, instance)
+        return instance
+
+    def get(self, id, default=None):
+        return self.instances.get(id, default)
+
+    def __contains__(self, id):
+        return id in self.instances
+
+    def __len__(self):
+        return len(self.instances)
+
+    def stats(self):
+        stats = self.recent.stats()
+        with self._lock:
+            stats.update(
+                live=len(self.instances),
+                hits=self.hits,
+                misses=self.misses)
+        return stats
 
 
 class Client(object):
@@ -56,22 +100,47 @@ class Client(object):
     @type logged_in:   L{bool}
     @ivar host:        Hostname of associated Stack Exchange site.
     @type host:        L{str}
+    @ivar bus:         Dispatches events from rooms watched without a callback.
+    @type bus:         L{events.EventBus}
+    @ivar store:       Local record of messages, if any.
+    @type store:       L{store.MessageStore}
     @cvar valid_hosts: Set of valid/real Stack Exchange hostnames with chat.
     @type valid_hosts: L{set}
     """
 
-    _max_recently_gotten_objects = 5000
+    # How many recently used objects of each type to keep alive, and for
+    # how many seconds after their last use (None for no time limit).
+    identity_map_sizes = {'messages': 5000, 'rooms': 500, 'users': 5000}
+    identity_map_ttl = None
+
+    # How many chat actions (sends, edits, deletes) may be in flight at
+    # once, across all rooms.
+    max_concurrent_actions = 4
 
     def __init__(
             self,
             host='stackexchange.com',
             email=None, password=None,
-            send_aggressively=False
+            send_aggressively=False,
+            share_socket=False,
+            batch_polling=False,
+            dispatcher=None,
+            store=None
     ):
         """
         Initializes a client for a specific chat host.
 
         If email and password are provided, the client will L{login}.
+
+        If share_socket is True, all rooms watched with
+        L{rooms.Room.watch_socket} share a single WebSocket connection.
+        If batch_polling is True, all rooms watched with
+        L{rooms.Room.watch_polling} are polled together, one request per tick.
+        If dispatcher (a L{dispatch.ActivityDispatcher}) is given, event
+        callbacks are run on its worker threads instead of the watchers'.
+        If store (a L{store.MessageStore}) is given, messages seen in
+        watched rooms and scraped pages are recorded in it, and their
+        attributes are loaded from it when it knows them.
         """
         self.logger = logger.getChild('Client')
 
@@ -80,9 +149,12 @@ class Client(object):
                 "must specify both email and password or neither")
 
         # any known instances
-        self._messages = weakref.WeakValueDictionary()
-        self._rooms = weakref.WeakValueDictionary()
-        self._users = weakref.WeakValueDictionary()
+        self._messages = IdentityMap(
+            self.identity_map_sizes['messages'], self.identity_map_ttl)
+        self._rooms = IdentityMap(
+            self.identity_map_sizes['rooms'], self.identity_map_ttl)
+        self._users = IdentityMap(
+            self.identity_map_sizes['users'], self.identity_map_ttl)
 
         if host not in self.valid_hosts:
             raise ValueError("invalid host: %r" % (host,))
@@ -90,15 +162,24 @@ class Client(object):
         self.host = host
         self.logged_in = False
         self.on_message_sent = None
-        self._request_queue = PeekableQueue()
+        # receives events from rooms watched without a callback
+        self.bus = events.EventBus(self)
+        self.store = store
+        self._lanes = {}
+        self._lanes_lock = threading.Lock()
+        self._action_slots = threading.BoundedSemaphore(
+            self.max_concurrent_actions)
+        # queued edits that haven't been started, by message id
+        self._pending_edits = {}
+        self._pending_edits_lock = threading.Lock()
 
         self._br = browser.Browser()
         self._br.host = host
-        self._previous = None
-        self._recently_gotten_objects = collections.deque(maxlen=self._max_recently_gotten_objects)
+        self._br.share_socket = share_socket
+        self._br.batch_polling = batch_polling
+        self._br.dispatcher = dispatcher
         self._requests_served = 0
-        self._thread = threading.Thread(target=self._worker, name="ChatExchange: message_sender for chat.{}".format(host))
-        self._thread.daemon = True
+        self._requests_served_lock = threading.Lock()
 
         self.aggressive_sender = send_aggressively
 
@@ -116,6 +197,80 @@ class Client(object):
         return self._get_and_set_deduplicated(
             messages.Message, message_id, self._messages, attrs_to_set)
 
+    def get_messages(self, message_ids, workers=4):
+        """
+        Returns the Message instances with the given message_ids, with
+        everything that transcript pages say about them loaded.
+
+        Each transcript page has many messages on it, so pages are
+        fetched in waves, up to `workers` at once, and messages loaded
+        by an earlier page aren't looked up again. Messages already
+        loaded, or known to the client's store, aren't fetched at all.
+
+        @rtype: L{list} of L{messages.Message}
+        """
+        found = [self.get_message(message_id) for message_id in message_ids]
+
+        def needs_transcript(message):
+            return not all(
+                getattr(messages.Message, name).is_loaded(message)
+                for name in messages.Message._transcript_attributes)
+
+        remaining = sorted(set(
+            message.id for message in found
+            if needs_transcript(message) and not message._load_from_store(
+                messages.Message._transcript_attributes)))
+
+        # The widest range of ids seen on one page, used to guess which
+        # ids are likely on different pages.
+        page_span = None
+        pages = 0
+
+        executor = concurrent.futures.ThreadPoolExecutor(workers)
+        try:
+            while remaining:
+                if page_span is None:
+                    targets = remaining[:1]
+                else:
+                    targets = []
+                    for message_id in remaining:
+                        if not targets or message_id > targets[-1] + page_span:
+                            targets.append(message_id)
+                            if len(targets) == workers:
+                                break
+
+                fetches = [
+                    (message_id, executor.submit(
+                        self._br.get_transcript_with_message, message_id))
+                    for message_id in targets]
+
+                for message_id, fetch in fetches:
+                    data = fetch.result()
+                    pages += 1
+                    if self.store is not None:
+                        self.store.record_transcript(data)
+                    self.get_message(message_id)._apply_transcript(data)
+
+                    page_ids = [message_data['id'] for message_data in data['messages']]
+                    if page_ids:
+                        page_span = max(page_span or 0, max(page_ids) - min(page_ids))
+
+                for message_id in targets:
+                    if needs_transcript(self.get_message(message_id)):
+                        self.logger.warning(
+                            "Message #%s wasn't on its own transcript page", message_id)
+
+                remaining = [
+                    message_id for message_id in remaining
+                    if message_id not in targets
+                    and needs_transcript(self.get_message(message_id))]
+        finally:
+            executor.shutdown(wait=True)
+
+        self.logger.info(
+            "Loaded %d messages from %d transcript pages", len(found), pages)
+        return found
+
     def get_room(self, room_id, **attrs_to_set):
         """
         Returns the Room instance with the given room_id.
@@ -137,16 +292,46 @@ class Client(object):
             users.User, user_id, self._users, attrs_to_set)
 
     def _get_and_set_deduplicated(self, cls, id, instances, attrs):
-        instance = instances.setdefault(id, cls(id, self))
+        instance = instances.get_or_create(id, cls, self)
 
         for key, value in attrs.items():
             setattr(instance, key, value)
 
-        # we force a fixed number of recent objects to be cached
-        self._recently_gotten_objects.appendleft(instance)
-
         return instance
 
+    def search_messages(
+            self, query, room_id=None, user_id=None, since=None, until=None,
+            limit=100
+    ):
+        """
+        Searches the messages in the client's store, without making any
+        requests; see L{store.MessageStore.search}.
+
+        @rtype: L{list} of L{messages.Message}
+        """
+        assert self.store is not None, "client has no message store"
+
+        found = []
+        for message_data in self.store.search(
+                query, room_id, user_id, since, until, limit):
+            message = self.get_message(message_data['id'])
+            message._apply_message_data(message_data)
+            found.append(message)
+        return found
+
+    def identity_map_stats(self):
+        """
+        Returns the size, hit, miss and eviction counts of the maps of
+        known messages, rooms and users.
+
+        @rtype: L{dict}
+        """
+        return {
+            'messages': self._messages.stats(),
+            'rooms': self._rooms.stats(),
+            'users': self._users.stats(),
+        }
+
     valid_hosts = ('stackexchange.com', 'meta.stackexchange.com', 'stackoverflow.com')
 
     def get_me(self):
@@ -170,7 +355,7 @@ class Client(object):
 
         self.logged_in = True
         self.logger.info("Logged in.")
-        self._thread.start()
+        self._start_lanes()
 
         return cookies
 
@@ -185,7 +370,7 @@ class Client(object):
 
         self.logged_in = True
         self.logger.info("Logged in (cookie).")
-        self._thread.start()
+        self._start_lanes()
 
     def logout(self):
         """
@@ -197,10 +382,16 @@ class Client(object):
         for watcher in self._br.sockets.values():
             watcher.killed = True
 
+        if self._br.shared_socket is not None:
+            self._br.shared_socket.killed = True
+
+        if self._br.shared_poll is not None:
+            self._br.shared_poll.close()
+
         for watcher in self._br.polls.values():
             watcher.killed = True
 
-        self._request_queue.put(SystemExit)
+        self._stop_lanes()
         self.logger.info("Logged out.")
         self.logged_in = False
 
@@ -209,30 +400,119 @@ class Client(object):
 
     def __del__(self):
         if self.logged_in:
-            self._request_queue.put(SystemExit)
+            self._stop_lanes()
             assert False, "You forgot to log out."
 
-    def _worker(self):
+    def _lane(self, room_id):
+        """
+        Returns the RequestLane for room_id, creating it if neccessary.
+        Actions whose room isn't known go to the lane for room_id None.
+        """
+        lane = self._lanes.get(room_id)
+        if lane is None:
+            with self._lanes_lock:
+                lane = self._lanes.get(room_id)
+                if lane is None:
+                    lane = RequestLane(self, room_id)
+                    self._lanes[room_id] = lane
+                    if self.logged_in:
+                        lane.thread.start()
+        return lane
+
+    def _start_lanes(self):
+        with self._lanes_lock:
+            for lane in self._lanes.values():
+                lane.thread.start()
+
+    def _stop_lanes(self):
+        with self._lanes_lock:
+            for lane in self._lanes.values():
+                lane.queue.put(SystemExit)
+
+    def _coalesce_edit(self, action, request_queue):
+        """
+        If an edit of the same message is still queued, gives it action's
+        text and future instead of queueing another, and returns True.
+        Otherwise notes action, about to be put on request_queue, as the
+        message's pending edit.
+
+        The queued edit keeps the higher of the two priorities.
+        """
+        with self._pending_edits_lock:
+            pending = self._pending_edits.get(action.target_id)
+            if pending is not None:
+                pending_action, pending_queue = pending
+                pending_action.text = action.text
+                pending_action.futures.extend(action.futures)
+                if action.priority < pending_action.priority:
+                    # if a worker has just taken it, it's being sent anyway
+                    pending_queue.reprioritize(pending_action, action.priority)
+                return True
+            self._pending_edits[action.target_id] = (action, request_queue)
+            return False
+
+    def _drop_pending_edits(self, message_id):
+        """
+        Cancels any queued edit of a message that is about to be deleted.
+        """
+        with self._pending_edits_lock:
+            pending = self._pending_edits.pop(message_id, None)
+        if pending is not None:
+            pending_action, _ = pending
+            for future in pending_action.futures:
+                future.cancel()
+        return pending is not None
+
+    def _worker(self, lane):
         assert self.logged_in
-        self.logger.info("Worker thread reporting for duty.")
+        self.logger.info(
+            "Worker thread for room #%s reporting for duty.", lane.room_id)
         while True:
-            next_action = self._request_queue.get()  # blocking
+            next_action = lane.queue.get()  # blocking
             if next_action == SystemExit:
-                self.logger.info("Worker thread exits.")
+                self.logger.info(
+                    "Worker thread for room #%s exits.", lane.room_id)
                 return
             else:
-                self._requests_served += 1
+                with self._requests_served_lock:
+                    self._requests_served += 1
+                    served = self._requests_served
                 self.logger.info(
-                    "Now serving customer %d, %r",
-                    self._requests_served, next_action)
+                    "Now serving customer %d, %r", served, next_action)
+
+            if next_action.action_type == 'edit':
+                # from now on, further edits have to be queued separately
+                with self._pending_edits_lock:
+                    pending = self._pending_edits.get(next_action.target_id)
+                    if pending is not None and pending[0] is next_action:
+                        del self._pending_edits[next_action.target_id]
+
+            # futures cancelled before we got to them are skipped, and
+            # if every part of the action was cancelled, so is the action
+            futures = [
+                future for future in next_action.futures
+                if future.set_running_or_notify_cancel()]
+            if not futures:
+                self.logger.info("Cancelled before sending: %r", next_action)
+                lane.queue.task_done()
+                continue
 
             try:
-                self._do_action_despite_throttling(next_action)
-            except requests.HTTPError as exc:
+                result = self._do_action_despite_throttling(next_action, lane)
+            except Exception as exc:
+                # the lane has to outlive any failure, or every later
+                # action for its room would wait forever
                 self.logger.error(
-                    "Attempt %d: denied: %s", self._requests_served, exc)
+                    "Attempt %d: denied: %s", served, exc)
+                if not isinstance(exc, ChatActionError):
+                    exc = ChatActionError("chat action failed: %s" % (exc,))
+                for future in futures:
+                    future.set_exception(exc)
+            else:
+                for future in futures:
+                    future.set_result(result)
 
-            self._request_queue.task_done()
+            lane.queue.task_done()
 
     # Appeasing the rate limiter gods is hard.
     _BACKOFF_ADDER = 5
@@ -267,42 +547,89 @@ class Client(object):
             "Attempt %d: denied: unknown reason %r", attempt, unpacked)
         return self._BACKOFF_ADDER
 
-    def _do_action_despite_throttling(self, action):
-        action_type = action[0]
+    # Responses to chat actions that mean there is nothing left to retry.
+    _ignored_action_responses = (
+        "ok",
+        "It is too late to delete this message",
+        "It is too late to edit this message",
+        "The message has been deleted and cannot be edited",
+        "This message has already been deleted."
+    )
+
+    def _assess_action_response(self, unpacked, action_type, text, attempt):
+        """
+        Helper for _do_action_despite_throttling: decide what to do next,
+        given the unpacked response to an attempt.
+
+        Returns (sent, wait, text): whether the action is done, how many
+        seconds to wait before continuing, and the text to retry with.
+        """
+        wait = 0
+        if isinstance(unpacked, str) and unpacked not in self._ignored_action_responses:
+            wait = self._handle_throttled_text(unpacked, attempt)
+        elif isinstance(unpacked, dict):
+            if unpacked["id"] is None:  # Duplicate message?
+                text += " "  # Append because markdown
+                wait = self._BACKOFF_ADDER
+                self.logger.debug(
+                    "Attempt %d: denied: duplicate, waiting %.1f seconds.",
+                    attempt, wait)
+
+        if wait:
+            self.logger.debug("Attempt %d: waiting %.1f seconds", attempt, wait)
+            return False, wait, text
+
+        if action_type != 'send':
+            # There's no reason to wait after sending a message.
+            # At least for sending a message, SE chat responses make it clear when a wait is needed.
+            wait = self._BACKOFF_ADDER
+        self.logger.debug(
+            "Attempt %d: success. Next action waits %.1f seconds", attempt, wait)
+        return True, wait, text
+
+    def _do_action_despite_throttling(self, action, lane):
+        """
+        Does a ChatAction, retrying until Stack Exchange accepts it.
+
+        Returns the new message's id for a send, or the final response
+        for an edit or delete.
+        """
+        action_type = action.action_type
+        text = action.text
         if action_type == 'send':
-            action_type, room_id, text = action
+            room_id = action.target_id
             message_id = None
         else:
-            assert action_type == 'edit' or action_type == 'delete'
-            action_type, message_id, text = action
+            room_id = None
+            message_id = action.target_id
+
+        # wait out the backoff left by this lane's previous action
+        delay = lane.ready_at - _utils._now()
+        if delay > 0:
+            self.logger.debug("Waiting %.1f seconds before next action", delay)
+            time.sleep(delay)
 
         sent = False
         attempt = 0
-        if text == self._previous:
+        if text == lane.previous:
             text = " " + text
         response = None
         unpacked = None
-        ignored_messages = [
-            "ok",
-            "It is too late to delete this message",
-            "It is too late to edit this message",
-            "The message has been deleted and cannot be edited",
-            "This message has already been deleted."
-        ]
 
         while not sent:
-            wait = 0
             attempt += 1
             self.logger.debug("Attempt %d: start.", attempt)
 
             try:
-                if action_type == 'send':
-                    response = self._br.send_message(room_id, text)
-                elif action_type == 'edit':
-                    response = self._br.edit_message(message_id, text)
-                else:
-                    assert action_type == 'delete'
-                    response = self._br.delete_message(message_id)
+                # waits for throttling below don't take up a slot
+                with self._action_slots:
+                    if action_type == 'send':
+                        response = self._br.send_message(room_id, text)
+                    elif action_type == 'edit':
+                        response = self._br.edit_message(message_id, text)
+                    else:
+                        assert action_type == 'delete'
+                        response = self._br.delete_message(message_id)
             except requests.HTTPError as ex:
                 if ex.response.status_code == 409:
                     # this could be a throttling message we know how to handle
@@ -311,32 +638,20 @@ class Client(object):
                     raise
 
             unpacked = Client._unpack_response(response)
-            if isinstance(unpacked, str) and unpacked not in ignored_messages:
-                wait = self._handle_throttled_text(unpacked, attempt)
-            elif isinstance(unpacked, dict):
-                if unpacked["id"] is None:  # Duplicate message?
-                    text += " "  # Append because markdown
-                    wait = self._BACKOFF_ADDER
-                    self.logger.debug(
-                        "Attempt %d: denied: duplicate, waiting %.1f seconds.",
-                        attempt, wait)
-
-            if wait:
-                self.logger.debug("Attempt %d: waiting %.1f seconds", attempt, wait)
+            sent, wait, text = self._assess_action_response(
+                unpacked, action_type, text, attempt)
+            if sent:
+                lane.previous = text
+                # The result is ready now; the wait only holds up the
+                # lane's next action.
+                lane.ready_at = _utils._now() + wait
             else:
-                if action_type != 'send':
-                    # There's no reason to wait after sending a message.
-                    # At least for sending a message, SE chat responses make it clear when a wait is needed.
-                    wait = self._BACKOFF_ADDER
-                self.logger.debug("Attempt %d: success. Waiting %.1f seconds", attempt, wait)
-                sent = True
-                self._previous = text
+                time.sleep(wait)
 
-            time.sleep(wait)
-
-        if action_type == 'send' and isinstance(
-                unpacked, dict) and self.on_message_sent is not None:
-            self.on_message_sent(response.json()["id"], room_id)
+        if action_type == 'send' and isinstance(unpacked, dict):
+            if self.on_message_sent is not None:
+                self.on_message_sent(unpacked["id"], room_id)
+            return unpacked["id"]
 
         return response
 
@@ -345,7 +660,3 @@ class Client(object):
 
     def _leave_room(self, room_id):
         self._br.leave_room(room_id)
-
-
-class ChatActionError(Exception):
-    pass
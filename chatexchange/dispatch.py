@@ -0,0 +1,256 @@
+"""
+Runs room activity callbacks on a pool of worker threads, so that slow
+callbacks don't hold up the threads reading from chat.
+"""
+import collections
+import itertools
+import json
+import logging
+import tempfile
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+SPILL = 'spill'
+
+
+class _Lane(object):
+    """
+    The activity waiting to be handled for one ordering key.
+    """
+    def __init__(self):
+        # (seq, callback, activity), oldest first
+        self.items = collections.deque()
+        self.busy = False
+        self.queued = False
+        # activity that didn't fit in memory, as JSON lines, and the
+        # callbacks to pass it to
+        self.spill = None
+        self.spill_read_pos = 0
+        self.spilled_callbacks = collections.deque()
+
+
+class ActivityDispatcher(object):
+    """
+    Hands room activity to a bounded pool of worker threads.
+
+    Activity with the same ordering key is handled one item at a time,
+    in the order it was submitted; activity for different keys is
+    handled concurrently. With ordering='room' the key is the room id.
+    With ordering='message', each room's events are split up by message
+    id, so only the events about the same message are kept in order.
+
+    At most max_pending items are held in memory. When that's reached,
+    the backpressure policy decides what happens to new activity:
+
+     - BLOCK: the submitting (watcher) thread waits for room
+     - DROP_OLDEST: the oldest waiting item is discarded
+     - SPILL: the item is written to a temporary file in spill_dir
+       (or the default temporary directory) until it can be handled
+    """
+    def __init__(
+            self, workers=4, max_pending=1000, backpressure=BLOCK,
+            ordering='room', spill_dir=None
+    ):
+        assert workers >= 1, "workers must be at least 1"
+        assert max_pending >= 1, "max_pending must be at least 1"
+        assert backpressure in (BLOCK, DROP_OLDEST, SPILL), (
+            "unknown backpressure policy: %r" % (backpressure,))
+        assert ordering in ('room', 'message'), (
+            "unknown ordering: %r" % (ordering,))
+
+        self.logger = logger.getChild('ActivityDispatcher')
+        self.max_pending = max_pending
+        self.backpressure = backpressure
+        self.ordering = ordering
+        self.spill_dir = spill_dir
+
+        self._lanes = {}
+        self._ready = collections.deque()
+        self._depth = 0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self.closed = False
+
+        self.submitted = 0
+        self.dispatched = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.errors = 0
+        self.max_depth = 0
+
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(
+                name="ChatExchange: ActivityDispatcher worker #{}".format(i),
+                target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, room_id, on_activity, activity):
+        """
+        Queues on_activity(activity) to be called by a worker thread.
+        """
+        if self.ordering == 'message':
+            for key, message_activity in self._split_by_message(room_id, activity):
+                self._submit(key, on_activity, message_activity)
+        else:
+            self._submit(str(room_id), on_activity, activity)
+
+    @staticmethod
+    def _split_by_message(room_id, activity):
+        room_key = 'r%s' % (room_id,)
+        room_activity = activity.get(room_key)
+        if not room_activity or not room_activity.get('e'):
+            return [(str(room_id), activity)]
+
+        by_message = collections.OrderedDict()
+        for event_data in room_activity['e']:
+            message_id = event_data.get('message_id') if event_data else None
+            by_message.setdefault(message_id, []).append(event_data)
+
+        return [
+            ((str(room_id), message_id), {room_key: dict(room_activity, e=events_data)})
+            for message_id, events_data in by_message.items()
+        ]
+
+    def _submit(self, key, on_activity, activity):
+        with self._cond:
+            if self.closed:
+                raise RuntimeError("dispatcher is closed")
+            self.submitted += 1
+
+            lane = self._lanes.get(key)
+            # keep a key's activity in order behind whatever is on disk
+            spill = lane is not None and lane.spill is not None
+            if not spill:
+                while self._depth >= self.max_pending and self.backpressure == BLOCK:
+                    self._cond.wait()
+                if self._depth >= self.max_pending:
+                    if self.backpressure == DROP_OLDEST:
+                        self._drop_oldest()
+                    else:
+                        spill = True
+
+            # the lane may have been finished with while we waited
+            lane = self._lanes.get(key)
+            if lane is None:
+                lane = self._lanes[key] = _Lane()
+
+            if spill:
+                self._spill(lane, on_activity, activity)
+            else:
+                lane.items.append((next(self._seq), on_activity, activity))
+                self._depth += 1
+                self.max_depth = max(self.max_depth, self._depth)
+
+            self._schedule(key, lane)
+
+    def _schedule(self, key, lane):
+        if not lane.busy and not lane.queued and (
+                lane.items or lane.spilled_callbacks):
+            lane.queued = True
+            self._ready.append(key)
+            self._cond.notify_all()
+
+    def _drop_oldest(self):
+        oldest = min(
+            (lane for lane in self._lanes.values() if lane.items),
+            key=lambda lane: lane.items[0][0])
+        oldest.items.popleft()
+        self._depth -= 1
+        self.dropped += 1
+        self.logger.warning("Dropped activity; %d items are waiting.", self._depth)
+
+    def _spill(self, lane, on_activity, activity):
+        if lane.spill is None:
+            lane.spill = tempfile.TemporaryFile(
+                'w+', prefix='chatexchange-', dir=self.spill_dir)
+            lane.spill_read_pos = 0
+        lane.spill.seek(0, 2)
+        lane.spill.write(json.dumps(activity) + '\n')
+        lane.spilled_callbacks.append(on_activity)
+        self.spilled += 1
+
+    def _unspill(self, lane):
+        lane.spill.seek(lane.spill_read_pos)
+        activity = json.loads(lane.spill.readline())
+        lane.spill_read_pos = lane.spill.tell()
+        on_activity = lane.spilled_callbacks.popleft()
+        if not lane.spilled_callbacks:
+            lane.spill.close()
+            lane.spill = None
+        return on_activity, activity
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self.closed:
+                    self._cond.wait()
+                if not self._ready:
+                    return
+
+                key = self._ready.popleft()
+                lane = self._lanes[key]
+                lane.queued = False
+                if not lane.items and not lane.spilled_callbacks:
+                    # everything it had was dropped
+                    if not lane.busy:
+                        del self._lanes[key]
+                    continue
+                lane.busy = True
+                if lane.items:
+                    _, on_activity, activity = lane.items.popleft()
+                    self._depth -= 1
+                    self._cond.notify_all()
+                else:
+                    on_activity, activity = self._unspill(lane)
+
+            try:
+                on_activity(activity)
+            except Exception:
+                self.errors += 1
+                self.logger.exception(
+                    "ignored unhandled exception handling activity for %r", key)
+
+            with self._cond:
+                self.dispatched += 1
+                lane.busy = False
+                if lane.items or lane.spilled_callbacks:
+                    self._schedule(key, lane)
+                else:
+                    del self._lanes[key]
+
+    def close(self, wait=True):
+        """
+        Stops the workers once everything already submitted is handled.
+        """
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self.threads:
+                if thread is not threading.current_thread():
+                    thread.join()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'depth': self._depth,
+                'max_depth': self.max_depth,
+                'depth_by_key': dict(
+                    (key, len(lane.items) + len(lane.spilled_callbacks))
+                    for key, lane in self._lanes.items()),
+                'spilled_pending': sum(
+                    len(lane.spilled_callbacks) for lane in self._lanes.values()),
+                'submitted': self.submitted,
+                'dispatched': self.dispatched,
+                'dropped': self.dropped,
+                'spilled': self.spilled,
+                'errors': self.errors,
+            }
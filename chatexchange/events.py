@@ -1,6 +1,9 @@
+import itertools
 import logging
+import re
+import threading
 
-from . import messages
+from . import _utils, messages
 
 
 logger = logging.getLogger(__name__)
@@ -30,10 +33,207 @@ def register_type(event_type):
     return event_type
 
 
+class EventFilter(object):
+    """
+    Selects events by their raw data, so that events nobody wants can be
+    dropped before an Event is made for them.
+
+    An event must match every criterion given:
+
+     - types: event type ids or Event subclasses (a subclass also
+       selects every registered type derived from it)
+     - user_ids: ids of the users the events are from
+     - content: a regular expression searched for in the event content;
+       events without content never match it
+    """
+    def __init__(self, types=None, user_ids=None, content=None):
+        self.type_ids = self._type_ids(types)
+        self.user_ids = None if user_ids is None else frozenset(user_ids)
+        if content is not None and not hasattr(content, 'search'):
+            content = re.compile(content)
+        self.content = content
+
+    @staticmethod
+    def _type_ids(selected):
+        if selected is None:
+            return None
+        if isinstance(selected, (int, type)):
+            selected = [selected]
+        type_ids = set()
+        for type_ in selected:
+            if not isinstance(type_, type):
+                type_ids.add(type_)
+            elif type_ is Event:
+                return None
+            else:
+                type_ids.update(
+                    type_id for type_id, cls in types.items()
+                    if issubclass(cls, type_))
+        return frozenset(type_ids)
+
+    def matches(self, data):
+        if self.type_ids is not None and data['event_type'] not in self.type_ids:
+            return False
+        if self.user_ids is not None and data.get('user_id') not in self.user_ids:
+            return False
+        if self.content is not None:
+            content = data.get('content')
+            if content is None or not self.content.search(content):
+                return False
+        return True
+
+
+# Returned by an EventBus handler to stop later handlers seeing the event.
+STOP = object()
+
+
+class Subscription(object):
+    """
+    A handler registered with an L{EventBus}.
+    """
+    def __init__(self, bus, handler, keys, order, seq):
+        self.bus = bus
+        self.handler = handler
+        self.keys = keys
+        self.order = order
+        self.seq = seq
+        self.active = True
+
+    def cancel(self):
+        self.bus.unsubscribe(self)
+
+    def __repr__(self):
+        return 'Subscription(%r, order=%r)' % (self.handler, self.order)
+
+
+class EventBus(object):
+    """
+    Dispatches events from any number of rooms to handlers subscribed
+    by event type, room id and user id.
+
+    Handlers are indexed by those three values, so finding the handlers
+    for an event is a few dict lookups however many are subscribed. They
+    are called as handler(event, client), in ascending order and then in
+    the order they subscribed. A handler can return L{STOP} to keep the
+    event from the handlers after it.
+    """
+    # how many (type, room, user) combinations to remember handlers for
+    max_cached_chains = 10000
+
+    def __init__(self, client):
+        self.client = client
+        self._logger = logger.getChild('EventBus')
+        # (type_id, room_id, user_id), with None for any -> Subscriptions
+        self._index = {}
+        # (type_id, room_id, user_id) -> sorted Subscriptions that apply
+        self._chains = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def subscribe(self, handler, types=None, room_ids=None, user_ids=None, order=0):
+        """
+        Calls handler for every event matching all of the given types
+        (ids or Event subclasses), room ids and user ids; each may be a
+        single value, a list, or None for any.
+
+        @rtype: L{Subscription}
+        """
+        type_ids = EventFilter._type_ids(types)
+        keys = [
+            (type_id, room_id, user_id)
+            for type_id in ([None] if type_ids is None else sorted(type_ids))
+            for room_id in self._values(room_ids)
+            for user_id in self._values(user_ids)
+        ]
+        with self._lock:
+            subscription = Subscription(
+                self, handler, keys, order, next(self._seq))
+            for key in keys:
+                self._index.setdefault(key, []).append(subscription)
+            self._chains = {}
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscription.active = False
+            for key in subscription.keys:
+                subscriptions = self._index.get(key, [])
+                if subscription in subscriptions:
+                    subscriptions.remove(subscription)
+                if not subscriptions:
+                    self._index.pop(key, None)
+            self._chains = {}
+
+    @staticmethod
+    def _values(ids):
+        if ids is None:
+            return [None]
+        if not isinstance(ids, (list, tuple, set, frozenset)):
+            # a single id, whether an int, a Python 2 long or a string
+            return [ids]
+        return list(ids)
+
+    def handlers_for(self, type_id, room_id, user_id):
+        """
+        Returns the Subscriptions that apply to an event, in call order.
+        """
+        key = (type_id, room_id, user_id)
+        chains = self._chains
+        chain = chains.get(key)
+        if chain is None:
+            matching = set()
+            for type_key in (type_id, None):
+                for room_key in (room_id, None):
+                    for user_key in (user_id, None):
+                        matching.update(
+                            self._index.get((type_key, room_key, user_key), ()))
+            chain = sorted(matching, key=lambda s: (s.order, s.seq))
+            if len(chains) >= self.max_cached_chains:
+                chains.clear()
+            chains[key] = chain
+        return chain
+
+    def publish_data(self, data):
+        """
+        Dispatches an event given its raw data. The Event is only made
+        if some handler wants it.
+        """
+        chain = self.handlers_for(
+            data['event_type'], data.get('room_id'), data.get('user_id'))
+        if chain:
+            self._call(make(data, self.client), chain)
+
+    def publish(self, event):
+        """
+        Dispatches an Event.
+        """
+        self._call(event, self.handlers_for(
+            event.type_id, event.room_id, event.user_id))
+
+    def _call(self, event, chain):
+        for subscription in chain:
+            if not subscription.active:
+                continue
+            try:
+                result = subscription.handler(event, self.client)
+            except Exception:
+                self._logger.exception(
+                    "%r raised an exception handling %r", subscription, event)
+                continue
+            if result is STOP:
+                break
+
+
 class Event(object):
-    def __init__(self, data, client):
-        self.logger = logger.getChild(type(self).__name__)
+    """
+    An event from a chat room.
 
+    type_id, id, time_stamp, room_id and user_id are read from the event
+    data straight away. The Room, User and Message objects the event is
+    about are only looked up (and, for messages, updated with what the
+    event says about them) when they're first accessed.
+    """
+    def __init__(self, data, client):
         assert data, "empty data passed to Event constructor"
 
         self.client = client
@@ -45,14 +245,33 @@ class Event(object):
             self.type_id = data['event_type']
 
         self.id = data['id']
-        if 'room_id' in data:
-            self.room = client.get_room(data['room_id'], name=data['room_name'])
-        else:
-            self.room = None
+        self.room_id = data.get('room_id', None)
+        self.user_id = data.get('user_id', None)
         self.time_stamp = data['time_stamp']
 
         self._init_from_data()
 
+    @property
+    def logger(self):
+        return logger.getChild(type(self).__name__)
+
+    room = _utils.LazyFrom('_load_room')
+    user = _utils.LazyFrom('_load_user')
+
+    def _load_room(self):
+        if self.room_id is not None:
+            self.room = self.client.get_room(
+                self.room_id, name=self.data['room_name'])
+        else:
+            self.room = None
+
+    def _load_user(self):
+        if self.user_id is not None:
+            self.user = self.client.get_user(
+                self.user_id, name=self.data['user_name'])
+        else:
+            self.user = None
+
     def _init_from_data(self):
         """
         Initializes any type-specific fields from self.data.
@@ -69,13 +288,8 @@ class MessageEvent(Event):
     Base class for events about Messages.
     """
     def _init_from_data(self):
-        if 'user_id' in self.data:
-            self.user = self.client.get_user(
-                self.data['user_id'], name=self.data['user_name'])
-        else:
-            self.user = None
         self.content = self.data.get('content', None)
-        self._message_id = self.data['message_id']
+        self.message_id = self._message_id = self.data['message_id']
         self._message_edits = self.data.get('message_edits', 0)
         self.show_parent = self.data.get('show_parent', False)
         self._message_stars = self.data.get('message_stars', 0)
@@ -83,9 +297,22 @@ class MessageEvent(Event):
         self.target_user_id = self.data.get('target_user_id', None)
         self.parent_message_id = self.data.get('parent_id', None)
 
-        self.message = self.client.get_message(self._message_id)
+        if self.message_id in self.client._messages:
+            # Keep messages that are already known up to date, even if
+            # nothing looks at this event.
+            self.message
 
-        self._update_message()
+    message = _utils.LazyFrom('_load_message')
+
+    def _load_message(self):
+        self.message = self.client.get_message(self.message_id)
+
+        # Events may be materialized out of order; don't let an older
+        # one overwrite what a newer one has told us.
+        last_event_id = getattr(self.message, '_last_event_id', None)
+        if last_event_id is None or last_event_id <= self.id:
+            self.message._last_event_id = self.id
+            self._update_message()
 
     def _update_message(self):
         # XXX: assuming Event has newer information than Message.
@@ -100,7 +327,7 @@ class MessageEvent(Event):
         pinned = self._message_owner_stars > 0
 
         if pinned:
-            if not messages.Message.pinned.values.get(message):
+            if not messages.Message.pinned.peek(message):
                 # If it just became pinned but was previously known unpinned,
                 # these cached pin details will be stale if set.
                 try:
@@ -152,19 +379,11 @@ class MessageEdited(MessageEvent):
 class UserEntered(Event):
     type_id = 3
 
-    def _init_from_data(self):
-        self.user = self.client.get_user(
-            self.data['user_id'], name=self.data['user_name'])
-
 
 @register_type
 class UserLeft(Event):
     type_id = 4
 
-    def _init_from_data(self):
-        self.user = self.client.get_user(
-            self.data['user_id'], name=self.data['user_name'])
-
 
 @register_type
 class RoomNameChanged(Event):
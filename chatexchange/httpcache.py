@@ -0,0 +1,287 @@
+"""
+An HTTP cache for the GET requests a Browser makes, honoring ETag,
+Last-Modified and Cache-Control, with per-endpoint freshness overrides.
+"""
+import base64
+import email.utils
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import requests
+import requests.adapters
+import requests.structures
+import requests.utils
+
+from . import _utils
+
+
+logger = logging.getLogger(__name__)
+
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+class CacheEntry(object):
+    """
+    A stored response, and until when it may be used without asking
+    the server whether it has changed.
+    """
+    def __init__(self, url, status_code, reason, headers, content, fresh_until):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = requests.structures.CaseInsensitiveDict(headers)
+        self.content = content
+        self.fresh_until = fresh_until
+
+    def is_fresh(self):
+        return self.fresh_until is not None and time.time() < self.fresh_until
+
+    def validators(self):
+        """
+        Returns the headers that make a request conditional on the
+        stored response having changed.
+        """
+        validators = {}
+        if 'ETag' in self.headers:
+            validators['If-None-Match'] = self.headers['ETag']
+        if 'Last-Modified' in self.headers:
+            validators['If-Modified-Since'] = self.headers['Last-Modified']
+        return validators
+
+    def to_response(self, request):
+        response = requests.Response()
+        response.status_code = self.status_code
+        response.reason = self.reason
+        response.headers = requests.structures.CaseInsensitiveDict(self.headers)
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response._content = self.content
+        response.url = self.url
+        response.request = request
+        response.from_cache = True
+        return response
+
+    def to_json(self):
+        return json.dumps({
+            'url': self.url,
+            'status_code': self.status_code,
+            'reason': self.reason,
+            'headers': dict(self.headers),
+            'content': base64.b64encode(self.content).decode('ascii'),
+            'fresh_until': self.fresh_until,
+        })
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        return cls(
+            data['url'], data['status_code'], data['reason'], data['headers'],
+            base64.b64decode(data['content']), data['fresh_until'])
+
+
+class DiskStore(object):
+    """
+    Keeps cache entries as files in a directory.
+
+    Cached pages can be specific to the logged-in user, so a directory
+    should only be shared by Browsers logged in as the same user.
+    """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file_path(self, url):
+        return os.path.join(
+            self.path, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, url):
+        try:
+            with open(self._file_path(url)) as f:
+                entry = CacheEntry.from_json(f.read())
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        # guard against hash collisions
+        return entry if entry.url == url else None
+
+    def put(self, url, entry):
+        file_path = self._file_path(url)
+        temporary_path = '%s.%s.tmp' % (file_path, threading.current_thread().ident)
+        with open(temporary_path, 'w') as f:
+            f.write(entry.to_json())
+        _replace(temporary_path, file_path)
+
+    def pop(self, url):
+        try:
+            os.remove(self._file_path(url))
+        except OSError:
+            pass
+
+
+class CachingAdapter(requests.adapters.HTTPAdapter):
+    """
+    A transport adapter that answers GET requests from a cache.
+
+    A stored response is used as is while it is fresh: for the TTL of
+    the first of ttls' (url regex, seconds) pairs matching its URL's
+    path, if any, otherwise for as long as its Cache-Control max-age
+    or Expires header allows. Once stale, it's revalidated with
+    If-None-Match/If-Modified-Since if it has an ETag or Last-Modified,
+    and a 304 response refreshes it.
+
+    Entries are kept in memory, up to maxsize of them, least recently
+    used first out, and also in a L{DiskStore} at disk_path if given.
+    """
+    cacheable_statuses = frozenset([200, 203, 300, 301, 410])
+
+    def __init__(self, maxsize=1000, disk_path=None, ttls=(), **kwargs):
+        super(CachingAdapter, self).__init__(**kwargs)
+        self.logger = logger.getChild('CachingAdapter')
+        self.memory = _utils.LRUCache(maxsize)
+        self.disk = DiskStore(disk_path) if disk_path is not None else None
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in ttls]
+
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+
+    def _get_entry(self, url):
+        entry = self.memory.get(url)
+        if entry is None and self.disk is not None:
+            entry = self.disk.get(url)
+            if entry is not None:
+                self.memory.put(url, entry)
+        return entry
+
+    def _put_entry(self, url, entry):
+        self.memory.put(url, entry)
+        if self.disk is not None:
+            self.disk.put(url, entry)
+
+    def _pop_entry(self, url):
+        self.memory.pop(url)
+        if self.disk is not None:
+            self.disk.pop(url)
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET':
+            return super(CachingAdapter, self).send(request, **kwargs)
+
+        url = request.url
+        entry = self._get_entry(url)
+        if entry is not None and entry.is_fresh():
+            self._count('hits')
+            self.logger.debug("Using cached response for %s", url)
+            return entry.to_response(request)
+
+        if entry is not None:
+            request.headers.update(entry.validators())
+
+        response = super(CachingAdapter, self).send(request, **kwargs)
+
+        if entry is not None and response.status_code == 304:
+            self._count('revalidations')
+            headers = requests.structures.CaseInsensitiveDict(entry.headers)
+            headers.update(response.headers)
+            entry = CacheEntry(
+                url, entry.status_code, entry.reason, headers, entry.content,
+                self._fresh_until(url, headers))
+            self._put_entry(url, entry)
+            response.close()
+            return entry.to_response(request)
+
+        self._count('misses')
+        self._store(url, response)
+        return response
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _store(self, url, response):
+        cache_control = self._cache_control(response.headers)
+        if response.status_code not in self.cacheable_statuses or (
+                'no-store' in cache_control
+                or response.headers.get('Vary', '').strip() == '*'):
+            self._pop_entry(url)
+            return
+
+        fresh_until = self._fresh_until(url, response.headers)
+        if fresh_until is None and 'ETag' not in response.headers and (
+                'Last-Modified' not in response.headers):
+            # it could never be used
+            self._pop_entry(url)
+            return
+
+        # reading .content here keeps the body for the caller too
+        self._put_entry(url, CacheEntry(
+            url, response.status_code, response.reason,
+            dict(response.headers), response.content, fresh_until))
+
+    def _fresh_until(self, url, headers):
+        """
+        Returns the time until which a response is fresh, or None if it
+        must be revalidated before every use.
+        """
+        path = requests.utils.urlparse(url).path
+        for pattern, ttl in self.ttls:
+            if pattern.search(path):
+                return time.time() + ttl
+
+        cache_control = self._cache_control(headers)
+        if 'no-cache' in cache_control:
+            return None
+
+        max_age = cache_control.get('max-age')
+        if max_age is not None:
+            try:
+                max_age = int(max_age)
+            except ValueError:
+                return None
+            age = headers.get('Age', '0')
+            return time.time() + max_age - (int(age) if age.isdigit() else 0)
+
+        expires = self._parse_date(headers.get('Expires'))
+        if expires is not None:
+            date = self._parse_date(headers.get('Date'))
+            if date is not None:
+                return time.time() + expires - date
+            return expires
+
+        return None
+
+    @staticmethod
+    def _cache_control(headers):
+        directives = {}
+        for directive in headers.get('Cache-Control', '').split(','):
+            name, _, value = directive.strip().partition('=')
+            if name:
+                directives[name.lower()] = value.strip('"') or None
+        return directives
+
+    @staticmethod
+    def _parse_date(value):
+        if not value:
+            return None
+        parsed = email.utils.parsedate_tz(value)
+        if parsed is None:
+            return None
+        return email.utils.mktime_tz(parsed)
+
+    def stats(self):
+        memory_stats = self.memory.stats()
+        with self._lock:
+            return {
+                'size': memory_stats['size'],
+                'maxsize': memory_stats['maxsize'],
+                'evictions': memory_stats['evictions'],
+                'hits': self.hits,
+                'revalidations': self.revalidations,
+                'misses': self.misses,
+            }
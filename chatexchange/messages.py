@@ -1,16 +1,35 @@
 import logging
 
-from . import _utils
+from . import _utils, actions
 
 
 logger = logging.getLogger(__name__)
 
 
 class Message(object):
+    # __dict__ is kept so that attributes set by events and by users
+    # of the library still work.
+    __slots__ = (
+        'id', '_client', 'starred', '_last_event_id', '_bypass_store',
+        '__dict__', '__weakref__',
+    ) + _utils.lazy_slots(
+        'room', 'content', 'owner', '_parent_message_id', 'stars',
+        'starred_by_you', 'pinned', 'content_source', 'editor', 'edited',
+        'edits', 'pins', 'pinners', 'time_stamp')
+
+    _logger = logger.getChild('Message')
+
     def __init__(self, id, client):
         self.id = id
-        self._logger = logger.getChild('Message')
         self._client = client
+        self._bypass_store = False
+
+    def __delattr__(self, name):
+        super(Message, self).__delattr__(name)
+        if isinstance(getattr(Message, name, None), _utils.LazyFrom):
+            # Whoever deleted it wants a fresh value, which the client's
+            # store may not have; the next scrape goes to the network.
+            self._bypass_store = True
 
     room = _utils.LazyFrom('scrape_transcript')
     content = _utils.LazyFrom('scrape_transcript')
@@ -28,9 +47,23 @@ class Message(object):
     pinners = _utils.LazyFrom('scrape_history')
     time_stamp = _utils.LazyFrom('scrape_history')
 
+    # The attributes each scrape sets, used to tell whether the client's
+    # store knew enough to make the scrape unnecessary.
+    _history_attributes = (
+        'content_source', 'editor', 'edited', 'edits', 'pins', 'pinners')
+    _transcript_attributes = (
+        'room', 'content', 'owner', '_parent_message_id', 'stars',
+        'starred_by_you', 'pinned')
+
     def scrape_history(self):
+        if self._load_from_store(self._history_attributes):
+            return
         data = self._client._br.get_history(self.id)
+        if self._client.store is not None:
+            self._client.store.record_history(self.id, data)
+        self._apply_history(data)
 
+    def _apply_history(self, data):
         self.owner = self._client.get_user(
             data['owner_user_id'], name=data['owner_user_name'])
         self.room = self._client.get_room(data['room_id'])
@@ -57,44 +90,100 @@ class Message(object):
         # TODO: self.time_stamp = ...
 
     def scrape_transcript(self):
+        if self._load_from_store(self._transcript_attributes):
+            return
         data = self._client._br.get_transcript_with_message(self.id)
+        if self._client.store is not None:
+            self._client.store.record_transcript(data)
+        self._apply_transcript(data)
 
+    def _apply_transcript(self, data):
         self.room = self._client.get_room(
             data['room_id'], name=data['room_name'])
 
         for message_data in data['messages']:
-            message_id = message_data['id']
-
-            message = self._client.get_message(message_id)
-
-            message.owner = self._client.get_user(
+            message = self._client.get_message(message_data['id'])
+            message._apply_message_data(message_data)
+
+    def _load_from_store(self, attributes):
+        """
+        Applies what the client's store knows about this message,
+        returning whether that included all of the given attributes.
+        """
+        store = self._client.store
+        if store is None:
+            return False
+
+        if self._bypass_store:
+            self._bypass_store = False
+            return False
+
+        message_data = store.get(self.id)
+        if message_data is None or not all(
+                key in message_data for key in self._required_keys):
+            return False
+
+        self._apply_message_data(message_data)
+        loaded = all(getattr(Message, name).is_loaded(self) for name in attributes)
+        if not loaded:
+            self._logger.debug(
+                "Store has incomplete data for message_id #%r", self.id)
+        return loaded
+
+    # What _apply_message_data needs; local changes recorded in the store
+    # can leave it with less for messages it knew nothing else about.
+    _required_keys = ('edited', 'content', 'stars', 'starred', 'pinned')
+
+    def _record(self, **message_data):
+        """
+        Records state changed locally in the client's store, if any.
+        """
+        if self._client.store is not None:
+            message_data['id'] = self.id
+            self._client.store.record(message_data)
+
+    def _apply_message_data(self, message_data):
+        """
+        Applies data in the form of a transcript page's 'messages', or
+        as kept by a L{store.MessageStore}, where every key but 'id',
+        'edited', 'content' and the star data may be missing.
+        """
+        if 'owner_user_id' in message_data:
+            self.owner = self._client.get_user(
                 message_data['owner_user_id'], name=message_data['owner_user_name'])
-            message.room = self._client.get_room(
+        if 'room_name' in message_data:
+            self.room = self._client.get_room(
                 message_data['room_id'], name=message_data['room_name'])
+        elif 'room_id' in message_data:
+            self.room = self._client.get_room(message_data['room_id'])
+
+        if message_data['edited']:
+            if not Message.edited.peek(self):
+                # If it was edited but not previously known to be edited,
+                # these might have cached outdated None/0 no-edit values.
+                del self.editor
+                del self.edits
+
+        if 'editor_user_id' in message_data:
+            if message_data['editor_user_id'] is not None:
+                self.editor = self._client.get_user(
+                    message_data['editor_user_id'], name=message_data['editor_user_name'])
+            else:
+                self.editor = None
+        if 'edits' in message_data:
+            self.edits = message_data['edits']
 
-            if message_data['edited']:
-                if not Message.edited.values.get(message):
-                    # If it was edited but not previously known to be edited,
-                    # these might have cached outdated None/0 no-edit values.
-                    del message.editor
-                    del message.edits
-
-            if 'editor_user_id' in message_data:
-                if message_data['editor_user_id'] is not None:
-                    message.editor = self._client.get_user(
-                        message_data['editor_user_id'], name=message_data['editor_user_name'])
-                else:
-                    message.editor = None
-            if 'edits' in message_data:
-                message.edits = message_data['edits']
-
-            message.edited = message_data['edited']
-            message.content = message_data['content']
-            message._scrape_stars(message_data)
+        self.edited = message_data['edited']
+        self.content = message_data['content']
+        if 'content_source' in message_data:
+            self.content_source = message_data['content_source']
+        self._scrape_stars(message_data)
 
-            message._parent_message_id = message_data['parent_message_id']
+        if 'parent_message_id' in message_data:
+            self._parent_message_id = message_data['parent_message_id']
 
-            # TODO: message.time_stamp = ...
+        if 'time_stamp' in message_data:
+            self.time_stamp = message_data['time_stamp']
 
     def _scrape_stars(self, data):
         self.starred = data['starred']
@@ -103,7 +192,7 @@ class Message(object):
         if 'starred_by_you' in data:
             self.starred_by_you = data['starred_by_you']
 
-        if data['pinned'] and not Message.pinned.values.get(self):
+        if data['pinned'] and not Message.pinned.peek(self):
             # If it just became pinned but was previously known unpinned,
             # these cached pin details will be stale if set.
             del self.pinners
@@ -130,19 +219,58 @@ class Message(object):
         if self.content is not None:
             return _utils.html_to_text(self.content)
 
-    def reply(self, text, length_check=True):
-        self.room.send_message(
-            ":%s %s" % (self.id, text), length_check)
-
-    def edit(self, text):
-        self._client._request_queue.put(('edit', self.id, text))
+    def reply(self, text, length_check=True, priority=actions.PRIORITY_NORMAL):
+        return self.room.send_message(
+            ":%s %s" % (self.id, text), length_check, priority)
+
+    def _request_queue(self):
+        """
+        Returns the queue for this message's room, if the room is already
+        known, without scraping to find out.
+        """
+        room = Message.room.peek(self)
+        return self._client._lane(room.id if room is not None else None).queue
+
+    def edit(self, text, priority=actions.PRIORITY_NORMAL):
+        """
+        Edits the message (queued, to avoid getting throttled)
+
+        If an earlier edit of this message is still queued, it is changed
+        to use this text instead, and both futures share its result. It
+        keeps whichever of the two priorities is higher.
+
+        @return: A future for the final response.
+        @rtype: L{concurrent.futures.Future}
+        """
+        action = actions.ChatAction('edit', self.id, text, priority=priority)
+        request_queue = self._request_queue()
+        if self._client._coalesce_edit(action, request_queue):
+            self._logger.info(
+                "Replaced queued edit for message_id #%r with %r.", self.id, text)
+            return action.future
+        request_queue.put(action)
         self._logger.info("Queued edit %r for message_id #%r.", text, self.id)
-        self._logger.info("Queue length: %d.", self._client._request_queue.qsize())
-
-    def delete(self):
-        self._client._request_queue.put(('delete', self.id, ''))
+        self._logger.info("Queue length: %d.", request_queue.qsize())
+        return action.future
+
+    def delete(self, priority=actions.PRIORITY_HIGH):
+        """
+        Deletes the message (queued, to avoid getting throttled)
+
+        Any edit of this message that is still queued is cancelled.
+
+        @return: A future for the final response.
+        @rtype: L{concurrent.futures.Future}
+        """
+        if self._client._drop_pending_edits(self.id):
+            self._logger.info(
+                "Cancelled queued edit for message_id #%r.", self.id)
+        request_queue = self._request_queue()
+        action = actions.ChatAction('delete', self.id, '', priority=priority)
+        request_queue.put(action)
         self._logger.info("Queued deletion for message_id #%r.", self.id)
-        self._logger.info("Queue length: %d.", self._client._request_queue.qsize())
+        self._logger.info("Queue length: %d.", request_queue.qsize())
+        return action.future
 
     def star(self, value=True):
         del self.starred_by_you  # don't use cached value
@@ -152,16 +280,19 @@ class Message(object):
 
             self.starred_by_you = value
 
-            if self in Message.stars.values:
+            if Message.stars.is_loaded(self):
                 if value:
                     self.stars += 1
                 else:
                     self.stars -= 1
 
                 self.starred = bool(self.stars)
+                self._record(
+                    starred_by_you=value, stars=self.stars, starred=self.starred)
             else:
                 # bust potential stale cached values
                 del self.starred
+                self._record(starred_by_you=value)
         else:
             self._logger.info(".starred_by_you is already %r", value)
 
@@ -171,8 +302,8 @@ class Message(object):
             self._client._br.toggle_pinning(self.id)
             # we assume this was successfully
 
-            if self in Message.pins.values:
-                assert self in Message.pinners.values
+            if Message.pins.is_loaded(self):
+                assert Message.pinners.is_loaded(self)
                 me = self._client.get_me()
 
                 if value:
@@ -182,11 +313,16 @@ class Message(object):
                     self.pins -= 1
                     self.pinners.remove(me)
 
-                self.pinned = bool(self.pinned)
+                self.pinned = value
+                self._record(
+                    pinned=value, pins=self.pins,
+                    pinner_user_ids=[user.id for user in self.pinners],
+                    pinner_user_names=[user.name for user in self.pinners])
             else:
                 # bust potential stale cached values
                 del self.pinned
                 del self.pinners
+                self._record(pinned=value)
         else:
             self._logger.info(".pinned is already %r", value)
 
@@ -202,5 +338,8 @@ class Message(object):
             self.pinned = False
             self.pins = 0
             self.pinners = []
+            self._record(
+                starred_by_you=False, stars=0, starred=False, pinned=False,
+                pins=0, pinner_user_ids=[], pinner_user_names=[])
         else:
             self._logger.info(".stars is already 0")
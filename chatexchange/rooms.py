@@ -3,18 +3,27 @@ if sys.version_info[0] == 2:
     import Queue as queue
 else:
     import queue
+import concurrent.futures
 import logging
 
-from . import _utils, events, markdown_detector
+from . import _utils, actions, events, markdown_detector
 
 
 logger = logging.getLogger(__name__)
 
 
 class Room(object):
+    __slots__ = (
+        'id', '_client', 'send_aggressively', '__dict__',
+        '__weakref__',
+    ) + _utils.lazy_slots(
+        'name', 'description', 'message_count', 'user_count',
+        'parent_site_name', 'owners', 'tags')
+
+    _logger = logger.getChild('Room')
+
     def __init__(self, id, client):
         self.id = id
-        self._logger = logger.getChild('Room')
         self._client = client
         self.send_aggressively = client.aggressive_sender
 
@@ -28,7 +37,9 @@ class Room(object):
 
     def scrape_info(self):
         data = self._client._br.get_room_info(self.id)
+        self._apply_info(data)
 
+    def _apply_info(self, data):
         self.name = data['name']
         self.description = data['description']
         self.message_count = data['message_count']
@@ -58,14 +69,16 @@ class Room(object):
         """
         if message1 is None or message2 is None:
             return False
-        op1, room1, msg1 = message1
-        op2, room2, msg2 = message2
+        op1, room1, msg1 = message1.action_type, message1.target_id, message1.text
+        op2, room2, msg2 = message2.action_type, message2.target_id, message2.text
         if op1 != 'send':
             return False
         if op2 != 'send':
             return False
         if room1 != room2:
             return False
+        if message1.priority != message2.priority:
+            return False
         # If one starts with four spaces, the other also needs to start with four spaces
         indent1 = msg1.startswith('    ')
         indent2 = msg2.startswith('    ')
@@ -80,62 +93,118 @@ class Room(object):
             return False
         return True
 
-    def send_message(self, text, length_check=True):
+    def send_message(self, text, length_check=True, priority=actions.PRIORITY_NORMAL):
         """
         Sends a message (queued, to avoid getting throttled)
         @ivar text: The message to send
         @type text: L{str}
+        @ivar priority: Where to queue the message relative to other
+                        actions; see L{actions.PriorityPeekableQueue}
+        @return: A future for the new message's id.
+        @rtype: L{concurrent.futures.Future}
         """
         if len(text) > 500 and length_check and '\n' not in text:
             self._logger.info("Could not send message because it was longer than 500 characters.")
-            return
+            return self._failed_future("message is longer than 500 characters")
         if len(text) == 0:
             self._logger.info("Could not send message because it was empty.")
-            return
+            return self._failed_future("message is empty")
+        request_queue = self._client._lane(self.id).queue
+        action = actions.ChatAction('send', self.id, text, priority=priority)
         if self.send_aggressively:
-            previous_request = self._client._request_queue.peek_latest()
-            if self._mergeable_pair(previous_request, ('send', self.id, text)):
-                merged_text = '\n'.join([previous_request[2], text])
+            previous_request = request_queue.peek_latest(priority)
+            if self._mergeable_pair(previous_request, action):
+                merged_text = '\n'.join([previous_request.text, text])
                 if (not length_check or len(merged_text) <= 500) and \
-                    self._client._request_queue.poke_latest(previous_request, (
-                        tuple(list(previous_request[0:2]) + [merged_text]))):
+                    request_queue.poke_latest(previous_request, actions.ChatAction(
+                        'send', self.id, merged_text,
+                        previous_request.futures + action.futures, priority)):
                     self._logger.info(
                         "Merging message %r for room_id #%r to previous queued message",
                         text, self.id)
-                    return
-        self._client._request_queue.put(('send', self.id, text))
+                    return action.future
+        request_queue.put(action)
         self._logger.info("Queued message %r for room_id #%r.", text, self.id)
-        self._logger.info("Queue length: %d.", self._client._request_queue.qsize())
+        self._logger.info("Queue length: %d.", request_queue.qsize())
+        return action.future
 
-    def watch(self, event_callback):
-        return self.watch_polling(event_callback, 3)
+    @staticmethod
+    def _failed_future(reason):
+        future = concurrent.futures.Future()
+        future.set_exception(actions.ChatActionError(reason))
+        return future
 
-    def watch_polling(self, event_callback, interval):
-        def on_activity(activity):
-            for event in self._events_from_activity(activity, self.id):
-                event_callback(event, self._client)
+    def watch(self, event_callback=None, event_filter=None):
+        return self.watch_polling(event_callback, 3, event_filter)
+
+    def watch_polling(self, event_callback, interval, event_filter=None):
+        """
+        Polls the room for events, passing each to event_callback, or
+        to the client's L{events.EventBus} if event_callback is None.
 
+        If event_filter (an L{events.EventFilter}) is given, events that
+        don't match it are dropped without being made into Events.
+        """
+        on_activity = self._activity_handler(event_callback, event_filter)
         return self._client._br.watch_room_http(self.id, on_activity, interval)
 
-    def watch_socket(self, event_callback):
-        def on_activity(activity):
-            for event in self._events_from_activity(activity, self.id):
-                event_callback(event, self._client)
+    def watch_socket(self, event_callback=None, event_filter=None):
+        """
+        Listens for events over a WebSocket, passing each to
+        event_callback, or to the client's L{events.EventBus} if
+        event_callback is None.
 
+        If event_filter (an L{events.EventFilter}) is given, events that
+        don't match it are dropped without being made into Events.
+        """
+        on_activity = self._activity_handler(event_callback, event_filter)
         return self._client._br.watch_room_socket(self.id, on_activity)
 
-    def _events_from_activity(self, activity, room_id):
+    def _activity_handler(self, event_callback, event_filter):
+        on_activity = self._event_handler(event_callback, event_filter)
+        store = self._client.store
+        if store is None:
+            return on_activity
+
+        def on_activity_recorded(activity):
+            for event_data in self._event_data_from_activity(activity, self.id):
+                store.record_event(event_data)
+            on_activity(activity)
+
+        return on_activity_recorded
+
+    def _event_handler(self, event_callback, event_filter):
+        if event_callback is None:
+            bus = self._client.bus
+
+            def on_activity(activity):
+                for event_data in self._event_data_from_activity(
+                        activity, self.id, event_filter):
+                    bus.publish_data(event_data)
+        else:
+            def on_activity(activity):
+                for event in self._events_from_activity(activity, self.id, event_filter):
+                    event_callback(event, self._client)
+
+        return on_activity
+
+    def _events_from_activity(self, activity, room_id, event_filter=None):
         """
         Returns a list of Events associated with a particular room,
         given an activity message from the server.
         """
+        for event_data in self._event_data_from_activity(
+                activity, room_id, event_filter):
+            yield events.make(event_data, self._client)
+
+    @staticmethod
+    def _event_data_from_activity(activity, room_id, event_filter=None):
         room_activity = activity.get('r%s' % (room_id,), {})
         room_events_data = room_activity.get('e', [])
         for room_event_data in room_events_data:
-            if room_event_data:
-                event = events.make(room_event_data, self._client)
-                self._client._recently_gotten_objects.appendleft(event)
-                yield event
+            if room_event_data and (
+                    event_filter is None or event_filter.matches(room_event_data)):
+                yield room_event_data
 
     def new_events(self, types=events.Event):
         return FilteredEventIterator(self, types)
@@ -143,6 +212,14 @@ class Room(object):
     def new_messages(self):
         return MessageIterator(self)
 
+    def search_messages(self, query, user_id=None, since=None, until=None, limit=100):
+        """
+        Searches this room's messages in the client's store; see
+        L{client.Client.search_messages}.
+        """
+        return self._client.search_messages(
+            query, self.id, user_id, since, until, limit)
+
     def get_pingable_users(self):
         return [
             self._client.get_user(user_id, name=name)
@@ -176,7 +253,7 @@ class FilteredEventIterator(object):
         self._queue = queue.Queue()
 
         room.join()
-        self._watcher = room.watch(self._on_event)
+        self._watcher = room.watch(self._on_event, events.EventFilter(types))
 
     def __enter__(self):
         return self
@@ -189,8 +266,7 @@ class FilteredEventIterator(object):
             yield self._queue.get()
 
     def _on_event(self, event, client):
-        if isinstance(event, self.types):
-            self._queue.put(event)
+        self._queue.put(event)
 
 
 class MessageIterator(object):
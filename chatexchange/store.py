@@ -0,0 +1,321 @@
+"""
+A local SQLite mirror of messages seen through events and scrapes.
+"""
+import json
+import logging
+import sqlite3
+import threading
+
+from . import _utils
+
+
+logger = logging.getLogger(__name__)
+
+
+class MessageStore(object):
+    """
+    Records what is known about messages in a SQLite database, so that
+    a L{client.Client} given it as its store can load messages' lazy
+    attributes without going back to Stack Exchange, across restarts.
+
+    Message data is kept in the form of the 'messages' returned by
+    L{browser.Browser.get_transcript_with_message}, merged with whatever
+    later history scrapes and events add.
+
+    Writes are batched: they are visible to get() at once, but only
+    reach the database once batch_size are waiting, every
+    flush_interval seconds, or on flush() or close().
+
+    Message ids are only unique within a chat host, so a store should
+    only be used by Clients for one host.
+
+    If SQLite was built with FTS5, the text of messages' content is
+    indexed as it is written, for L{search}.
+    """
+    # The events that carry a message's current state.
+    message_event_types = frozenset([1, 2, 6, 10, 20])
+
+    # What only a history scrape tells us, and an edit makes stale.
+    history_keys = ('content_source', 'editor_user_id', 'editor_user_name')
+
+    def __init__(self, path, batch_size=500, flush_interval=1.0):
+        self.logger = logger.getChild('MessageStore')
+        self.path = path
+        self.batch_size = batch_size
+
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._create_tables()
+
+        # message id -> data waiting to be merged into the database
+        self._pending = {}
+        # message id -> keys to drop from its data in the database
+        self._forgotten = {}
+
+        self._closed = threading.Event()
+        self._flusher = None
+        if flush_interval is not None:
+            self._flusher = threading.Thread(
+                name="ChatExchange: MessageStore flusher",
+                target=self._flush_periodically, args=(flush_interval,))
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _create_tables(self):
+        with self._connection:
+            self._connection.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY,
+                    room_id INTEGER,
+                    owner_user_id INTEGER,
+                    time_stamp INTEGER,
+                    data TEXT NOT NULL
+                )''')
+            self._connection.execute('''
+                CREATE INDEX IF NOT EXISTS messages_by_room
+                ON messages (room_id, id)''')
+
+            try:
+                self._connection.execute('''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS message_text
+                    USING fts5 (text)''')
+            except sqlite3.OperationalError:
+                self.logger.warning(
+                    "SQLite has no FTS5 support; messages can't be searched.")
+                self.searchable = False
+            else:
+                self.searchable = True
+
+    def get(self, message_id):
+        """
+        Returns everything known about a message, or None.
+
+        @rtype: L{dict}
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT data FROM messages WHERE id = ?', (message_id,)
+            ).fetchone()
+            pending = self._pending.get(message_id)
+            forgotten = self._forgotten.get(message_id, ())
+
+        if row is None:
+            return dict(pending) if pending is not None else None
+
+        message_data = json.loads(row[0])
+        for key in forgotten:
+            message_data.pop(key, None)
+        if pending is not None:
+            message_data.update(pending)
+        return message_data
+
+    def record(self, message_data, forget=()):
+        """
+        Merges message_data (which must include its 'id') into what is
+        known about the message, after dropping the keys in forget.
+        """
+        with self._lock:
+            message_id = message_data['id']
+            pending = self._pending.setdefault(message_id, {})
+            if forget:
+                forgotten = self._forgotten.setdefault(message_id, set())
+                for key in forget:
+                    pending.pop(key, None)
+                    forgotten.add(key)
+            forgotten = self._forgotten.get(message_id)
+            if forgotten:
+                forgotten.difference_update(message_data)
+            pending.update(message_data)
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+
+    def record_transcript(self, data):
+        """
+        Records the messages from a transcript page's data.
+        """
+        with self._lock:
+            for message_data in data['messages']:
+                self.record(message_data)
+
+    def record_history(self, message_id, data):
+        """
+        Records a message's data from its history page.
+        """
+        message_data = dict(data, id=message_id)
+        self.record(message_data)
+
+    def record_event(self, event_data):
+        """
+        Records the state of a message given in a raw event, if the
+        event is about a message.
+        """
+        if event_data.get('event_type') not in self.message_event_types:
+            return
+
+        stars = event_data.get('message_stars', 0)
+        edits = event_data.get('message_edits', 0)
+        pinned = event_data.get('message_owner_stars', 0) > 0
+
+        message_data = {
+            'id': event_data['message_id'],
+            'room_id': event_data['room_id'],
+            'content': event_data.get('content'),
+            'edited': bool(edits),
+            'edits': edits,
+            'stars': stars,
+            'starred': bool(stars),
+            'pinned': pinned,
+            'parent_message_id': event_data.get('parent_id'),
+        }
+        if 'room_name' in event_data:
+            message_data['room_name'] = event_data['room_name']
+        if not stars:
+            message_data['starred_by_you'] = False
+        if not pinned:
+            message_data['pins'] = 0
+            message_data['pinner_user_ids'] = []
+            message_data['pinner_user_names'] = []
+        if event_data['event_type'] == 1:
+            message_data['owner_user_id'] = event_data['user_id']
+            message_data['owner_user_name'] = event_data['user_name']
+            message_data['time_stamp'] = event_data['time_stamp']
+
+        with self._lock:
+            known = self.get(message_data['id'])
+            if known is not None and known.get('edits', edits) != edits:
+                self.record(message_data, forget=self.history_keys)
+            else:
+                self.record(message_data)
+
+    def flush(self):
+        """
+        Writes all pending data to the database.
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            forgotten, self._forgotten = self._forgotten, {}
+
+            ids = list(pending)
+            stored = {}
+            # stay under SQLite's limit on the number of parameters
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                stored.update(self._connection.execute(
+                    'SELECT id, data FROM messages WHERE id IN (%s)' % (
+                        ','.join('?' * len(chunk)),),
+                    chunk))
+
+            rows = []
+            texts = []
+            for message_id, message_data in pending.items():
+                content_changed = 'content' in message_data
+                if message_id in stored:
+                    merged = json.loads(stored[message_id])
+                    for key in forgotten.get(message_id, ()):
+                        merged.pop(key, None)
+                    content_changed = content_changed and (
+                        merged.get('content') != message_data['content'])
+                    merged.update(message_data)
+                    message_data = merged
+                rows.append((
+                    message_id, message_data.get('room_id'),
+                    message_data.get('owner_user_id'),
+                    message_data.get('time_stamp'), json.dumps(message_data)))
+                if content_changed:
+                    content = message_data['content']
+                    texts.append((
+                        message_id,
+                        _utils.html_to_text(content) if content is not None else None))
+
+            with self._connection:
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO messages '
+                    '(id, room_id, owner_user_id, time_stamp, data) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    rows)
+                if self.searchable:
+                    self._index(texts)
+
+        self.logger.debug("Wrote %d messages", len(rows))
+
+    def _index(self, texts):
+        self._connection.executemany(
+            'DELETE FROM message_text WHERE rowid = ?',
+            [(message_id,) for message_id, text in texts if text is None])
+        self._connection.executemany(
+            'INSERT OR REPLACE INTO message_text (rowid, text) VALUES (?, ?)',
+            [(message_id, text) for message_id, text in texts if text is not None])
+
+    def search(
+            self, query, room_id=None, user_id=None, since=None, until=None,
+            limit=100
+    ):
+        """
+        Returns the data of the messages whose text contains every word
+        in query, newest first, optionally only those in a room, posted
+        by a user, or posted between the since and until timestamps.
+
+        Time stamps are only known for messages seen being posted, so
+        other messages are left out when since or until is given.
+
+        @rtype: L{list} of L{dict}
+        """
+        if not self.searchable:
+            raise RuntimeError("SQLite was built without FTS5 support")
+
+        # quote each word, so that nothing in it is taken as query syntax
+        match = ' '.join(
+            '"%s"' % (word.replace('"', '""'),) for word in query.split())
+        if not match:
+            return []
+
+        conditions = ['message_text MATCH ?']
+        parameters = [match]
+        for condition, value in [
+                ('messages.room_id = ?', room_id),
+                ('messages.owner_user_id = ?', user_id),
+                ('messages.time_stamp >= ?', since),
+                ('messages.time_stamp < ?', until)]:
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        parameters.append(limit)
+
+        with self._lock:
+            self.flush()
+            rows = self._connection.execute(
+                'SELECT messages.data FROM message_text '
+                'JOIN messages ON messages.id = message_text.rowid '
+                'WHERE %s ORDER BY messages.id DESC LIMIT ?' % (
+                    ' AND '.join(conditions),),
+                parameters).fetchall()
+
+        return [json.loads(data) for data, in rows]
+
+    def _flush_periodically(self, interval):
+        while not self._closed.wait(interval):
+            try:
+                self.flush()
+            except Exception:
+                self.logger.exception("Failed to write messages")
+
+    def close(self):
+        """
+        Writes all pending data and closes the database.
+        """
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        with self._lock:
+            self.flush()
+            self._connection.close()
+
+    def __len__(self):
+        with self._lock:
+            self.flush()
+            return self._connection.execute(
+                'SELECT COUNT(*) FROM messages').fetchone()[0]
@@ -0,0 +1,208 @@
+"""
+Client-side rate limiting and retrying for requests to Stack Exchange chat.
+"""
+import email.utils
+import random
+import threading
+import time
+
+from ._utils import _now
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` acquisitions per second on average, with bursts of up
+    to `capacity` acquisitions at once.
+    """
+    def __init__(self, rate, capacity=1):
+        assert rate > 0, "rate must be positive"
+        assert capacity >= 1, "capacity must be at least 1"
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._updated = _now()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token, returning how many seconds the caller must wait
+        before it may use it.
+        """
+        with self._lock:
+            now = _now()
+            self._tokens = min(
+                self.capacity,
+                self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            # tokens may go negative; later callers queue up behind us
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """
+        Blocks until a token is available, returning the time waited.
+        """
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class RateLimiter(object):
+    """
+    A TokenBucket for each class of endpoint.
+
+    limits maps endpoint class names to (rate, capacity) pairs, or None
+    for classes that should not be limited at all.
+    """
+    def __init__(self, limits):
+        self.buckets = {}
+        for endpoint_class, limit in limits.items():
+            if limit is not None:
+                rate, capacity = limit
+                self.buckets[endpoint_class] = TokenBucket(rate, capacity)
+
+    def acquire(self, endpoint_class):
+        """
+        Blocks until a request of endpoint_class may be made, returning
+        the time waited.
+        """
+        bucket = self.buckets.get(endpoint_class)
+        if bucket is None:
+            return 0.0
+        return bucket.acquire()
+
+
+class RetryBudget(object):
+    """
+    Caps retries at a fraction of the requests being made.
+
+    Every request deposits `ratio` tokens, up to `capacity`, and every
+    retry withdraws a whole one. While requests mostly succeed the
+    budget stays full; during an outage it drains, and from then on
+    only about one request in 1/ratio is retried.
+    """
+    def __init__(self, ratio=0.1, capacity=10):
+        self.ratio = float(ratio)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + self.ratio)
+
+    def withdraw(self):
+        """
+        Takes a token for a retry, returning False if none are left.
+        """
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+# Shared by every RetryPolicy that isn't given its own budget, so that
+# all the Browsers in a process back off together.
+default_retry_budget = RetryBudget()
+
+
+class RetryPolicy(object):
+    """
+    Decides whether and when a failed request should be retried.
+
+    Delays use exponential backoff with full jitter: a random time
+    between 0 and min(max_delay, base_delay * 2 ** attempt). A
+    Retry-After header on a retryable response is honored instead,
+    unless it asks for longer than max_retry_after.
+    """
+    retry_statuses = frozenset([429, 502, 503, 504])
+
+    def __init__(
+            self, max_retries=5, base_delay=0.1, max_delay=30.0,
+            max_retry_after=120.0, budget=None
+    ):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        if budget is None:
+            budget = default_retry_budget
+        self.budget = budget
+
+        self.requests = 0
+        self.retries = 0
+        self.give_ups = 0
+        self.budget_exhaustions = 0
+        self._lock = threading.Lock()
+
+    def on_request(self):
+        """
+        Records a new (not retried) request.
+        """
+        self.budget.deposit()
+        with self._lock:
+            self.requests += 1
+
+    def is_retryable(self, response):
+        return response.status_code in self.retry_statuses
+
+    def next_delay(self, attempt, response=None):
+        """
+        Returns how long to wait before retrying after the given failed
+        attempt (counting from 0), or None to give up.
+        """
+        delay = None
+        if attempt < self.max_retries:
+            delay = self._retry_after(response)
+            if delay is None:
+                cap = min(self.max_delay, self.base_delay * 2 ** attempt)
+                delay = random.uniform(0, cap)
+            elif delay > self.max_retry_after:
+                delay = None
+
+        if delay is not None and not self.budget.withdraw():
+            with self._lock:
+                self.budget_exhaustions += 1
+            delay = None
+
+        with self._lock:
+            if delay is None:
+                self.give_ups += 1
+            else:
+                self.retries += 1
+
+        return delay
+
+    @staticmethod
+    def _retry_after(response):
+        """
+        Returns the delay in seconds asked for by a Retry-After header,
+        if there is one.
+        """
+        if response is None:
+            return None
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        parsed = email.utils.parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'retries': self.retries,
+                'give_ups': self.give_ups,
+                'budget_exhaustions': self.budget_exhaustions,
+            }
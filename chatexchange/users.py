@@ -7,9 +7,16 @@ logger = logging.getLogger(__name__)
 
 
 class User(object):
+    __slots__ = (
+        'id', '_client', '__dict__', '__weakref__',
+    ) + _utils.lazy_slots(
+        'name', 'about', 'is_moderator', 'message_count', 'room_count',
+        'reputation', 'last_seen', 'last_message')
+
+    _logger = logger.getChild('User')
+
     def __init__(self, id, client):
         self.id = id
-        self._logger = logger.getChild('User')
         self._client = client
 
     name = _utils.LazyFrom('scrape_profile')
@@ -23,7 +30,9 @@ class User(object):
 
     def scrape_profile(self):
         data = self._client._br.get_profile(self.id)
+        self._apply_profile(data)
 
+    def _apply_profile(self, data):
         self.name = data['name']
         self.is_moderator = data['is_moderator']
         self.message_count = data['message_count']
@@ -57,6 +57,7 @@ class Server(HTTPServer, object):
         self.room = self.client.get_room(kw.pop('room_id'))
         self.room.name = "Chat Room"  # prevent request
         self.messages = collections.deque(maxlen=25)
+        self.recent_events = collections.deque(maxlen=25)
 
         self.room.join()
         self.room.watch_socket(self.on_chat_event)
@@ -73,7 +74,7 @@ class Server(HTTPServer, object):
                 'name': self.room.name
             },
             'recent_events':
-                map(str, self.client._recently_gotten_objects),
+                list(map(str, reversed(self.recent_events))),
             'messages': [{
                 'id': message.id,
                 'owner_user_id': message.owner.id,
@@ -89,6 +90,7 @@ class Server(HTTPServer, object):
         }
 
     def on_chat_event(self, event, client):
+        self.recent_events.append(event)
         if isinstance(event, events.MessagePosted) and event.room is self.room:
             self.messages.append(event.message)
 
@@ -10,9 +10,21 @@ setuptools.setup(
     install_requires=[
         'beautifulsoup4>=4.3.2',
         'requests>=2.2.1',
-        'websocket-client>=0.13.0'
+        'websocket-client>=0.13.0',
+        'futures>=3.0.0; python_version < "3"'
     ],
+    entry_points={
+        'console_scripts': [
+            'chatexchange-archive=chatexchange.archive:main'
+        ]
+    },
     extras_require={
+        'aio': [
+            'aiohttp>=3.8; python_version >= "3"'
+        ],
+        'fast': [
+            'orjson>=3.0'
+        ],
         'dev': [
             'coverage>=4.5.0',
             'epydoc>=3.0.1',
@@ -20,7 +32,8 @@ setuptools.setup(
             'pytest-timeout>=0.3',
             'pytest>=3.4.2',
             'py>=1.5.0',
-            'bpython>=0.16'
+            'bpython>=0.16',
+            'aiohttp>=3.8; python_version >= "3"'
         ]
     }
 )
@@ -0,0 +1,7 @@
+import sys
+
+
+# chatexchange.aio uses async/await, which Python 2 can't even parse.
+collect_ignore = []
+if sys.version_info[0] == 2:
+    collect_ignore.append('test_aio.py')
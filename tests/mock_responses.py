@@ -13,9 +13,7 @@ def only_httmock(*mocks):
 TEST_FKEY = 'dc63b60f5ada11372b8ff63821d9bf24'
 
 
-@httmock.urlmatch(path=r'^/chats/join/favorite$')
-def favorite_with_test_fkey(url, request):
-    return '''<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" "http://www.w3.org/TR/html4/strict.dtd">
+FAVORITE_PAGE = '''<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" "http://www.w3.org/TR/html4/strict.dtd">
 <html>
 <head>
 
@@ -150,6 +148,148 @@ def favorite_with_test_fkey(url, request):
 </html>'''
 
 
+@httmock.urlmatch(path=r'^/chats/join/favorite$')
+def favorite_with_test_fkey(url, request):
+    return FAVORITE_PAGE
+
+
+# Trimmed-down copies of chat pages, keeping the markup the scrapers use.
+
+HISTORY_PAGE = '''<!DOCTYPE html>
+<html>
+<head><title>message history - Sandbox</title></head>
+<body>
+<div id="container"><div id="content">
+<p><span class="stars owner-star"><span class="img"></span></span>
+ pinned by <a href="/users/7/bob">bob</a></p>
+<div class="monologue user-5">
+  <div class="signature"><div class="username"><a href="/users/5/alice">alice</a></div></div>
+  <div class="messages">
+    <div class="message">
+      <a name="1234" href="/transcript/1?m=1234#1234"><span class="action-link">&nbsp;</span></a>
+      <div class="content">hello <b>world</b> &amp; all</div>
+      <span class="flash"><span class="stars owner-star"><span class="img"></span><span class="times">3</span></span></span>
+    </div>
+    <div class="message-source">hello **world** &amp; all</div>
+  </div>
+</div>
+<div class="monologue user-5">
+  <div class="signature"><div class="username"><a href="/users/5/alice">alice</a></div></div>
+  <div class="messages">
+    <div class="message"><b>edited:</b><div class="content">hello world</div></div>
+  </div>
+</div>
+<div class="monologue user-5">
+  <div class="signature"><div class="username"><a href="/users/5/alice">alice</a></div></div>
+  <div class="messages">
+    <div class="message"><b>said:</b><div class="content">hello</div></div>
+  </div>
+</div>
+</div></div>
+</body>
+</html>'''
+
+PROFILE_PAGE = u'''<!DOCTYPE html>
+<html>
+<head><title>User alice - chat.stackexchange.com</title></head>
+<body>
+<div id="content">
+  <h1>alice</h1>
+  <div class="user-status">&#9830;</div>
+  <div class="user-message-count-xxl">12345</div>
+  <div class="user-room-count-xxl">42</div>
+  <span class="reputation-score" title="23456">23.5k</span>
+  <table>
+    <tr><td class="user-keycell">parent user</td><td class="user-valuecell">alice</td></tr>
+    <tr><td class="user-keycell">last message</td><td class="user-valuecell">3h ago</td></tr>
+    <tr><td class="user-keycell">last seen</td><td class="user-valuecell">just now</td></tr>
+    <tr><td class="user-keycell">about</td><td class="user-valuecell">I like chat.</td></tr>
+  </table>
+</div>
+</body>
+</html>'''
+
+ROOM_INFO_PAGE = '''<!DOCTYPE html>
+<html>
+<head><title>Sandbox | chat.stackexchange.com</title></head>
+<body>
+<div id="content">
+  <div class="roomcard-xxl">
+    <h1>Sandbox</h1>
+    <p>Where you can play with <a href="/faq">regular</a> chat features</p>
+    <img src="//cdn.sstatic.net/stackexchange/img/icon-16.png" title="Stack Exchange">
+    <div class="room-message-count-xxl">1234567</div>
+    <div class="room-user-count-xxl">890</div>
+    <a class="tag" href="/?tab=all&amp;sort=active&amp;tags=sandbox">sandbox</a>
+    <a class="tag" href="/?tab=all&amp;sort=active&amp;tags=test">test</a>
+  </div>
+  <div id="room-ownercards">
+    <div class="usercard"><a href="/users/5/alice">alice</a></div>
+    <div class="usercard"><a href="/users/7/bob">bob</a></div>
+  </div>
+</div>
+</body>
+</html>'''
+
+ROOM_PAGE = '''<!DOCTYPE html>
+<html>
+<head><title>Sandbox | chat.stackexchange.com</title></head>
+<body>
+<div id="present-users" class="js-present" data-users="[{&quot;id&quot;:5,&quot;name&quot;:&quot;alice&quot;},{&quot;id&quot;:7,&quot;name&quot;:&quot;bob &amp; co&quot;}]"></div>
+</body>
+</html>'''
+
+
+def transcript_page(message_count=3, first_message_id=100, hour_links=()):
+    """
+    A transcript page for room 1 with message_count messages, in
+    monologues of up to three messages each, linking to the pages of
+    the other hour_links (day, start, end) of the same day.
+    """
+    monologues = []
+    for start in range(0, message_count, 3):
+        user_id = 5 + start % 2
+        messages = []
+        for message_id in range(first_message_id + start,
+                                first_message_id + min(start + 3, message_count)):
+            extras = ''
+            if message_id % 5 == 0:
+                extras += '<a class="reply-info" href="/transcript/message/%d#%d"></a>' % (
+                    message_id - 1, message_id - 1)
+            if message_id % 4 == 0:
+                extras += '<span class="edits">edited</span>'
+            if message_id % 7 == 0:
+                extras += (
+                    '<span class="flash"><span class="stars user-star">'
+                    '<span class="img"></span><span class="times">2</span></span></span>')
+            messages.append(
+                '<div class="message" id="message-%d">'
+                '<a name="%d" href="/transcript/1?m=%d#%d"></a>%s'
+                '<div class="content">message <i>number</i> %d &amp; more</div>'
+                '</div>' % (message_id, message_id, message_id, message_id, extras, message_id))
+        monologues.append(
+            '<div class="monologue user-%d">'
+            '<div class="signature"><div class="username">'
+            '<a href="/users/%d/user-%d">user %d</a></div></div>'
+            '<div class="messages">%s</div></div>' % (
+                user_id, user_id, user_id, user_id, ''.join(messages)))
+
+    return '''<!DOCTYPE html>
+<html>
+<head><title>Sandbox - transcript</title></head>
+<body>
+<div id="info"><div class="room-name"><a href="/rooms/1/sandbox">Sandbox</a></div></div>
+<div class="pager">%s</div>
+<div id="transcript">%s</div>
+</body>
+</html>''' % (
+        ''.join(
+            '<a href="/transcript/1/%s/%d-%d">%02d:00 - %02d:00</a>' % (
+                day, start, end, start, end)
+            for day, start, end in hour_links),
+        ''.join(monologues))
+
+
 @httmock.urlmatch(netloc=r'.*')
 def fail_everything_else(url, request):
     raise Exception("unexpected request; no mock available", request)
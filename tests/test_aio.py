@@ -0,0 +1,177 @@
+import asyncio
+import json
+
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from chatexchange import aio
+
+
+FAVORITE_PAGE = '''<html><body>
+<div class="topbar-menu-links"><a href="/users/5/me">me</a></div>
+<input name="fkey" value="testfkey">
+</body></html>'''
+
+TRANSCRIPT_PAGE = '''<html><body>
+<div class="room-name"><a href="/rooms/1/sandbox">Sandbox</a></div>
+<div class="monologue user-7">
+  <div class="signature"><div class="username"><a href="/users/7/bob">bob</a></div></div>
+  <div class="messages">
+    <div class="message" id="message-100"><div class="content">hello <b>world</b></div></div>
+    <div class="message" id="message-101">
+      <a class="reply-info" href="/transcript/message/100#100"></a>
+      <div class="content">again</div>
+    </div>
+  </div>
+</div>
+</body></html>'''
+
+
+def run_with_server(routes, test):
+    """
+    Runs test(client) against a local server with the given routes,
+    standing in for chat.stackexchange.com.
+    """
+    async def main():
+        app = web.Application()
+        app.add_routes(routes)
+        server = TestServer(app)
+        await server.start_server()
+
+        client = aio.AsyncClient('stackexchange.com')
+        client._br.__class__ = type(
+            'LocalAsyncBrowser', (aio.AsyncBrowser,),
+            {'chat_root': str(server.make_url('')).rstrip('/')})
+        try:
+            return await test(client)
+        finally:
+            await client.logout()
+            await server.close()
+
+    return asyncio.run(main())
+
+
+def test_scrape_transcript():
+    async def transcript(request):
+        assert request.match_info['id'] == '101'
+        return web.Response(text=TRANSCRIPT_PAGE, content_type='text/html')
+
+    async def test(client):
+        message = await client.scrape_transcript(101)
+        assert message is client.get_message(101)
+        return message
+
+    message = run_with_server(
+        [web.get('/transcript/message/{id}', transcript)], test)
+
+    assert message.content == 'again'
+    assert message.owner.id == 7
+    assert message.room.id == 1
+    assert message.parent.content == 'hello <b>world</b>'
+    assert message.parent.owner is message.owner
+
+
+def test_send_message_waits_out_throttling():
+    posted = []
+
+    async def favorite(request):
+        return web.Response(text=FAVORITE_PAGE, content_type='text/html')
+
+    async def new_message(request):
+        form = await request.post()
+        assert form['fkey'] == 'testfkey'
+        posted.append(form['text'])
+        if len(posted) == 1:
+            return web.Response(
+                status=409,
+                text="You can perform this action again in 1 seconds.")
+        return web.Response(
+            text=json.dumps({'id': 1234, 'time': 1}),
+            content_type='application/json')
+
+    async def test(client):
+        return await client.send_message(1, 'hello')
+
+    message_id = run_with_server([
+        web.get('/chats/join/favorite', favorite),
+        web.post('/chats/{room}/messages/new', new_message),
+    ], test)
+
+    assert message_id == 1234
+    assert posted == ['hello', 'hello']
+
+
+def test_backoff_delays_the_next_action_not_the_result():
+    edited = []
+
+    async def favorite(request):
+        return web.Response(text=FAVORITE_PAGE, content_type='text/html')
+
+    async def edit(request):
+        form = await request.post()
+        edited.append(form['text'])
+        return web.Response(text=json.dumps('ok'), content_type='application/json')
+
+    async def test(client):
+        client._client._BACKOFF_ADDER = 0.5
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await client.edit_message(5, 'first')
+        first = loop.time() - started
+        await client.edit_message(5, 'second')
+        return first, loop.time() - started
+
+    first, both = run_with_server([
+        web.get('/chats/join/favorite', favorite),
+        web.post('/messages/{id}', edit),
+    ], test)
+
+    assert edited == ['first', 'second']
+    assert first < 0.4
+    assert both >= 0.5
+
+
+def test_socket_recovery_rewatches_every_room(monkeypatch):
+    class ClosedSocket(object):
+        async def receive(self, timeout=None):
+            return aiohttp.WSMessage(aiohttp.WSMsgType.CLOSED, None, None)
+
+        async def close(self):
+            pass
+
+    started = []
+
+    async def start(watcher, room_id):
+        started.append(room_id)
+        watcher.ws = ClosedSocket()
+
+    monkeypatch.setattr(aio.AsyncSocketWatcher, 'start', start)
+
+    async def main():
+        browser = aio.AsyncBrowser('stackexchange.com')
+        joined = []
+
+        async def join_room(room_id):
+            joined.append(room_id)
+            browser.rooms[room_id] = {'eventtime': 1}
+
+        browser.join_room = join_room
+
+        callbacks = {}
+        for room_id in ['1', '2', '3']:
+            await browser.join_room(room_id)
+            callbacks[room_id] = lambda activity: None
+            await browser.watch_room_socket(room_id, callbacks[room_id])
+        old_socket = browser.socket
+
+        await old_socket._runner()
+
+        assert browser.socket is not old_socket
+        assert browser.socket.rooms == callbacks
+        assert joined == ['1', '2', '3', '1', '2', '3']
+        assert started == ['1', '1']
+
+    asyncio.run(main())
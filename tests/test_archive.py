@@ -0,0 +1,115 @@
+import datetime
+import json
+import threading
+
+import httmock
+
+from chatexchange import archive, Client
+
+from tests import mock_responses
+from tests.mock_responses import only_httmock
+
+
+DAY = datetime.date(2020, 1, 1)
+
+
+def transcript_days(requested_paths):
+    """
+    Mocks room 1's transcript with three messages a day, except on
+    January 2nd, which is split over two pages.
+    """
+    lock = threading.Lock()
+
+    @httmock.urlmatch(path=r'^/transcript/1/2020/1/\d+(/\d+-\d+)?$')
+    def transcript_day(url, request):
+        with lock:
+            requested_paths.append(url.path)
+        day = int(url.path.split('/')[5])
+        if url.path.endswith('/12-24'):
+            return mock_responses.transcript_page(3, 2000 + day * 10)
+        hour_links = ()
+        if day == 2:
+            hour_links = [('2020/1/2', 12, 24)]
+        return mock_responses.transcript_page(3, 1000 + day * 10, hour_links)
+
+    return transcript_day
+
+
+def test_archiver_yields_every_day_in_order():
+    requested_paths = []
+    with only_httmock(transcript_days(requested_paths)):
+        archiver = archive.TranscriptArchiver(
+            Client('stackexchange.com'), 1, DAY, DAY + datetime.timedelta(days=2),
+            workers=2)
+        ids = [message_data['id'] for message_data in archiver]
+
+    assert ids == [
+        1010, 1011, 1012,
+        1020, 1021, 1022, 2020, 2021, 2022,
+        1030, 1031, 1032,
+    ]
+    assert sorted(requested_paths) == [
+        '/transcript/1/2020/1/1',
+        '/transcript/1/2020/1/2',
+        '/transcript/1/2020/1/2/12-24',
+        '/transcript/1/2020/1/3',
+    ]
+
+
+def test_archiver_resumes_from_checkpoint(tmpdir):
+    checkpoint_path = str(tmpdir.join('checkpoint'))
+    client = Client('stackexchange.com')
+    end = DAY + datetime.timedelta(days=2)
+
+    with only_httmock(transcript_days([])):
+        archiver = archive.TranscriptArchiver(
+            client, 1, DAY, end, workers=1, checkpoint_path=checkpoint_path)
+        messages = iter(archiver)
+        # stop partway through the second day
+        seen = [next(messages)['id'] for _ in range(5)]
+        messages.close()
+
+    assert seen == [1010, 1011, 1012, 1020, 1021]
+    with open(checkpoint_path) as f:
+        checkpoint = json.load(f)
+    assert checkpoint['day'] == '2020-01-01'
+    # 1021 was never followed by a request for the next message
+    assert checkpoint['message_id'] == 1020
+
+    requested_paths = []
+    with only_httmock(transcript_days(requested_paths)):
+        archiver = archive.TranscriptArchiver(
+            client, 1, DAY, end, workers=1, checkpoint_path=checkpoint_path)
+        ids = [message_data['id'] for message_data in archiver]
+
+    assert ids[0] == 1021
+    assert '/transcript/1/2020/1/1' not in requested_paths
+    with open(checkpoint_path) as f:
+        assert json.load(f)['day'] == '2020-01-03'
+
+
+def test_cli_does_not_rewrite_messages_already_in_output(tmpdir):
+    output_path = str(tmpdir.join('output.jsonl'))
+    checkpoint_path = str(tmpdir.join('checkpoint'))
+    # as if killed partway through January 2nd, after writing 1021 but
+    # before the checkpoint caught up
+    with open(checkpoint_path, 'w') as f:
+        json.dump({
+            'host': 'stackexchange.com', 'room_id': 1,
+            'day': '2020-01-01', 'message_id': 1012}, f)
+    with open(output_path, 'w') as f:
+        for message_id in [1010, 1011, 1012, 1020, 1021]:
+            f.write(json.dumps({'id': message_id}) + '\n')
+        f.write('{"id": 10')
+
+    with only_httmock(transcript_days([])):
+        archive.main([
+            'stackexchange.com', '1', '--start', '2020-01-01',
+            '--end', '2020-01-02', '--output', output_path,
+            '--checkpoint', checkpoint_path])
+
+    with open(output_path) as f:
+        lines = f.read().split('\n')
+    assert lines[5] == '{"id": 10'
+    assert [json.loads(line)['id'] for line in lines[6:] if line] == [
+        1022, 2020, 2021, 2022]
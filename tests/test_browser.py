@@ -1,7 +1,19 @@
+import json
+import time
+try:
+    import urlparse
+except ImportError:
+    from urllib import parse as urlparse
+
 import httmock
+import pytest
+import websocket
 
 from chatexchange import Browser
+from chatexchange.browser import (
+    RoomSocketWatcher, SharedPollingWatcher, SharedSocketWatcher)
 
+from tests import mock_responses
 from tests.mock_responses import only_httmock, favorite_with_test_fkey, TEST_FKEY
 
 
@@ -39,3 +51,378 @@ def test_user_agent():
         browser.get_soup('http://example.com/2', with_chat_root=False)
 
         assert len(good_requests) == 2, "Unexpected number of requests"
+
+
+def test_shared_socket_routes_activity_by_room():
+    """
+    Tests that a SharedSocketWatcher passes each room only its own
+    section of a frame, and ignores rooms nobody is watching.
+    """
+    browser = Browser()
+    shared_socket = SharedSocketWatcher(browser)
+
+    seen = []
+    shared_socket.add_room(1, lambda activity: seen.append((1, activity)))
+    shared_socket.add_room('2', lambda activity: seen.append((2, activity)))
+
+    shared_socket._dispatch({
+        'r1': {'e': [{'id': 10}], 't': 10},
+        'r2': {'t': 11},
+        'r3': {'e': [{'id': 12}], 't': 12},
+    })
+
+    assert sorted(seen, key=lambda s: s[0]) == [
+        (1, {'r1': {'e': [{'id': 10}], 't': 10}}),
+        (2, {'r2': {'t': 11}}),
+    ]
+
+
+def test_shared_socket_survives_a_failing_room_handler():
+    """
+    Tests that an exception from one room's on_activity doesn't keep
+    the other rooms from getting their activity.
+    """
+    browser = Browser()
+    shared_socket = SharedSocketWatcher(browser)
+
+    def broken(activity):
+        raise ValueError("broken handler")
+
+    seen = []
+    shared_socket.add_room(1, broken)
+    shared_socket.add_room(2, seen.append)
+
+    shared_socket._dispatch({'r1': {'t': 10}, 'r2': {'t': 11}})
+    shared_socket._dispatch({'r2': {'t': 12}})
+
+    assert seen == [{'r2': {'t': 11}}, {'r2': {'t': 12}}]
+
+
+def test_shared_socket_is_reused_for_later_rooms(monkeypatch):
+    """
+    Tests that watching a second room with share_socket set does not
+    open another connection, and that the connection is closed once
+    the last room stops being watched.
+    """
+    started = []
+    monkeypatch.setattr(
+        SharedSocketWatcher, 'start',
+        lambda self, room_id: started.append(room_id))
+    monkeypatch.setattr(
+        Browser, 'post_fkeyed', lambda self, url, data=None: None)
+
+    browser = Browser()
+    browser.share_socket = True
+
+    watcher1 = browser.watch_room_socket(1, lambda activity: None)
+    watcher2 = browser.watch_room_socket(2, lambda activity: None)
+
+    assert started == ['1']
+    assert watcher1.shared_watcher is watcher2.shared_watcher
+    assert set(browser.shared_socket.rooms) == {'1', '2'}
+
+    browser.leave_room(1)
+    assert not browser.shared_socket.killed
+    browser.leave_room(2)
+    assert browser.shared_socket.killed
+
+
+def test_shared_poll_sends_one_request_for_all_due_rooms():
+    """
+    Tests that a SharedPollingWatcher polls every due room in a single
+    'events' request and splits the response back out per room.
+    """
+    polled = []
+
+    @httmock.urlmatch(path=r'^/events$')
+    def events(url, request):
+        polled.append(dict(urlparse.parse_qsl(request.body)))
+        return json.dumps({
+            'r1': {'e': [{'id': 5, 'event_type': 1}], 't': 5},
+            'r2': {'t': 7},
+        })
+
+    with only_httmock(favorite_with_test_fkey, events):
+        browser = Browser()
+        browser.host = 'stackexchange.com'
+        browser.rooms = {'1': {'eventtime': 1}, '2': {'eventtime': 2}}
+
+        seen = {}
+        shared_poll = SharedPollingWatcher(browser)
+        shared_poll.add_room(1, lambda activity: seen.setdefault(1, activity), 3)
+        shared_poll.add_room(2, lambda activity: seen.setdefault(2, activity), 3)
+
+        shared_poll._poll(list(shared_poll.rooms.values()), 100)
+
+    assert len(polled) == 1
+    assert polled[0]['r1'] == '1' and polled[0]['r2'] == '2'
+    assert seen == {
+        1: {'r1': {'e': [{'id': 5, 'event_type': 1}], 't': 5}},
+        2: {'r2': {'t': 7}},
+    }
+    assert browser.rooms == {'1': {'eventtime': 5}, '2': {'eventtime': 7}}
+    assert all(w.next_poll == 103 for w in shared_poll.rooms.values())
+
+
+def test_shared_poll_survives_a_failing_room_handler():
+    """
+    Tests that an exception from one room's on_activity doesn't keep
+    the other rooms polled with it from getting their activity.
+    """
+    @httmock.urlmatch(path=r'^/events$')
+    def events(url, request):
+        return json.dumps({'r1': {'t': 5}, 'r2': {'t': 7}})
+
+    def broken(activity):
+        raise ValueError("broken handler")
+
+    with only_httmock(favorite_with_test_fkey, events):
+        browser = Browser()
+        browser.host = 'stackexchange.com'
+        browser.rooms = {'1': {'eventtime': 1}, '2': {'eventtime': 2}}
+
+        seen = []
+        shared_poll = SharedPollingWatcher(browser)
+        shared_poll.add_room(1, broken, 3)
+        shared_poll.add_room(2, seen.append, 3)
+
+        shared_poll._poll(list(shared_poll.rooms.values()), 100)
+
+    assert seen == [{'r2': {'t': 7}}]
+    assert all(w.next_poll == 103 for w in shared_poll.rooms.values())
+
+
+def test_socket_recovery_backfills_missed_events(monkeypatch):
+    """
+    Tests that the default WebSocket recovery fetches the events missed
+    since the last frame before watching again, dropping any that were
+    already seen.
+    """
+    class FakeResponse(object):
+        def __init__(self, data):
+            self.content = json.dumps(data).encode('utf-8')
+
+    posts = []
+
+    def post_fkeyed(self, url, data=None):
+        posts.append((url, data))
+        if url == 'chats/1/events':
+            return FakeResponse({'time': 500})
+        if url == 'events':
+            return FakeResponse({'r1': {'e': [{'id': 2}, {'id': 3}], 't': 400}})
+        return FakeResponse({})
+
+    watched = []
+    monkeypatch.setattr(Browser, 'post_fkeyed', post_fkeyed)
+    monkeypatch.setattr(
+        Browser, 'watch_room_socket',
+        lambda self, room_id, on_activity: watched.append(
+            (room_id, self.rooms[room_id]['eventtime'])))
+
+    browser = Browser()
+    browser.join_room(1)
+    received = []
+    browser.sockets['1'] = SharedSocketWatcher(browser).add_room(1, received.append)
+
+    # a frame arrives over the socket, then the connection is lost
+    activity = browser._track_socket_activity(
+        '1', {'r1': {'e': [{'id': 1}, {'id': 2}], 't': 300}})
+    assert activity == {'r1': {'e': [{'id': 1}, {'id': 2}], 't': 300}}
+    assert browser.rooms['1']['eventtime'] == 300
+
+    browser._default_ws_recovery('1')
+
+    assert ('events', {'r1': 300}) in posts
+    assert received == [{'r1': {'e': [{'id': 3}], 't': 400}}]
+    assert watched == [('1', 400)]
+
+
+def test_shared_socket_recovery_keeps_live_events_during_backfill(monkeypatch):
+    """
+    Tests that when a room is recovered onto a shared socket that is
+    already running, events arriving while it is backfilled are passed
+    on after the backfill, once each.
+    """
+    class FakeResponse(object):
+        def __init__(self, data):
+            self.content = json.dumps(data).encode('utf-8')
+
+    def post_fkeyed(self, url, data=None):
+        if url == 'chats/2/events':
+            return FakeResponse({'time': 500})
+        if url == 'events':
+            # a frame arrives over the socket meanwhile
+            self.shared_socket._dispatch(
+                {'r2': {'e': [{'id': 3}, {'id': 4}], 't': 450}})
+            return FakeResponse({'r2': {'e': [{'id': 2}, {'id': 3}], 't': 400}})
+        return FakeResponse({})
+
+    monkeypatch.setattr(Browser, 'post_fkeyed', post_fkeyed)
+    monkeypatch.setattr(SharedSocketWatcher, 'start', lambda self, room_id: None)
+
+    browser = Browser()
+    browser.share_socket = True
+    browser.watch_room_socket(1, lambda activity: None)
+    received = []
+    browser.join_room(2)
+    browser.watch_room_socket(2, received.append)
+    browser.rooms['2']['eventtime'] = 300
+
+    browser._default_ws_recovery('2')
+
+    assert received == [
+        {'r2': {'e': [{'id': 2}], 't': 400}},
+        {'r2': {'e': [{'id': 3}, {'id': 4}], 't': 450}},
+    ]
+    assert browser.sockets['2'].on_activity == received.append
+    browser.shared_socket._dispatch({'r2': {'e': [{'id': 5}], 't': 460}})
+    assert received[-1] == {'r2': {'e': [{'id': 5}], 't': 460}}
+
+
+def test_socket_watchdog_detects_silent_connection():
+    """
+    Tests that a socket which stops receiving anything, even pongs, is
+    closed and handed to the recovery hook, and that pings are sent
+    while waiting.
+    """
+    class FakeWebSocket(object):
+        def __init__(self, frames):
+            self.frames = list(frames)
+            self.pings = 0
+            self.closed = False
+            self.timeout = None
+
+        def settimeout(self, timeout):
+            self.timeout = timeout
+
+        def ping(self):
+            self.pings += 1
+
+        def close(self):
+            self.closed = True
+
+        def recv_data(self, control_frame=False):
+            if self.frames:
+                return self.frames.pop(0)
+            time.sleep(self.timeout)
+            raise websocket.WebSocketTimeoutException()
+
+    browser = Browser()
+    browser.socket_ping_interval = 0.05
+    browser.socket_recv_timeout = 0.01
+    browser.socket_idle_timeout = 0.2
+
+    received = []
+    closed = []
+    watcher = RoomSocketWatcher(browser, 1, received.append)
+    watcher.on_websocket_closed = closed.append
+    watcher.ws = FakeWebSocket([
+        (websocket.ABNF.OPCODE_TEXT, b'{"r1": {"e": [{"id": 1}], "t": 5}}'),
+        (websocket.ABNF.OPCODE_TEXT, b''),
+        (websocket.ABNF.OPCODE_PONG, b''),
+    ])
+
+    watcher._runner()
+
+    assert received == [{'r1': {'e': [{'id': 1}], 't': 5}}]
+    assert closed == ['1']
+    assert watcher.killed
+    assert watcher.ws.closed
+    assert watcher.ws.pings >= 2
+    assert time.time() - browser.last_frame_times['1'] >= 0.2
+
+
+def test_decode_frame_skips_heartbeats():
+    browser = Browser()
+
+    assert browser.decode_frame('') is None
+    assert browser.decode_frame('{}') is None
+    assert browser.decode_frame('{"r1":{},"r17":{}}') is None
+    assert browser.decode_frame('{"r1":{"t":5}}') == {'r1': {'t': 5}}
+
+
+def test_json_library_can_be_chosen(monkeypatch):
+    monkeypatch.setattr(Browser, 'json_library', 'json')
+    assert Browser().json_loads is json.loads
+
+    monkeypatch.setattr(Browser, 'json_library', 'no_such_json_library')
+    with pytest.raises(ImportError):
+        Browser()
+
+
+@pytest.mark.parametrize('parser', ['html.parser', 'lxml'])
+def test_scrapers_give_the_same_data_with_every_parser(parser):
+    if parser == 'lxml':
+        pytest.importorskip('lxml')
+
+    browser = Browser()
+    browser.soup_parser = parser
+    soup = browser.make_soup
+
+    assert Browser._parse_history(soup(mock_responses.HISTORY_PAGE), 1234) == {
+        'room_id': 1,
+        'content': 'hello <b>world</b> &amp; all',
+        'content_source': 'hello **world** & all',
+        'owner_user_id': 5,
+        'owner_user_name': 'alice',
+        'editor_user_id': 5,
+        'editor_user_name': 'alice',
+        'edited': True,
+        'edits': 1,
+        'stars': 3,
+        'starred': True,
+        'pinned': True,
+        'pins': 1,
+        'pinner_user_ids': [7],
+        'pinner_user_names': ['bob'],
+    }
+
+    assert Browser._parse_profile(soup(mock_responses.PROFILE_PAGE)) == {
+        'name': 'alice',
+        'is_moderator': True,
+        'message_count': 12345,
+        'room_count': 42,
+        'reputation': 23456,
+        'last_seen': 0,
+        'last_message': 3 * 3600,
+    }
+
+    assert Browser._parse_room_info(soup(mock_responses.ROOM_INFO_PAGE)) == {
+        'name': 'Sandbox',
+        'description': 'Where you can play with <a href="/faq">regular</a> chat features',
+        'message_count': 1234567,
+        'user_count': 890,
+        'parent_site_name': 'Stack Exchange',
+        'owner_user_ids': [5, 7],
+        'owner_user_names': ['alice', 'bob'],
+        'tags': ['sandbox', 'test'],
+    }
+
+    assert Browser._parse_current_users(soup(mock_responses.ROOM_PAGE)) == [
+        (5, 'alice'), (7, 'bob & co')]
+
+    transcript = Browser._parse_transcript(
+        soup(mock_responses.transcript_page(8)), 101)
+    assert transcript['room_id'] == 1
+    assert transcript['room_name'] == 'Sandbox'
+    assert [m['id'] for m in transcript['messages']] == list(range(100, 108))
+    assert transcript['messages'][0] == {
+        'id': 100,
+        'content': 'message <i>number</i> 100 &amp; more',
+        'room_id': 1,
+        'room_name': 'Sandbox',
+        'owner_user_id': 5,
+        'owner_user_name': 'user 5',
+        'edited': True,
+        'parent_message_id': 99,
+        'stars': 0,
+        'starred': False,
+        'pinned': False,
+        'pins': 0,
+        'pinner_user_ids': [],
+        'pinner_user_names': [],
+        'starred_by_you': False,
+    }
+    assert transcript['messages'][5]['stars'] == 2
+    assert transcript['messages'][5]['starred_by_you']
+    assert transcript['messages'][3]['owner_user_id'] == 6
@@ -7,14 +7,16 @@ import logging
 if sys.version_info[:2] <= (2, 6):
     logging.Logger.getChild = lambda self, suffix:\
         self.manager.getLogger('.'.join((self.name, suffix)) if self.root is not self else suffix)
+import threading
 import time
 import uuid
 import os
 
 import pytest
+import requests
 
-from chatexchange.client import Client
-from chatexchange import events
+from chatexchange.client import ChatActionError, Client
+from chatexchange import actions, events
 
 from tests import live_testing
 
@@ -207,10 +209,9 @@ if live_testing.enabled:
         assert test_edit.message.content_source == test_edit_content
 
         # it should be safe to assume that there isn't so much activity
-        # that these events will have been flushed out of recent_events.
-        assert test_message_posted in client._recently_gotten_objects
-        assert test_reply in client._recently_gotten_objects
-        assert test_edit in client._recently_gotten_objects
+        # that these messages will have been evicted from the identity map.
+        assert test_message_posted.message.id in client._messages.recent
+        assert test_reply.message.id in client._messages.recent
 
         # Delete the second test message.
         test_reply.message.delete()
@@ -224,3 +225,312 @@ if live_testing.enabled:
         assert test_deletion.message == test_reply.message
 
         client.logout()
+
+
+def test_throttled_room_does_not_block_other_rooms():
+    """
+    Tests that an action stuck waiting in one room's lane doesn't delay
+    actions queued for another room.
+    """
+    client = Client('stackexchange.com')
+    release = threading.Event()
+    done = []
+
+    def fake_action(action, lane):
+        if action.target_id == 1:
+            assert release.wait(5)
+        done.append((action.action_type, action.target_id, action.text))
+
+    client._do_action_despite_throttling = fake_action
+    client.logged_in = True
+    client._start_lanes()
+
+    slow = client.get_room(1).send_message("slow")
+    fast = client.get_room(2).send_message("fast")
+
+    fast.result(5)
+    assert done == [('send', 2, "fast")]
+    assert not slow.done()
+
+    release.set()
+    slow.result(5)
+    assert done == [('send', 2, "fast"), ('send', 1, "slow")]
+
+    client.logout()
+
+
+def test_action_futures():
+    """
+    Tests that sends resolve to the new message id, that failures are
+    reported as ChatActionError, and that cancelled actions are skipped.
+    """
+    client = Client('stackexchange.com')
+    sent = []
+
+    def fake_action(action, lane):
+        sent.append(action.text)
+        if action.action_type == 'edit':
+            raise ChatActionError("too late")
+        return 1000 + len(sent)
+
+    client._do_action_despite_throttling = fake_action
+    room = client.get_room(1)
+
+    first = room.send_message("first")
+    cancelled = room.send_message("cancelled")
+    assert cancelled.cancel()
+    edit = client.get_message(5).edit("edited")
+
+    client.logged_in = True
+    client._start_lanes()
+
+    assert first.result(5) == 1001
+    with pytest.raises(ChatActionError):
+        edit.result(5)
+    assert cancelled.cancelled()
+    assert sent == ["first", "edited"]
+
+    client.logout()
+
+
+def test_lane_survives_unexpected_errors():
+    """
+    Tests that an action failing with something other than an HTTP or
+    chat error fails its futures without stopping its lane.
+    """
+    client = Client('stackexchange.com')
+
+    def fake_action(action, lane):
+        if action.text == "broken":
+            raise requests.ConnectionError("connection reset")
+        return 1000
+
+    client._do_action_despite_throttling = fake_action
+    room = client.get_room(1)
+
+    broken = room.send_message("broken")
+    client.logged_in = True
+    client._start_lanes()
+
+    with pytest.raises(ChatActionError):
+        broken.result(5)
+    assert room.send_message("fine").result(5) == 1000
+    assert client._lanes[1].thread.is_alive()
+
+    client.logout()
+
+
+def test_action_results_arrive_before_backoff():
+    """
+    Tests that an edit's future resolves as soon as SE accepts it, with
+    the backoff after it only delaying the lane's next action.
+    """
+    client = Client('stackexchange.com')
+    client._BACKOFF_ADDER = 0.5
+    edited = []
+
+    class FakeResponse(object):
+        text = "ok"
+
+        def json(self):
+            raise ValueError
+
+    def edit_message(message_id, text):
+        edited.append((time.time(), text))
+        return FakeResponse()
+
+    client._br.edit_message = edit_message
+    client.logged_in = True
+    client._start_lanes()
+
+    message = client.get_message(1)
+    start = time.time()
+    assert message.edit("first").result(5).text == "ok"
+    assert time.time() - start < 0.4
+
+    message.edit("second").result(5)
+    assert edited[1][0] - edited[0][0] >= 0.45
+
+    client.logout()
+
+
+def test_queued_edits_are_coalesced():
+    """
+    Tests that a burst of edits to one message is sent as a single edit
+    with the latest text, and that a delete cancels a queued edit.
+    """
+    client = Client('stackexchange.com')
+    sent = []
+
+    def fake_action(action, lane):
+        sent.append((action.action_type, action.target_id, action.text))
+        return action.text
+
+    client._do_action_despite_throttling = fake_action
+    status = client.get_message(1)
+    doomed = client.get_message(2)
+
+    edits = [status.edit("status %d" % (n,)) for n in range(5)]
+    doomed_edit = doomed.edit("never sent")
+    deletion = doomed.delete()
+
+    client.logged_in = True
+    client._start_lanes()
+
+    assert [edit.result(5) for edit in edits] == ["status 4"] * 5
+    assert deletion.result(5) == ''
+    assert doomed_edit.cancelled()
+    # deletes are high priority by default, so they go first
+    assert sent == [('delete', 2, ''), ('edit', 1, "status 4")]
+
+    # once the first edit has been sent, later edits are queued again
+    assert status.edit("status 5").result(5) == "status 5"
+
+    client.logout()
+
+
+def test_coalesced_edit_keeps_higher_priority():
+    client = Client('stackexchange.com')
+    sent = []
+
+    def fake_action(action, lane):
+        sent.append((action.target_id, action.text, action.priority))
+        return action.text
+
+    client._do_action_despite_throttling = fake_action
+
+    first = client.get_message(1).edit("one")
+    other = client.get_message(2).edit("two")
+    urgent = client.get_message(1).edit("one, urgently", priority=actions.PRIORITY_HIGH)
+    # a lower priority doesn't demote it again
+    client.get_message(1).edit("one, finally", priority=actions.PRIORITY_LOW)
+
+    client.logged_in = True
+    client._start_lanes()
+
+    assert first.result(5) == urgent.result(5) == "one, finally"
+    assert other.result(5) == "two"
+    assert sent == [
+        (1, "one, finally", actions.PRIORITY_HIGH),
+        (2, "two", actions.PRIORITY_NORMAL),
+    ]
+
+    client.logout()
+
+
+def test_priority_queue_order():
+    """
+    Tests that higher priorities are served first, FIFO within a
+    priority, and that overdue actions aren't starved.
+    """
+    request_queue = actions.PriorityPeekableQueue()
+    low = actions.ChatAction('send', 1, "low", priority=actions.PRIORITY_LOW)
+    normal1 = actions.ChatAction('send', 1, "normal 1")
+    normal2 = actions.ChatAction('send', 1, "normal 2")
+    high = actions.ChatAction('delete', 5, '', priority=actions.PRIORITY_HIGH)
+
+    for action in (low, normal1, SystemExit, normal2, high):
+        request_queue.put(action)
+
+    assert request_queue.peek_latest() is normal2
+    assert request_queue.peek_latest(actions.PRIORITY_LOW) is low
+    assert [request_queue.get() for _ in range(5)] == [
+        high, normal1, normal2, low, SystemExit]
+
+    starved = actions.ChatAction('send', 1, "starved", priority=actions.PRIORITY_LOW)
+    request_queue.put(starved)
+    starved.queued_at -= request_queue.max_wait + 1
+    request_queue.put(high)
+
+    assert request_queue.get() is starved
+
+
+def test_aggressive_merging_respects_priority():
+    client = Client('stackexchange.com', send_aggressively=True)
+    room = client.get_room(1)
+
+    room.send_message("one")
+    room.send_message("two")
+    room.send_message("urgent", priority=actions.PRIORITY_HIGH)
+
+    request_queue = client._lane(1).queue
+    assert request_queue.peek_latest().text == "one\ntwo"
+    assert request_queue.peek_latest(actions.PRIORITY_HIGH).text == "urgent"
+    assert request_queue.qsize() == 2
+
+
+def test_identity_map_keeps_recent_objects():
+    class SmallClient(Client):
+        identity_map_sizes = {'messages': 2, 'rooms': 1, 'users': 1}
+
+    client = SmallClient('stackexchange.com')
+
+    first = client.get_message(1)
+    first.content = 'cached'
+    first_id = id(first)
+    del first
+    for message_id in [2, 1, 3]:
+        client.get_message(message_id)
+
+    # message 1 was used more recently than message 2
+    assert id(client.get_message(1)) == first_id
+    assert client.get_message(1).content == 'cached'
+    assert 2 not in client._messages
+
+    stats = client.identity_map_stats()['messages']
+    assert stats['hits'] == 3
+    assert stats['misses'] == 3
+    assert stats['evictions'] == 1
+    assert stats['size'] == 2
+
+    # events aren't kept by the identity map
+    room = client.get_room(11)
+    event_data = {
+        'event_type': 1, 'time_stamp': 0, 'id': 99, 'room_id': 11,
+        'room_name': 'Sandbox', 'content': 'hi', 'user_id': 5,
+        'user_name': 'me', 'message_id': 1,
+    }
+    event, = room._events_from_activity({'r11': {'e': [event_data]}}, 11)
+    assert event.message is client.get_message(1)
+    assert client.identity_map_stats()['rooms']['size'] == 1
+
+
+def test_get_messages_fetches_each_page_once():
+    import httmock
+    from tests import mock_responses
+
+    requested_ids = []
+    lock = threading.Lock()
+
+    @httmock.urlmatch(path=r'^/transcript/message/\d+$')
+    def transcript_with_message(url, request):
+        message_id = int(url.path.rpartition('/')[2])
+        with lock:
+            requested_ids.append(message_id)
+        if message_id < 200:
+            return mock_responses.transcript_page(50, 100)
+        return mock_responses.transcript_page(30, 200)
+
+    client = Client('stackexchange.com')
+    already_loaded = client.get_message(300)
+    already_loaded.room = client.get_room(1)
+    already_loaded.content = 'known'
+    already_loaded.owner = client.get_user(5)
+    already_loaded._parent_message_id = None
+    already_loaded.stars = 0
+    already_loaded.starred_by_you = False
+    already_loaded.pinned = False
+
+    ids = [229, 100, 300, 201, 149, 100, 120]
+    with mock_responses.only_httmock(transcript_with_message):
+        found = client.get_messages(ids, workers=4)
+
+        assert [message.id for message in found] == ids
+        assert found[0] is client.get_message(229)
+        assert found[1].content == 'message <i>number</i> 100 &amp; more'
+        assert found[2].content == 'known'
+        assert found[3].owner.id == 5
+        assert found[6].parent.id == 119
+
+    # the first page shows how far apart ids on different pages are
+    assert requested_ids == [100, 201]
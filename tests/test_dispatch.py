@@ -0,0 +1,121 @@
+import threading
+import time
+
+from chatexchange import dispatch
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_rooms_are_ordered_but_concurrent():
+    dispatcher = dispatch.ActivityDispatcher(workers=2)
+    handled = []
+    release = threading.Event()
+
+    def slow(activity):
+        release.wait(5)
+        handled.append(activity['n'])
+
+    def fast(activity):
+        handled.append(activity['n'])
+
+    dispatcher.submit(1, slow, {'n': 'slow 1'})
+    dispatcher.submit(1, fast, {'n': 'room 1 after slow'})
+    for n in range(3):
+        dispatcher.submit(2, fast, {'n': n})
+
+    # room 2 isn't held up by the slow callback in room 1
+    wait_until(lambda: len(handled) == 3)
+    assert handled == [0, 1, 2]
+
+    release.set()
+    dispatcher.close()
+    assert handled[3:] == ['slow 1', 'room 1 after slow']
+    assert dispatcher.stats()['dispatched'] == 5
+
+
+def test_message_ordering_splits_room_activity():
+    dispatcher = dispatch.ActivityDispatcher(workers=1, ordering='message')
+    handled = []
+    activity = {'r1': {'t': 5, 'e': [
+        {'id': 1, 'message_id': 10},
+        {'id': 2, 'message_id': 11},
+        {'id': 3, 'message_id': 10},
+    ]}}
+
+    dispatcher.submit(1, lambda a: handled.append(a['r1']), activity)
+    dispatcher.close()
+
+    assert [[e['id'] for e in a['e']] for a in handled] == [[1, 3], [2]]
+    assert all(a['t'] == 5 for a in handled)
+
+
+def test_drop_oldest():
+    dispatcher = dispatch.ActivityDispatcher(
+        workers=1, max_pending=2, backpressure=dispatch.DROP_OLDEST)
+    handled = []
+    release = threading.Event()
+
+    dispatcher.submit(1, lambda a: release.wait(5), {})
+    wait_until(lambda: dispatcher.stats()['depth'] == 0)
+    for n in range(4):
+        dispatcher.submit(2, lambda a: handled.append(a['n']), {'n': n})
+
+    stats = dispatcher.stats()
+    assert stats['depth'] == 2
+    assert stats['dropped'] == 2
+
+    release.set()
+    dispatcher.close()
+    assert handled == [2, 3]
+
+
+def test_spill_keeps_order(tmpdir):
+    dispatcher = dispatch.ActivityDispatcher(
+        workers=1, max_pending=2, backpressure=dispatch.SPILL,
+        spill_dir=str(tmpdir))
+    handled = []
+    release = threading.Event()
+
+    dispatcher.submit(1, lambda a: release.wait(5), {})
+    wait_until(lambda: dispatcher.stats()['depth'] == 0)
+    for n in range(5):
+        dispatcher.submit(2, lambda a: handled.append(a['n']), {'n': n})
+
+    stats = dispatcher.stats()
+    assert stats['depth'] == 2
+    assert stats['spilled_pending'] == 3
+    assert stats['depth_by_key'] == {'1': 0, '2': 5}
+
+    release.set()
+    dispatcher.close()
+    assert handled == [0, 1, 2, 3, 4]
+    assert dispatcher.stats()['spilled_pending'] == 0
+
+
+def test_block_waits_for_room():
+    dispatcher = dispatch.ActivityDispatcher(workers=1, max_pending=1)
+    release = threading.Event()
+    submitted = threading.Event()
+
+    dispatcher.submit(1, lambda a: release.wait(5), {})
+    wait_until(lambda: dispatcher.stats()['depth'] == 0)
+    dispatcher.submit(1, lambda a: None, {})
+
+    def submit_third():
+        dispatcher.submit(1, lambda a: None, {})
+        submitted.set()
+
+    thread = threading.Thread(target=submit_third)
+    thread.daemon = True
+    thread.start()
+    assert not submitted.wait(0.2)
+
+    release.set()
+    assert submitted.wait(5)
+    dispatcher.close()
+    assert dispatcher.stats()['dispatched'] == 3
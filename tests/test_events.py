@@ -128,3 +128,200 @@ def test_message_starred_event_initialization():
     assert event.message.stars == message_stars
     assert event.user.id == user_id
     assert event.user.name == user_name
+
+
+def test_event_allocations_for_known_objects(monkeypatch):
+    """
+    Processing events about rooms, users and messages that are already
+    known shouldn't construct any new instances of them.
+    """
+    from chatexchange import messages, rooms, users
+
+    constructed = []
+    for cls in [messages.Message, rooms.Room, users.User]:
+        def counting_init(self, id, client, original=cls.__init__):
+            constructed.append(type(self))
+            original(self, id, client)
+        monkeypatch.setattr(cls, '__init__', counting_init)
+
+    test_client = client.Client()
+    event_data = {
+        "content": 'hello',
+        "event_type": 1,
+        "id": 28258802,
+        "message_id": 15249005,
+        "room_id": 1,
+        "room_name": "Sandbox",
+        "time_stamp": 1398822427,
+        "user_id": 146115,
+        "user_name": "bot"
+    }
+
+    first = events.make(event_data, test_client)
+    assert constructed == []
+    first.message
+    assert sorted(cls.__name__ for cls in constructed) == [
+        'Message', 'Room', 'User']
+
+    del constructed[:]
+    count = 1000
+    for i in range(count):
+        event = events.make(dict(event_data, id=event_data['id'] + i), test_client)
+        assert event.message is first.message
+
+    assert len(constructed) / float(count) == 0
+    stats = test_client.identity_map_stats()
+    assert stats['messages']['hits'] == count
+    assert stats['rooms']['hits'] >= count
+    assert stats['users']['hits'] >= count
+
+
+def test_events_build_objects_on_demand():
+    test_client = client.Client()
+    event_data = {
+        "content": 'first',
+        "event_type": 2,
+        "id": 100,
+        "message_id": 15249005,
+        "message_edits": 1,
+        "room_id": 1,
+        "room_name": "Sandbox",
+        "time_stamp": 1398822427,
+        "user_id": 146115,
+        "user_name": "bot"
+    }
+
+    older = events.make(event_data, test_client)
+    newer = events.make(
+        dict(event_data, id=101, content='second', message_edits=2),
+        test_client)
+
+    assert (older.type_id, older.room_id, older.user_id, older.message_id) == (
+        2, 1, 146115, 15249005)
+    assert len(test_client._messages) == 0
+    assert len(test_client._rooms) == 0
+    assert len(test_client._users) == 0
+
+    message = newer.message
+    assert message.content == 'second'
+    assert older.message is message
+    # the older event mustn't clobber what the newer one said
+    assert message.content == 'second'
+    assert message.edits == 2
+
+    # further events about a known message update it right away
+    events.make(dict(event_data, id=102, content='third'), test_client)
+    assert message.content == 'third'
+
+
+def test_event_filter():
+    posted = {"event_type": 1, "user_id": 5, "content": "flag this post"}
+    edited = {"event_type": 2, "user_id": 6, "content": "nothing to see"}
+    entered = {"event_type": 3, "user_id": 5}
+
+    assert events.EventFilter().matches(entered)
+
+    by_type = events.EventFilter(types=[1, events.MessageEdited])
+    assert by_type.type_ids == {1, 2}
+    assert by_type.matches(posted)
+    assert by_type.matches(edited)
+    assert not by_type.matches(entered)
+
+    # MessageEvent selects all the message event types
+    assert events.EventFilter(types=events.MessageEvent).matches(edited)
+    assert not events.EventFilter(types=events.MessageEvent).matches(entered)
+
+    by_user = events.EventFilter(user_ids=[5])
+    assert by_user.matches(posted)
+    assert not by_user.matches(edited)
+
+    by_content = events.EventFilter(content=r'\bflag\b')
+    assert by_content.matches(posted)
+    assert not by_content.matches(edited)
+    assert not by_content.matches(entered)
+
+
+def test_filtered_events_are_not_made():
+    test_client = client.Client()
+    room = test_client.get_room(1)
+    activity = {'r1': {'e': [
+        {"event_type": 3, "id": 1, "room_id": 1, "room_name": "Sandbox",
+         "time_stamp": 0, "user_id": 5, "user_name": "someone"},
+        {"event_type": 1, "id": 2, "room_id": 1, "room_name": "Sandbox",
+         "time_stamp": 0, "user_id": 5, "user_name": "someone",
+         "message_id": 3, "content": "hi"},
+    ]}}
+
+    made = list(room._events_from_activity(
+        activity, 1, events.EventFilter(types=[1, 2, 10])))
+
+    assert [event.id for event in made] == [2]
+
+
+def test_event_bus_dispatch():
+    test_client = client.Client()
+    calls = []
+
+    def handler(name, result=None):
+        def handle(event, client):
+            calls.append((name, event.id))
+            return result
+        return handle
+
+    bus = test_client.bus
+    bus.subscribe(handler('any'))
+    bus.subscribe(handler('posted by 5'), types=events.MessagePosted, user_ids=5)
+    bus.subscribe(handler('room 2'), room_ids=[2], order=-1)
+    stopper = bus.subscribe(
+        handler('stop in room 3', events.STOP), room_ids=3, order=-1)
+
+    def data(id, event_type, room_id, user_id):
+        return {
+            "event_type": event_type, "id": id, "room_id": room_id,
+            "room_name": "room", "time_stamp": 0, "user_id": user_id,
+            "user_name": "user", "message_id": id, "content": "hi",
+        }
+
+    bus.publish_data(data(1, 1, 1, 5))
+    bus.publish_data(data(2, 2, 1, 5))
+    bus.publish_data(data(3, 1, 2, 5))
+    bus.publish_data(data(4, 1, 3, 5))
+    stopper.cancel()
+    bus.publish_data(data(5, 3, 3, 6))
+
+    assert calls == [
+        ('any', 1), ('posted by 5', 1),
+        ('any', 2),
+        ('room 2', 3), ('any', 3), ('posted by 5', 3),
+        ('stop in room 3', 4),
+        ('any', 5),
+    ]
+
+
+def test_event_bus_skips_events_without_handlers():
+    test_client = client.Client()
+    bus = test_client.bus
+    received = []
+    bus.subscribe(lambda event, client: received.append(event), types=[1])
+
+    room = test_client.get_room(1)
+    on_activity = room._activity_handler(None, None)
+    on_activity({'r1': {'e': [
+        {"event_type": 3, "id": 1, "room_id": 1, "room_name": "Sandbox",
+         "time_stamp": 0, "user_id": 5, "user_name": "someone"},
+        {"event_type": 1, "id": 2, "room_id": 1, "room_name": "Sandbox",
+         "time_stamp": 0, "user_id": 5, "user_name": "someone",
+         "message_id": 3, "content": "hi"},
+    ]}})
+
+    assert [event.id for event in received] == [2]
+    assert len(test_client._users) == 0
+
+
+def test_event_bus_takes_any_single_id():
+    bus = client.Client().bus
+    bus.subscribe(lambda event, client: None, room_ids='123')
+    bus.subscribe(lambda event, client: None, user_ids=(5, 6))
+
+    assert sorted(bus._index, key=repr) == [
+        (None, '123', None), (None, None, 5), (None, None, 6)]
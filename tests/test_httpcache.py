@@ -0,0 +1,121 @@
+import email.utils
+import time
+
+import requests
+import requests.adapters
+
+from chatexchange import Browser
+from chatexchange.httpcache import CachingAdapter
+
+
+class FakeServer(object):
+    """
+    Stands in for the network under a CachingAdapter, answering with
+    the given headers and noting the requests that reach it.
+    """
+    def __init__(self, monkeypatch, headers=None, status_code=200):
+        self.headers = headers or {}
+        self.status_code = status_code
+        self.requests = []
+        monkeypatch.setattr(requests.adapters.HTTPAdapter, 'send', self.send)
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.headers = requests.structures.CaseInsensitiveDict(self.headers)
+        if self.headers.get('ETag') and (
+                request.headers.get('If-None-Match') == self.headers['ETag']):
+            response.status_code = 304
+            response._content = b''
+        else:
+            response.status_code = self.status_code
+            response._content = ('body %d' % (len(self.requests),)).encode('ascii')
+        response._content_consumed = True
+        return response
+
+
+def session_with(adapter):
+    session = requests.Session()
+    session.mount('https://', adapter)
+    return session
+
+
+def test_fresh_responses_are_reused(monkeypatch):
+    server = FakeServer(monkeypatch, {'Cache-Control': 'private, max-age=60'})
+    adapter = CachingAdapter()
+    session = session_with(adapter)
+
+    assert session.get('https://chat.example/a').text == 'body 1'
+    response = session.get('https://chat.example/a')
+    assert response.text == 'body 1'
+    assert response.from_cache
+    assert session.get('https://chat.example/b').text == 'body 2'
+    session.post('https://chat.example/a')
+    assert len(server.requests) == 3
+    assert adapter.stats()['hits'] == 1
+
+
+def test_stale_responses_are_revalidated(monkeypatch):
+    server = FakeServer(monkeypatch, {'ETag': '"v1"', 'Cache-Control': 'no-cache'})
+    adapter = CachingAdapter()
+    session = session_with(adapter)
+
+    assert session.get('https://chat.example/a').text == 'body 1'
+    assert session.get('https://chat.example/a').text == 'body 1'
+    assert server.requests[1].headers['If-None-Match'] == '"v1"'
+
+    server.headers['ETag'] = '"v2"'
+    assert session.get('https://chat.example/a').text == 'body 3'
+    assert adapter.stats()['revalidations'] == 1
+
+
+def test_uncacheable_responses_are_not_kept(monkeypatch):
+    server = FakeServer(monkeypatch, {'Cache-Control': 'no-store', 'ETag': '"v1"'})
+    session = session_with(CachingAdapter())
+    session.get('https://chat.example/a')
+    session.get('https://chat.example/a')
+    assert 'If-None-Match' not in server.requests[1].headers
+
+    server.headers = {
+        'Expires': email.utils.formatdate(time.time() - 10, usegmt=True)}
+    session.get('https://chat.example/a')
+    session.get('https://chat.example/a')
+    assert len(server.requests) == 4
+
+
+def test_ttl_overrides_and_disk_store(monkeypatch, tmpdir):
+    server = FakeServer(monkeypatch, {'Cache-Control': 'private'})
+    ttls = [(r'^/+rooms/\d+/?$', 5)]
+
+    session = session_with(CachingAdapter(disk_path=str(tmpdir), ttls=ttls))
+    assert session.get('https://chat.example//rooms/1/').text == 'body 1'
+    assert session.get('https://chat.example//rooms/1/').text == 'body 1'
+    session.get('https://chat.example/rooms/info/1')
+    session.get('https://chat.example/rooms/info/1')
+    assert len(server.requests) == 3
+
+    # a new adapter finds the response on disk
+    session = session_with(CachingAdapter(disk_path=str(tmpdir), ttls=ttls))
+    assert session.get('https://chat.example//rooms/1/').text == 'body 1'
+    assert len(server.requests) == 3
+
+
+def test_browser_caches_current_users(monkeypatch):
+    server = FakeServer(monkeypatch, {'Cache-Control': 'private'})
+    browser = Browser()
+    browser.host = 'stackexchange.com'
+    browser._parse_current_users = lambda soup: []
+
+    browser.get_current_users_in_room(1)
+    browser.get_current_users_in_room(1)
+    assert len(server.requests) == 1
+
+    monkeypatch.setattr(Browser, 'http_cache_size', None)
+    browser = Browser()
+    browser.host = 'stackexchange.com'
+    browser._parse_current_users = lambda soup: []
+    browser.get_current_users_in_room(1)
+    browser.get_current_users_in_room(1)
+    assert len(server.requests) == 3
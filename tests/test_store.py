@@ -0,0 +1,182 @@
+import httmock
+
+from chatexchange import Client
+from chatexchange.store import MessageStore
+
+from tests import mock_responses
+from tests.mock_responses import only_httmock
+
+
+@httmock.urlmatch(path=r'^/transcript/message/\d+$')
+def transcript_with_message(url, request):
+    return mock_responses.transcript_page(6)
+
+
+def test_scraped_messages_are_loaded_from_store_after_restart(tmpdir):
+    path = str(tmpdir.join('messages.db'))
+
+    store = MessageStore(path, flush_interval=None)
+    with only_httmock(transcript_with_message):
+        message = Client('stackexchange.com', store=store).get_message(101)
+        assert message.text_content == 'message number 101 & more'
+    store.close()
+
+    store = MessageStore(path, flush_interval=None)
+    assert len(store) == 6
+    # no requests are allowed
+    with only_httmock():
+        client = Client('stackexchange.com', store=store)
+        message = client.get_message(105)
+        assert message.content == 'message <i>number</i> 105 &amp; more'
+        assert message.owner.id == 6
+        assert message.room.name == 'Sandbox'
+        assert message.parent is client.get_message(104)
+        assert message.starred_by_you
+    store.close()
+
+
+def test_events_are_merged_with_scraped_data(tmpdir):
+    store = MessageStore(str(tmpdir.join('messages.db')), batch_size=2, flush_interval=None)
+    store.record({
+        'id': 1, 'room_id': 1, 'room_name': 'Sandbox', 'content': 'hello',
+        'owner_user_id': 5, 'owner_user_name': 'user 5', 'edited': False,
+        'stars': 0, 'starred': False, 'pinned': False,
+        'parent_message_id': None, 'starred_by_you': False,
+    })
+    store.record_event({
+        'event_type': 4, 'room_id': 1, 'user_id': 5, 'user_name': 'user 5',
+    })
+    store.record_event({
+        'event_type': 2, 'message_id': 1, 'room_id': 1, 'room_name': 'Sandbox',
+        'content': 'hello again', 'message_edits': 1, 'message_stars': 3,
+        'user_id': 5, 'user_name': 'user 5', 'time_stamp': 1000,
+    })
+    # the first flush happens when a second message is recorded
+    assert store._pending == {1: store._pending[1]}
+    store.record_event({
+        'event_type': 1, 'message_id': 2, 'room_id': 1, 'room_name': 'Sandbox',
+        'content': 'hi', 'user_id': 6, 'user_name': 'user 6', 'time_stamp': 1001,
+    })
+    assert store._pending == {}
+
+    message_data = store.get(1)
+    assert message_data['content'] == 'hello again'
+    assert message_data['owner_user_id'] == 5
+    assert message_data['edits'] == 1
+    assert message_data['stars'] == 3
+    assert message_data['starred_by_you'] is False
+    assert store.get(2)['time_stamp'] == 1001
+    assert store.get(3) is None
+    store.close()
+
+
+def test_local_changes_skip_the_store_and_are_recorded(tmpdir):
+    store = MessageStore(str(tmpdir.join('messages.db')), flush_interval=None)
+    with only_httmock(transcript_with_message):
+        Client('stackexchange.com', store=store).get_message(101).content
+    stars = store.get(105)['stars']
+    assert store.get(105)['starred_by_you']
+
+    requests = []
+
+    @httmock.urlmatch(path=r'^/transcript/message/\d+$')
+    def counted_transcript_with_message(url, request):
+        requests.append(url.path)
+        return mock_responses.transcript_page(6)
+
+    @httmock.urlmatch(path=r'^/messages/105/star$')
+    def toggle_starring(url, request):
+        requests.append(url.path)
+        return ''
+
+    with only_httmock(counted_transcript_with_message, toggle_starring):
+        client = Client('stackexchange.com', store=store)
+        client._br.chat_fkey = 'fkey'
+        message = client.get_message(105)
+        message.star(False)
+    # whether it's starred is checked on the server, not in the store
+    assert requests == ['/transcript/message/105', '/messages/105/star']
+
+    with only_httmock():
+        message = Client('stackexchange.com', store=store).get_message(105)
+        assert not message.starred_by_you
+        assert message.stars == stars - 1
+    store.close()
+
+
+def test_edits_drop_stale_history(tmpdir):
+    store = MessageStore(str(tmpdir.join('messages.db')), flush_interval=None)
+    store.record_history(1, {
+        'room_id': 1, 'content': 'hello', 'content_source': 'hello',
+        'edited': True, 'edits': 1, 'editor_user_id': 5,
+        'editor_user_name': 'user 5', 'stars': 0, 'starred': False,
+        'pinned': False,
+    })
+    store.flush()
+
+    def edited(edits, content):
+        store.record_event({
+            'event_type': 2, 'message_id': 1, 'room_id': 1,
+            'content': content, 'message_edits': edits,
+        })
+
+    edited(1, 'hello')
+    assert store.get(1)['content_source'] == 'hello'
+
+    edited(2, '<b>hello</b>')
+    for message_data in [store.get(1), store.flush() or store.get(1)]:
+        assert message_data['content'] == '<b>hello</b>'
+        assert 'content_source' not in message_data
+        assert 'editor_user_id' not in message_data
+
+    store.record_history(1, {'content_source': '**hello**', 'editor_user_id': 6})
+    store.flush()
+    assert store.get(1)['content_source'] == '**hello**'
+    assert store.get(1)['editor_user_id'] == 6
+    store.close()
+
+
+def test_search(tmpdir):
+    store = MessageStore(str(tmpdir.join('messages.db')), flush_interval=None)
+    with only_httmock(transcript_with_message):
+        client = Client('stackexchange.com', store=store)
+        client.get_message(101).content
+
+    def posted(message_id, room_id, user_id, time_stamp, content):
+        store.record_event({
+            'event_type': 1, 'message_id': message_id, 'room_id': room_id,
+            'room_name': 'Room %d' % (room_id,), 'user_id': user_id,
+            'user_name': 'user %d' % (user_id,), 'time_stamp': time_stamp,
+            'content': content,
+        })
+
+    posted(200, 2, 7, 1000, 'the <b>quick</b> brown fox')
+    posted(201, 2, 8, 2000, 'a quick "reply"')
+    posted(202, 3, 7, 3000, 'quick, somewhere else')
+
+    with only_httmock():
+        assert [m.id for m in client.search_messages('more')] == [
+            105, 104, 103, 102, 101, 100]
+        assert [m.id for m in client.search_messages('NUMBER 103')] == [103]
+
+        found = client.search_messages('quick')
+        assert [m.id for m in found] == [202, 201, 200]
+        assert found[2].text_content == 'the quick brown fox'
+        assert found[2].owner.name == 'user 7'
+
+        room = client.get_room(2)
+        assert [m.id for m in room.search_messages('quick')] == [201, 200]
+        assert [m.id for m in room.search_messages('quick', user_id=7)] == [200]
+        assert [m.id for m in client.search_messages(
+            'quick', since=1500, until=3000)] == [201]
+        assert [m.id for m in client.search_messages('"reply')] == [201]
+
+    # edits replace the indexed text, deletions remove it
+    store.record_event({
+        'event_type': 2, 'message_id': 200, 'room_id': 2,
+        'content': 'the slow brown fox', 'message_edits': 1,
+    })
+    store.record_event({'event_type': 10, 'message_id': 201, 'room_id': 2})
+    assert [m['id'] for m in store.search('quick')] == [202]
+    assert [m['id'] for m in store.search('slow')] == [200]
+    store.close()
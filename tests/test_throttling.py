@@ -0,0 +1,120 @@
+import time
+
+import httmock
+
+from chatexchange import Browser, throttling
+
+from tests.mock_responses import only_httmock
+
+
+def test_token_bucket_allows_bursts_then_spaces_requests(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(throttling, '_now', lambda: clock[0])
+
+    bucket = throttling.TokenBucket(rate=2, capacity=3)
+
+    assert [bucket.reserve() for _ in range(3)] == [0, 0, 0]
+    assert bucket.reserve() == 0.5
+    assert bucket.reserve() == 1.0
+
+    clock[0] += 10
+    assert bucket.reserve() == 0
+
+
+def test_rate_limiter_ignores_unlimited_classes():
+    limiter = throttling.RateLimiter({'read': None, 'write': (1, 1)})
+
+    assert limiter.acquire('read') == 0
+    assert limiter.acquire('read') == 0
+    assert limiter.acquire('write') == 0
+    assert 'read' not in limiter.buckets
+
+
+def test_endpoint_classes():
+    browser = Browser()
+
+    assert browser._endpoint_class('get', 'users/1') == 'read'
+    assert browser._endpoint_class('post', 'events') == 'read'
+    assert browser._endpoint_class('post', 'chats/1/events') == 'read'
+    assert browser._endpoint_class('post', 'chats/1/messages/new') == 'write'
+    assert browser._endpoint_class('post', 'messages/1/delete') == 'write'
+    assert browser._endpoint_class('post', 'ws-auth') == 'socket'
+    assert browser._endpoint_class(
+        'post', 'https://meta.stackexchange.com/users/login') == 'auth'
+
+
+def test_reads_are_not_delayed():
+    @httmock.all_requests
+    def ok(url, request):
+        return '{}'
+
+    with only_httmock(ok):
+        browser = Browser()
+        browser.host = 'stackexchange.com'
+
+        start = time.time()
+        for room_id in range(20):
+            browser.get('rooms/info/%s' % (room_id,))
+
+    assert time.time() - start < 1.0
+
+
+def test_retry_policy_backs_off_with_full_jitter(monkeypatch):
+    monkeypatch.setattr(throttling.random, 'uniform', lambda low, high: high)
+    policy = throttling.RetryPolicy(
+        max_retries=3, base_delay=1, max_delay=3,
+        budget=throttling.RetryBudget(capacity=10))
+
+    assert [policy.next_delay(attempt) for attempt in range(4)] == [1, 2, 3, None]
+    assert policy.stats()['retries'] == 3
+    assert policy.stats()['give_ups'] == 1
+
+
+def test_retry_budget_limits_retries():
+    policy = throttling.RetryPolicy(
+        budget=throttling.RetryBudget(ratio=0.5, capacity=1))
+
+    assert policy.next_delay(0) is not None
+    assert policy.next_delay(0) is None
+    assert policy.stats()['budget_exhaustions'] == 1
+
+    policy.on_request()
+    policy.on_request()
+    assert policy.next_delay(0) is not None
+
+
+def test_browser_retries_overloaded_responses(monkeypatch):
+    """
+    Tests that 503s are retried after the delay given by Retry-After,
+    and that other errors are not retried.
+    """
+    sleeps = []
+    monkeypatch.setattr(time, 'sleep', sleeps.append)
+    responses = [
+        {'status_code': 503, 'headers': {'Retry-After': '2'}},
+        {'status_code': 200, 'content': 'ok'},
+        {'status_code': 404},
+    ]
+
+    @httmock.all_requests
+    def flaky(url, request):
+        return responses.pop(0)
+
+    with only_httmock(flaky):
+        browser = Browser()
+        browser.host = 'stackexchange.com'
+        browser.retry_policy = throttling.RetryPolicy(
+            budget=throttling.RetryBudget())
+
+        assert browser.get('users/1').text == 'ok'
+        assert sleeps == [2.0]
+
+        try:
+            browser.get('users/2')
+        except Exception as e:
+            assert e.response.status_code == 404
+        else:
+            assert False, "404 should have been raised"
+
+    assert browser.retry_policy.stats() == {
+        'requests': 2, 'retries': 1, 'give_ups': 0, 'budget_exhaustions': 0}
@@ -0,0 +1,84 @@
+import pytest
+
+from chatexchange import _utils
+
+
+class Lazy(object):
+    __slots__ = ('loads',) + _utils.lazy_slots('a', 'b')
+
+    def __init__(self):
+        self.loads = 0
+
+    a = _utils.LazyFrom('load')
+    b = _utils.LazyFrom('load')
+
+    def load(self):
+        self.loads += 1
+        self.a = 'a'
+        self.b = None
+
+
+def test_lazy_from_slots():
+    obj = Lazy()
+    assert not Lazy.a.is_loaded(obj)
+    assert Lazy.a.peek(obj, 'default') == 'default'
+
+    assert obj.a == 'a'
+    assert obj.b is None
+    assert obj.loads == 1
+    assert Lazy.b.is_loaded(obj)
+
+    del obj.a
+    assert not Lazy.a.is_loaded(obj)
+    assert Lazy.b.is_loaded(obj)
+    assert obj.a == 'a'
+    assert obj.loads == 2
+
+
+def test_lazy_from_without_slots():
+    class Unslotted(object):
+        a = _utils.LazyFrom('load')
+
+        def load(self):
+            pass
+
+    obj = Unslotted()
+    with pytest.raises(AssertionError):
+        obj.a
+    obj.a = 1
+    assert obj.a == 1
+    assert obj.__dict__ == {'_lazy_a': 1}
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = _utils.LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert cache.stats() == {
+        'size': 2, 'maxsize': 2, 'hits': 1, 'misses': 1,
+        'evictions': 1, 'expirations': 0,
+    }
+
+
+def test_lru_cache_expires_entries(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(_utils, '_now', lambda: now[0])
+    cache = _utils.LRUCache(10, ttl=5)
+    cache.put('a', 1)
+    cache.put('b', 2)
+
+    now[0] = 4
+    assert cache.get('a') == 1
+    now[0] = 6
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+
+    cache.put('c', 3)
+    assert len(cache) == 2
+    assert cache.stats()['expirations'] == 1